@@ -23,12 +23,7 @@ __contributors__ = "Bob Ippolito, Michael Leonhard"
 #	--message-id-warning|--no-message-id-warning
 #       --quiet -q | -v --verbose
 # - show size info
-# - multiple pass (*inbox*/i ; Trash at the end)
 # - see -120 new email = 120 deleted, what to do ? keep it or overwrite the mbox ?
-# - show total size
-# - --quota 45GB
-# - show percent of use/quota
-# - show warning if quota reached --quota-percent-warning 90%
 # 
 
 # bugfixed: -y remove current mbox but return, no write of downloaded data
@@ -43,10 +38,6 @@ __contributors__ = "Bob Ippolito, Michael Leonhard"
 #   and add missing Message-Id
 # - Test parseList() and its descendents on other imapds
 # - Test bzip2 support
-# - Add option to download only subscribed folders
-# - Add regex option to filter folders
-# - Use a single IMAP command to get Message-IDs
-# - Use a single IMAP command to fetch the messages
 # - Add option to turn off spinner.  Since sys.stdin.isatty() doesn't work on
 #   Windows, redirecting output to a file results in junk output.
 # - Patch Python's ssl module to do proper checking of certificate chain
@@ -54,26 +45,53 @@ __contributors__ = "Bob Ippolito, Michael Leonhard"
 # - Submit patch of socket._fileobject.read
 # - Improve imaplib module with LIST parsing code, submit patch
 # DONE:
+# v1.4b
+# - Use a single IMAP command to get Message-IDs
+# - Use a single IMAP command to fetch the messages
 # v1.3c
 # - Add SSL support
 # - Support host:port
 # - Cleaned up code using PyLint to identify problems
 #   pylint -f html --indent-string="  " --max-line-length=90 imapbackup.py > report.html
 import getpass, os, gc, sys, time, platform, getopt
-import mailbox, imaplib, socket
-import re, sha, gzip, bz2
+import imaplib, socket, threading, Queue, mmap, itertools, glob, bisect
+import re, sha, gzip, bz2, json, struct, cProfile, pstats, multiprocessing, array
+import random, math, zlib, traceback
+
+# commands imaplib doesn't know about
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
-def tweaksocket(server):
-  server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+def tweaksocket(sock, config):
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  # lets the OS find out about connections dropped on the way, eg. by a NAT
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+  # a fixed buffer turns the autotuning of the OS off, only set if asked for
+  if config['rcvbuf']:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config['rcvbuf'])
 
 config_message_id_warning=0
 config_messahe_info_overwrite=1
 
+OUTPUT_LOCK = threading.Lock()
+
+def report(line):
+  """Prints a line of output, never interleaved with the lines of other threads"""
+  OUTPUT_LOCK.acquire()
+  try:
+    print line
+  finally:
+    OUTPUT_LOCK.release()
+
 def debugprint(msg):
   if len(msg) > 0:
-    print("[I]: %s" % msg)
+    report("[I]: %s" % msg)
   else:
-    print("")
+    report("")
 
 def print_usage():
   """Prints usage, exits"""
@@ -81,8 +99,10 @@ def print_usage():
   print " -a --append-to-mboxes     Append new messages to mbox files. (default)"
   print " -y --yes-overwrite-mboxes Overwite existing mbox files instead of appending."
   print " -n --compress=none        Use one plain mbox file for each folder. (default)"
-  print " -z --compress=gzip        Use mbox.gz files.  Appending may be very slow."
+  print " -z --compress=gzip        Use mbox.gz files, a new gzip member per run."
   print " -b --compress=bzip2       Use mbox.bz2 files. Appending not supported: use -y."
+  print " --compress=zstd           Use mbox.zst files, a new zstd frame per run."
+  print "                           Needs the zstandard module."
   print " -e --ssl                  Use SSL.  Port defaults to 993."
   print " -k KEY --key=KEY          PEM private key file for SSL.  Specify cert, too."
   print " -c CERT --cert=CERT       PEM certificate chain for SSL.  Specify key, too."
@@ -90,7 +110,80 @@ def print_usage():
   print " -s HOST --server=HOST     Address of server, port optional, eg. mail.com:143"
   print " -u USER --user=USER       Username to log into server"
   print " -p PASS --pass=PASS       Prompts for password if not specified."
-  print "\nNOTE: mbox files are created in the current working directory."
+  print " --scan-chunk=N            Messages per FETCH when scanning folders. (5000)"
+  print " --inflight=BYTES          Bytes of messages requested ahead when downloading."
+  print "                           Accepts K, M and G suffixes. (16M)"
+  print " --full-scan               Ignore the saved .state of folders, rescan them all."
+  print " --scan-processes=N        Scan the local files of folders without a .state in"
+  print "                           N processes, while the server is scanned.  0 scans"
+  print "                           each of them when its folder is backed up. (CPUs)"
+  print " -j N --jobs=N             Back up N folders at once over N connections. (1)"
+  print " --reconnects=N            Times a broken connection is opened again for a"
+  print "                           folder, waiting 1s, 2s, 4s... before, the backup of"
+  print "                           the folder going on from the messages stored. (5)"
+  print " --timeout=SECONDS         A connection the server sends nothing over for that"
+  print "                           long is taken as broken, and opened again.  0 waits"
+  print "                           for ever. (120)"
+  print " --no-deflate              Don't compress the connection, even when the server"
+  print "                           has COMPRESS=DEFLATE."
+  print " --rcvbuf=BYTES            Receive buffer of connections, for fast links far"
+  print "                           away.  0 leaves it to the OS. (0)"
+  print " --read-chunk=BYTES        Bytes of a message read at once from the server."
+  print "                           (256K)"
+  print " --order=oldest            Download the messages of a folder in the order they"
+  print "                           arrived in it. (default)"
+  print " --order=smallest          Download the smallest messages first."
+  print " --max-rate=BYTES          Most bytes per second downloaded, all folders together."
+  print " --budget=BYTES            Most bytes downloaded by this run, the next runs"
+  print "                           going on from where it stopped."
+  print " --since=DAYS|YYYY-MM-DD   Only back up messages received in the last DAYS days,"
+  print "                           or since that date."
+  print " --larger=BYTES            Only back up messages larger than BYTES."
+  print " --smaller=BYTES           Only back up messages smaller than BYTES."
+  print " --skip-deleted            Don't back up messages flagged \\Deleted."
+  print " --search=KEYS             Only back up messages matching these SEARCH keys,"
+  print "                           eg. --search='NOT FROM spam@example.com'"
+  print "                           The server does the filtering, by UID SEARCH."
+  print " --include=REGEX           Only back up folders whose name matches REGEX."
+  print " --exclude=REGEX           Don't back up folders whose name matches REGEX."
+  print "                           Both may be repeated.  --exclude replaces the default"
+  print "                           '\\[Gmail\\]/', an empty REGEX excluding nothing."
+  print " --subscribed              Only back up subscribed folders, and INBOX."
+  print " --skip-special=USES       Don't back up folders with these SPECIAL-USE"
+  print "                           attributes, eg. All,Flagged,Junk,Trash (All,Flagged)"
+  print "                           Folders are backed up INBOX first, Junk and Trash last."
+  print " --plan                    Only tell what would be done with each folder: skip"
+  print "                           it, scan it since its last run or fully, and its"
+  print "                           messages and size, from the STATUS of all folders."
+  print " --quota=BYTES             Quota of the account, when the server doesn't tell"
+  print "                           it with QUOTA, the folders backed up using it."
+  print " --quota-warning=PERCENT   Warn when this much of the quota is used. (90%)"
+  print " --disk-reserve=BYTES      Space kept free on the disk of the backup.  Folders"
+  print "                           whose new messages don't fit aren't downloaded,"
+  print "                           the run ending with status 7. (100M)"
+  print " --metrics=FILE            Append the time spent in each phase of each folder,"
+  print "                           round trips and bytes read and written, to FILE as"
+  print "                           JSON lines, one per folder and one for the account."
+  print " --prometheus=FILE         Write the same as a textfile for the node_exporter."
+  print " --profile=FILE            Run under cProfile, write the stats to FILE and print"
+  print "                           the functions most time is spent in."
+  print " --verify                  Check the messages stored against the server instead"
+  print "                           of backing up: their size and date, and for a"
+  print "                           sample of them, their text, downloaded again."
+  print "                           Messages stored before .sums files existed are"
+  print "                           only counted."
+  print " --verify-sample=RATIO     Part of the messages downloaded again. (0.01)"
+  print " --verify-time=SECONDS     Most time spent downloading them, 0 for no limit."
+  print "                           (3600)"
+  print " --store=mbox              Store each folder in a mbox file. (default)"
+  print " --store=maildir           Store each folder in a Maildir directory."
+  print " --store=cas               Store each message once in objects/, whatever folders"
+  print "                           it is in, each folder in a .manifest file listing them."
+  print "\nNOTE: mbox files are created in the current working directory, along with"
+  print "      a .state file per folder which lets next runs skip unchanged folders,"
+  print "      a .idx file per mbox which saves rereading it, and a .sums file per"
+  print "      folder recording the messages downloaded, for --verify.  What a"
+  print "      run planned to do is kept in imapbackup.plan."
   sys.exit(2)
 
 
@@ -132,6 +225,14 @@ class Spinner:
       sys.stdout.write("\r")
       sys.stdout.flush()
 
+def parse_byte_count(text):
+  """Converts a human friendly count of bytes into an integer, eg: 16MB"""
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', text, re.IGNORECASE)
+  if match is None:
+    raise ValueError("invalid byte count: %s" % (text))
+  unit = {'':1, 'K':1024, 'M':1048576, 'G':1073741824, 'T':1099511627776}
+  return int(float(match.group(1)) * unit[match.group(2).upper()])
+
 def pretty_byte_count(num):
   """Converts integer into a human friendly count of bytes, eg: 12.243 MB"""
   if num == 1:
@@ -147,181 +248,2431 @@ def pretty_byte_count(num):
   else:
     return "%.1f TB" % (num/1099511627776.0)
 
+def pretty_duration(seconds):
+  """Returns a duration as hours, minutes and seconds, eg. 1h02m03s"""
+  seconds = int(seconds)
+  if seconds < 3600:
+    return "%dm%02ds" % (seconds / 60, seconds % 60)
+  return "%dh%02dm%02ds" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
 
 # Regular expressions for parsing
 MSGID_RE = re.compile("^Message\-Id\: (.+)", re.IGNORECASE + re.MULTILINE)
 BLANKS_RE = re.compile(r'\s+', re.MULTILINE)
+MSGID_HEADER_RE = re.compile(r'^Message-Id\s*:', re.IGNORECASE + re.MULTILINE)
+
+FETCH_START_RE = re.compile(r'^(\d+) \(')
+LITERAL_RE = re.compile(r'\{(\d+)\}$')
+STATUS_RE = re.compile(r'\(([^()]*)\)\s*$')
+QUOTA_RE = re.compile(r'\bSTORAGE (\d+) (\d+)', re.IGNORECASE)
+SCAN_ITEMS = '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+SYNTHESIS_ITEMS = '(BODY.PEEK[HEADER.FIELDS (FROM TO CC DATE SUBJECT)])'
+FETCH_ITEMS = [
+  ('UID', re.compile(r'\bUID (\d+)'), int),
+  ('RFC822.SIZE', re.compile(r'\bRFC822\.SIZE (\d+)'), int),
+  ('INTERNALDATE', re.compile(r'\bINTERNALDATE "([^"]*)"'), str),
+]
+DOWNLOAD_ITEMS = '(UID INTERNALDATE BODY.PEEK[])'
+VERIFY_ITEMS = '(UID RFC822.SIZE INTERNALDATE)'
 
 # Constants
 UUID = '19AF1258-1AAF-44EF-9D9A-731079D6FAD7' # Used to generate Message-Ids
+SCAN_CHUNK = 5000 # Messages per FETCH command when scanning a folder
+FETCH_BATCH = 1000 # Most messages per FETCH command when downloading
+FETCH_PIPELINE = 4 # FETCH commands kept in flight when downloading
+FETCH_INFLIGHT = 16*1024*1024 # Bytes of messages requested but not yet read
+ZSTD_LEVEL = 10 # Compression level of mbox.zst files
+WRITER_QUEUE = 64 # Writes waiting for the compression thread
+READ_CHUNK = 256*1024 # Bytes read at once from compressed files
+LITERAL_CHUNK = 256*1024 # Bytes of a message read at once from the server
+DEFLATE_LEVEL = 6 # Compression level of the commands sent with COMPRESS=DEFLATE
+CHECKPOINT_BYTES = 16*1024*1024 # Bytes stored between two checkpoints of a store
+CHECKPOINT_INTERVAL = 30 # Most seconds between two checkpoints of a store
+RATE_BURST = 1.0 # Seconds of --max-rate a connection may catch up at once
+ORDERS = ('oldest', 'smallest') # Orders messages are downloaded in
+FILTER_OPTIONS = ('since', 'larger', 'smaller', 'skipdeleted', 'search') # See search_criteria()
+SPECIAL_USES = ['\\All', '\\Archive', '\\Drafts', '\\Flagged', '\\Junk', '\\Sent', '\\Trash']
+SKIP_SPECIAL = ['\\All', '\\Flagged'] # Folders showing messages of other folders
+TRASH_NAMES = ('trash', 'deleted items', 'deleted messages', 'bin')
+JUNK_NAMES = ('junk', 'spam', 'junk e-mail', 'bulk mail')
+METRIC_COUNTERS = [('round_trips', 'Round trips to the server'),
+                   ('received_bytes', 'Bytes read from the server'),
+                   ('sent_bytes', 'Bytes sent to the server'),
+                   ('compressed_bytes', 'Bytes read from the server over COMPRESS=DEFLATE'),
+                   ('inflated_bytes', 'Bytes those compressed bytes inflated to'),
+                   ('compressed_read_microseconds', 'Time spent waiting for those compressed bytes'),
+                   ('inflate_microseconds', 'Time spent inflating them'),
+                   ('written_bytes', 'Bytes of messages downloaded and stored'),
+                   ('copied_bytes', 'Bytes of messages copied from other folders'),
+                   ('largest_message_bytes', 'Size of the largest message downloaded'),
+                   ('new_messages', 'Messages found new on the server'),
+                   ('downloaded_messages', 'Messages downloaded'),
+                   ('reconnects', 'Connections opened again after they broke')]
+PROFILE_LINES = 25 # Functions listed by --profile
+RECONNECTS = 5 # Times a broken connection is opened again for a folder
+RECONNECT_DELAY = 1 # Seconds before opening a broken connection again, doubled each time
+RECONNECT_MAX_DELAY = 60 # Most seconds before opening a broken connection again
+TIMEOUT = 120 # Seconds without anything from the server before a connection is broken
+# What a broken connection raises, see Session
+CONNECTION_ERRORS = (socket.error, imaplib.IMAP4.abort)
+DISK_RESERVE = 100*1024*1024 # Bytes left free on the disk of the backup
+DISK_OVERHEAD = 1024 # Bytes a message may take on disk besides its text
+QUOTA_WARNING = 90 # Percent of the quota used past which a warning is printed
+VERIFY_SAMPLE = 0.01 # Part of the messages --verify downloads again and hashes
+VERIFY_TIME = 3600 # Most seconds --verify spends downloading messages again
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+PLAN_FILENAME = 'imapbackup.plan' # What the last run planned, see plan_folders()
+CAS_ROOT = 'objects' # Directory of the messages of --store=cas
+CAS_IDS = os.path.join(CAS_ROOT, 'ids') # Message-Id, hash, size and manifest of each of them
+# LocalCopies of the messages of all mbox files, see find_local_copy()
+LOCAL_COPIES = None
+LOCAL_COPIES_LOCK = threading.Lock()
+# Maildir file names, see http://cr.yp.to/proto/maildir.html
+# How the data past the last checkpoint of a mbox starts, see MboxStore.recover()
+MEMBER_MAGIC = {'none':'From ', 'gzip':'\x1f\x8b', 'zstd':'\x28\xb5\x2f\xfd'}
+HOSTNAME = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+UNIQUE_COUNTER = itertools.count()
 
-def download_messages(server, filename, messages, config, countlocal, countremote, countnew):
-  """Download messages from folder and append to mailbox"""
-  
-  if config['overwrite']:
-    if os.path.exists(filename):
-      if config_messahe_info_overwrite:
-        print("   Deleting %s" % (filename))
-      os.remove(filename)
-    #return 0, 0
+class MessageWriter:
+  """Writes a message to a file as it is downloaded, a chunk at a time
+
+  What gets written is the same as text.strip().replace('\r', '') of the
+  whole message, and with quote, lines starting with "From " get a '>' so
+  that mbox readers don't take them for the start of another message."""
+
+  def __init__(self, out, quote=False, digest=False):
+    """MessageWriter constructor"""
+    self.out = out
+    self.quote = quote
+    self.digest = digest and sha.new() or None
+    self.received = sha.new() # of the message as the server sent it, see Sums
+    self.length = 0 # bytes written
+    self.size = 0 # bytes of the message, without the quoting
+    self.started = False # once the leading blanks are skipped
+    self.blanks = '' # blanks held back, dropped if they end the message
+    self.line_start = True # the next byte starts a line
+    self.pending = '' # start of a line which may turn out to be "From "
+
+  def emit(self, data):
+    """Writes data as is"""
+    self.out.write(data)
+    self.length += len(data)
+    if self.digest is not None:
+      self.digest.update(data)
+
+  def write(self, data):
+    """Writes the next chunk of the message"""
+    self.received.update(data)
+    data = data.replace('\r', '')
+    if not self.started:
+      data = data.lstrip()
+      if not data:
+        return
+      self.started = True
+    text = data.rstrip()
+    if not text:
+      self.blanks += data
+      return
+    text, self.blanks = self.blanks + text, data[len(text):]
+    self.size += len(text)
+
+    if self.quote:
+      text = self.pending + text
+      if self.line_start:
+        text = ('\n' + text).replace('\nFrom ', '\n>From ')[1:]
+      else:
+        text = text.replace('\nFrom ', '\n>From ')
+      # hold back the end of the last line if it may still become "From "
+      cut = text.rfind('\n') + 1
+      tail = text[cut:]
+      if (cut or self.line_start) and len(tail) < 5 and 'From '.startswith(tail):
+        text, self.pending, self.line_start = text[:cut], tail, True
+      else:
+        self.pending, self.line_start = '', False
+    self.emit(text)
+
+  def finish(self, ending):
+    """Writes what was held back of the message, without its trailing blanks, then ending"""
+    self.emit(self.pending + ending)
+    self.pending = self.blanks = ''
+
+def make_fetch_batches(messages, budget, pipeline, keys=None):
+  """Splits {key: size} into sorted key lists, each worth a share of the in-flight budget
+
+  keys is the order the messages are wanted in, sorted keys by default: the
+  batches follow it, each batch being sorted for its sequence set."""
+  share = max(budget / pipeline, 1)
+  batches = []
+  batch, batch_size = [], 0
+  if keys is None:
+    keys = sorted(messages.keys())
+  for key in keys:
+    if batch and (batch_size + (messages[key] or 0) > share or len(batch) >= FETCH_BATCH):
+      batches.append(sorted(batch))
+      batch, batch_size = [], 0
+    batch.append(key)
+    batch_size += messages[key] or 0
+  if batch:
+    batches.append(sorted(batch))
+  return batches
+
+def schedule_downloads(wanted, order, throttle):
+  """Orders the {key: (msg_id, size)} messages to download, keys being UIDs or numbers
+
+  Returns (keys to download in that order, keys left for a later run because
+  they don't fit in the byte budget of the run).  'oldest' goes by key,
+  which is the order messages arrived in the folder, 'smallest' by size."""
+  if order == 'smallest':
+    keys = sorted(wanted.keys(), key=lambda key: (wanted[key][1] or 0, key))
   else:
-    assert('bzip2' != config['compress'])
+    keys = sorted(wanted.keys())
+  for i in range(len(keys)):
+    if not throttle.reserve(wanted[keys[i]][1] or 0):
+      return keys[:i], keys[i:]
+  return keys, []
+
+class Throttle:
+  """Keeps the downloads of a run under a rate and within a byte budget
+
+  One Throttle is shared by all the connections of a run (see get_config()).
+  reserve() tells whether a message still fits in the budget, delay() how
+  long to wait after reading bytes for the rate to stay under max_rate."""
+
+  def __init__(self, max_rate=0, budget=0):
+    """Throttle constructor, 0 meaning no limit"""
+    self.max_rate = max_rate
+    self.budget = budget
+    self.reserved = 0 # bytes of the budget taken
+    self.spent = False # once a message didn't fit
+    self.downloaded = 0 # bytes read
+    self.started = None # time of the first read
+    self.clock = 0 # when the bytes read would have been read at max_rate
+    self.left = 0 # bytes left for a later run
+    self.lock = threading.Lock()
+
+  def reserve(self, size):
+    """Takes size bytes from the budget, returns False if they don't fit
+
+    The first message always fits, even when bigger than the whole budget, so
+    that every run gets somewhere.  Once one doesn't, the budget is spent."""
+    self.lock.acquire()
+    try:
+      if not self.budget:
+        return True
+      if self.spent or (self.reserved and self.reserved + size > self.budget):
+        self.spent = True
+        return False
+      self.reserved += size
+      return True
+    finally:
+      self.lock.release()
+
+  def delay(self, count):
+    """Counts count bytes read, returns how many seconds to wait before reading more"""
+    self.lock.acquire()
+    try:
+      now = time.time()
+      if self.started is None:
+        self.started = now
+      self.downloaded += count
+      if not self.max_rate:
+        return 0
+      self.clock = max(self.clock, now - RATE_BURST) + float(count) / self.max_rate
+      return max(self.clock - now, 0)
+    finally:
+      self.lock.release()
+
+  def spend(self, count):
+    """Counts count bytes read, sleeps as long as needed to stay under max_rate"""
+    pause = self.delay(count)
+    if pause > 0:
+      time.sleep(pause)
+
+  def leave(self, size):
+    """Counts size bytes left for a later run"""
+    self.lock.acquire()
+    try:
+      self.left += size
+    finally:
+      self.lock.release()
+
+  def eta(self, size):
+    """Seconds to download size bytes at the pace of this run, None if unknown"""
+    rate = 0.0
+    if self.started is not None and time.time() > self.started:
+      rate = self.downloaded / (time.time() - self.started)
+    if self.max_rate:
+      rate = min(rate or self.max_rate, self.max_rate)
+    if not rate:
+      return None
+    return size / rate
+
+class DiskSpace:
+  """The free space of the disk of the backup, shared by the folders backed up at once
+
+  Before the new messages of a folder are downloaded, reserve() checks that
+  they fit in what is free, less --disk-reserve and what the folders being
+  downloaded meanwhile reserved.  A folder which doesn't fit isn't
+  downloaded at all, rather than half written, and finish() tells what
+  didn't fit."""
+
+  def __init__(self, keep_free=DISK_RESERVE):
+    """DiskSpace constructor"""
+    self.keep_free = keep_free
+    self.reserved = 0 # bytes of the folders being downloaded
+    self.unfitted = [] # (filename, bytes needed, bytes free)
+    self.lock = threading.Lock()
+
+  def free(self):
+    """Bytes free on the disk of the current directory, None if unknown"""
+    if not hasattr(os, 'statvfs'):
+      return None
+    stat = os.statvfs('.')
+    return stat.f_bavail * stat.f_frsize
+
+  def reserve(self, filename, size):
+    """Takes size bytes for the folder stored in filename, returns False if they don't fit"""
+    self.lock.acquire()
+    try:
+      free = self.free()
+      if free is None:
+        return True
+      free = max(free - self.keep_free - self.reserved, 0)
+      if size > free:
+        self.unfitted.append((filename, size, free))
+        return False
+      self.reserved += size
+      return True
+    finally:
+      self.lock.release()
+
+  def release(self, size):
+    """Gives back what reserve() took, once the folder is on disk"""
+    self.lock.acquire()
+    try:
+      self.reserved -= size
+    finally:
+      self.lock.release()
+
+  def finish(self):
+    """Tells which folders didn't fit, returns 7 if some didn't, 0 otherwise"""
+    if not self.unfitted:
+      return 0
+    report("Not enough disk space: %d folders not downloaded, %s needed for them:" % (
+           len(self.unfitted), pretty_byte_count(sum([size for filename, size, free in self.unfitted]))))
+    for filename, size, free in self.unfitted:
+      report("  %s: %s needed, %s free" % (filename, pretty_byte_count(size),
+                                           pretty_byte_count(free)))
+    return 7
+
+def disk_needed(new_messages, config):
+  """Bytes the new messages of a folder may take on disk, within the --budget of the run"""
+  needed = sum([(size or 0) + DISK_OVERHEAD for num, uid, size in new_messages.values()])
+  if config['budget']:
+    needed = min(needed, config['budget'])
+  return needed
+
+class Checkpoints:
+  """Tells when a store has stored enough since its last checkpoint for another one"""
+
+  def __init__(self):
+    """Checkpoints constructor"""
+    self.last = time.time()
+    self.size = 0
+
+  def due(self, size):
+    """Counts a message of size bytes stored, returns True when a checkpoint is due"""
+    self.size += size
+    if self.size < CHECKPOINT_BYTES and time.time() - self.last < CHECKPOINT_INTERVAL:
+      return False
+    self.last, self.size = time.time(), 0
+    return True
+
+class Metrics:
+  """Time spent in each phase of a folder, or of the account, and counters
+
+  Phases started and stopped by one thread nest: the time of an inner phase
+  doesn't count for the outer one.  Time measured by other threads is added
+  with charge(), and may overlap with the phases of this one."""
+
+  def __init__(self, folder=None, filename=None):
+    """Metrics constructor, folder None for the account"""
+    self.folder = folder
+    self.filename = filename
+    self.started = time.time()
+    self.times = {}
+    self.counters = {}
+    self.phases = [] # phases started and not stopped, innermost last
+    self.mark = None # when the time of the innermost phase was last counted
+    self.lock = threading.Lock()
+
+  def start(self, phase):
+    """Starts timing phase, pausing the phase it is part of"""
+    now = time.time()
+    if self.phases:
+      self.charge(self.phases[-1], now - self.mark)
+    self.phases.append(phase)
+    self.mark = now
+
+  def stop(self):
+    """Stops timing the innermost phase"""
+    now = time.time()
+    self.charge(self.phases.pop(), now - self.mark)
+    self.mark = now
+
+  def charge(self, phase, seconds):
+    """Adds seconds to the time of phase"""
+    self.lock.acquire()
+    try:
+      self.times[phase] = self.times.get(phase, 0.0) + seconds
+    finally:
+      self.lock.release()
+
+  def add(self, counter, value=1):
+    """Adds value to a counter"""
+    self.lock.acquire()
+    try:
+      self.counters[counter] = self.counters.get(counter, 0) + value
+    finally:
+      self.lock.release()
+
+  def stop_all(self):
+    """Stops the phases an error left started"""
+    while self.phases:
+      self.stop()
+
+  def record(self):
+    """The metrics as a dict, stopping the phases an error left started"""
+    self.stop_all()
+    record = {'time':int(self.started), 'seconds':round(time.time() - self.started, 6),
+              'phases':dict([(phase, round(seconds, 6)) for phase, seconds in self.times.items()])}
+    for counter, help in METRIC_COUNTERS:
+      record[counter] = self.counters.get(counter, 0)
+    if self.folder is not None:
+      record['folder'] = self.folder
+      record['file'] = self.filename
+    return record
+
+class MetricsReport:
+  """Collects the Metrics of a run, writes them as JSON lines and as a Prometheus textfile
+
+  A line is appended to --metrics for each folder once it is done, and one for
+  the whole account at the end.  The --prometheus textfile is written at the end,
+  replacing that of the previous run."""
+
+  def __init__(self, config):
+    """MetricsReport constructor"""
+    self.config = config
+    self.account = Metrics()
+    self.records = []
+    self.lock = threading.Lock()
+
+  def add(self, metrics):
+    """Adds the metrics of a folder which is done"""
+    record = metrics.record()
+    self.lock.acquire()
+    try:
+      self.records.append(record)
+      self.write_json(record)
+    finally:
+      self.lock.release()
+
+  def write_json(self, record):
+    """Appends a record to the --metrics file"""
+    if not self.config['metricsfile']:
+      return
+    record = dict(record, user=self.config['user'], server=self.config['server'])
+    metricsfile = open(self.config['metricsfile'], 'a')
+    try:
+      metricsfile.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+      metricsfile.close()
+
+  def close(self):
+    """Writes the metrics of the account, those of its folders added up"""
+    account = self.account.record()
+    for record in self.records:
+      for phase, seconds in record['phases'].items():
+        account['phases'][phase] = round(account['phases'].get(phase, 0.0) + seconds, 6)
+      for counter, help in METRIC_COUNTERS:
+        if counter == 'largest_message_bytes':
+          account[counter] = max(account[counter], record[counter])
+        else:
+          account[counter] += record[counter]
+    account['folders'] = len(self.records)
+    self.write_json(account)
+    if self.config['prometheusfile']:
+      self.write_prometheus(account)
+    if account['compressed_bytes']:
+      report_deflate(account)
+
+  def write_prometheus(self, account):
+    """Writes the metrics of the run as a textfile for the node_exporter"""
+    labels = 'user="%s",server="%s"' % (prometheus_label(self.config['user']),
+                                        prometheus_label(self.config['server']))
+    records = [('', account)] + [(record['folder'], record) for record in self.records]
+    lines = ["# HELP imapbackup_phase_seconds Time spent in each phase of the last run.",
+             "# TYPE imapbackup_phase_seconds gauge"]
+    for folder, record in records:
+      for phase in sorted(record['phases']):
+        lines.append('imapbackup_phase_seconds{%s,folder="%s",phase="%s"} %f' % (labels,
+          prometheus_label(folder), phase, record['phases'][phase]))
+    for counter, help in METRIC_COUNTERS:
+      lines += ["# HELP imapbackup_%s %s of the last run." % (counter, help),
+                "# TYPE imapbackup_%s gauge" % (counter)]
+      for folder, record in records:
+        lines.append('imapbackup_%s{%s,folder="%s"} %d' % (counter, labels,
+                                                             prometheus_label(folder), record[counter]))
+    lines += ["# HELP imapbackup_run_seconds Duration of the last run.",
+              "# TYPE imapbackup_run_seconds gauge",
+              "imapbackup_run_seconds{%s} %f" % (labels, account['seconds']),
+              "# HELP imapbackup_last_run_timestamp_seconds When the last run started.",
+              "# TYPE imapbackup_last_run_timestamp_seconds gauge",
+              "imapbackup_last_run_timestamp_seconds{%s} %d" % (labels, account['time'])]
+
+    # the node_exporter must never read half a file
+    temp = self.config['prometheusfile'] + '.tmp'
+    promfile = open(temp, 'w')
+    try:
+      promfile.write('\n'.join(lines) + '\n')
+    finally:
+      promfile.close()
+    os.rename(temp, self.config['prometheusfile'])
+
+def report_deflate(account):
+  """Tells how much COMPRESS=DEFLATE saved of the bytes read, and of the time of the run
+
+  The bytes saved would have come at the rate the compressed bytes came
+  at while waited for, which the delays of the server slow down: the time
+  they would have taken is at most that.  Against it is the time spent
+  inflating."""
+  saved = account['inflated_bytes'] - account['compressed_bytes']
+  line = "COMPRESS=DEFLATE: read %s for %s (%.1fx), %s less" % (
+    pretty_byte_count(account['compressed_bytes']), pretty_byte_count(account['inflated_bytes']),
+    float(account['inflated_bytes']) / account['compressed_bytes'], pretty_byte_count(saved))
+  if account['compressed_read_microseconds'] > 0 and saved > 0:
+    rate = account['compressed_bytes'] * 1e6 / account['compressed_read_microseconds']
+    line += ", up to %.1fs of reading at %s/s, for %.1fs of inflating" % (
+      saved / rate, pretty_byte_count(int(rate)), account['inflate_microseconds'] / 1e6)
+  report(line)
+
+def prometheus_label(value):
+  """Escapes a Prometheus label value"""
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def count_traffic(server):
+  """Counts the bytes an imaplib connection sends and reads into server.metrics
+
+  A round trip is counted each time the server is read from after it was
+  sent something.  Bytes are counted before they are compressed with
+  COMPRESS=DEFLATE, see Deflate."""
+  read, readline, send = server.read, server.readline, server.send
+  server.sending = False
+  server.deflate = None
+
+  def counted_send(data):
+    server.sending = True
+    server.metrics.add('sent_bytes', len(data))
+    if server.deflate is not None:
+      data = server.deflate.compress(data)
+    return send(data)
+
+  def received(data):
+    if server.sending:
+      server.sending = False
+      server.metrics.add('round_trips')
+    server.metrics.add('received_bytes', len(data))
+    return data
+
+  server.read = lambda size: received(read(size))
+  server.readline = lambda: received(readline())
+  server.send = counted_send
+
+class Deflate:
+  """The COMPRESS=DEFLATE layer of an imaplib connection, see RFC 4978
+
+  Stands in for the file the IMAP4 object reads from: what comes from the
+  socket is inflated as it comes, a read chunk at a time, so that no more
+  than that is held ahead of what imaplib asked for.  compress() deflates
+  what is sent, flushing it for the server to read it whole."""
+
+  def __init__(self, server, chunk):
+    """Deflate constructor"""
+    self.server = server
+    self.file = server.file
+    self.raw = getattr(server, 'sslobj', None) or server.sock
+    self.chunk = chunk
+    self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    self.deflater = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self.buffer = ''
+
+  def fill(self):
+    """Inflates more into the buffer, returns False once the server closed the connection"""
+    data = self.inflater.unconsumed_tail
+    if not data:
+      started = time.time()
+      data = self.raw.recv(self.chunk)
+      if not data:
+        return False
+      self.server.metrics.add('compressed_read_microseconds', int((time.time() - started) * 1e6))
+      self.server.metrics.add('compressed_bytes', len(data))
+    started = time.time()
+    try:
+      text = self.inflater.decompress(data, self.chunk)
+    except zlib.error, e:
+      raise self.server.abort("COMPRESS=DEFLATE: %s" % (e))
+    self.server.metrics.add('inflate_microseconds', int((time.time() - started) * 1e6))
+    self.server.metrics.add('inflated_bytes', len(text))
+    self.buffer += text
+    return True
+
+  def read(self, size):
+    """Reads size bytes, less only when the connection was closed"""
+    while len(self.buffer) < size and self.fill():
+      pass
+    data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+  def readline(self, size=-1):
+    """Reads a line, or size bytes of it"""
+    searched = 0
+    while True:
+      end = self.buffer.find('\n', searched) + 1
+      if end:
+        break
+      if size >= 0 and len(self.buffer) >= size:
+        end = size
+        break
+      searched = len(self.buffer)
+      if not self.fill():
+        end = len(self.buffer)
+        break
+    if size >= 0:
+      end = min(end, size)
+    line, self.buffer = self.buffer[:end], self.buffer[end:]
+    return line
+
+  def compress(self, data):
+    """The bytes to send for data"""
+    return self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+
+  def close(self):
+    """Closes the file imaplib read from before"""
+    self.file.close()
+
+class TimedWriter:
+  """Passes the chunks of a message on to its writer, as the 'disk write' phase"""
+
+  def __init__(self, writer, metrics):
+    """TimedWriter constructor"""
+    self.writer = writer
+    self.metrics = metrics
+
+  def write(self, data):
+    """Writes a chunk"""
+    self.metrics.start('disk write')
+    try:
+      self.writer.write(data)
+    finally:
+      self.metrics.stop()
+
+def profiled(config, function, *args):
+  """Calls function(*args), under cProfile with --profile"""
+  if not config['profile']:
+    return function(*args)
+  profile = cProfile.Profile()
+  try:
+    return profile.runcall(function, *args)
+  finally:
+    config['profiles'].append(profile)
+
+def dump_profiles(config):
+  """Writes the profiles of the threads of the run to the --profile file, prints the hottest functions"""
+  if not config['profiles']:
+    return
+  stats = pstats.Stats(config['profiles'][0])
+  for profile in config['profiles'][1:]:
+    stats.add(profile)
+  stats.dump_stats(config['profile'])
+  OUTPUT_LOCK.acquire()
+  try:
+    print "Profile written to %s, hottest functions:" % (config['profile'])
+    stats.sort_stats('time').print_stats(PROFILE_LINES)
+  finally:
+    OUTPUT_LOCK.release()
+
+def sync_file(fileobj):
+  """Flushes a file object to disk"""
+  fileobj.flush()
+  os.fsync(fileobj.fileno())
+
+def cut_partial_line(filename):
+  """Removes the end of a text file past its last newline, left by a killed run"""
+  try:
+    textfile = open(filename, 'r+b')
+  except IOError:
+    return
+  try:
+    textfile.seek(0, 2)
+    size = textfile.tell()
+    textfile.seek(max(0, size - 4096))
+    tail = textfile.read()
+    if tail and not tail.endswith('\n'):
+      textfile.truncate(size - len(tail) + tail.rfind('\n') + 1)
+  finally:
+    textfile.close()
+
+def fetch_pipelined(server, batches, items, use_uid=True, pipeline=FETCH_PIPELINE, stream=None,
+                    throttle=None):
+  """Issues one FETCH per batch, keeping several of them in flight.
+
+  Yields (num, attrs) for each message as soon as its response has been read,
+  attrs being parsed by parse_fetch_response().  When a literal comes,
+  stream(num, attrs) is called with what was parsed of the response so far:
+  if it returns a file-like object, the literal is written to it a chunk at a
+  time, and that object is the value of the literal in attrs, instead of the
+  literal read whole in memory.  Literals are read under the rate of the
+  throttle, if any.  When a FETCH fails, no other is sent, and the answers
+  to those in flight are read before SkipFolderException is raised, for
+  the connection to be left ready for the next command."""
+  command = use_uid and 'UID FETCH' or 'FETCH'
+  pending = list(batches)
+  inflight = []
+  failure = None
+  while pending or inflight:
+    # keep the pipeline full
+    while pending and len(inflight) < pipeline:
+      tag = server._new_tag()
+      msgset = make_sequence_set(pending.pop(0))
+      server.send('%s %s %s %s\r\n' % (tag, command, msgset, items))
+      inflight.append((tag, msgset))
+
+    line = server._get_line()
+    completed = [(tag, msgset) for tag, msgset in inflight if line.startswith(tag + ' ')]
+    if completed:
+      # tagged completion of one of the commands in flight
+      tag, msgset = completed[0]
+      inflight.remove(completed[0])
+      del server.tagged_commands[tag]
+      if line.split(' ', 2)[1] != 'OK' and failure is None:
+        failure = "FETCH %s failed: %s" % (msgset, line)
+        pending = []
+      continue
+    if line.startswith('* BYE'):
+      raise server.abort(line)
+    if not (line.startswith('* ') and ' FETCH (' in line):
+      # unrelated untagged response (EXISTS, EXPUNGE, ...)
+      continue
+
+    # read the whole response of this message, including its literals
+    parts = []
+    text = line[2:].replace(' FETCH (', ' (', 1)
+    while True:
+      match = LITERAL_RE.search(text)
+      if match is None:
+        parts.append(text)
+        break
+      size = int(match.group(1))
+      sink = None
+      if stream is not None and failure is None:
+        num, attrs = parse_fetch_response(parts + [(text, '')]).items()[0]
+        sink = stream(num, attrs)
+      chunks = []
+      while size > 0:
+        data = server.read(min(size, server.read_chunk))
+        if not data:
+          raise server.abort("connection closed in a literal")
+        if sink is None:
+          chunks.append(data)
+        else:
+          sink.write(data)
+        size -= len(data)
+        if throttle is not None:
+          throttle.spend(len(data))
+      parts.append((text, sink or ''.join(chunks)))
+      text = server._get_line()
+    if failure is not None:
+      # the folder is skipped, what is still coming is only read
+      continue
+    for num, attrs in parse_fetch_response(parts).items():
+      yield num, attrs
+  if failure is not None:
+    raise SkipFolderException(failure)
+
+class ThreadedWriter:
+  """Writes to a file object from a thread of its own
+
+  Used for compressed mboxes, so that compressing doesn't stall the network."""
+
+  def __init__(self, target):
+    """ThreadedWriter constructor"""
+    self.target = target
+    self.queue = Queue.Queue(WRITER_QUEUE)
+    self.error = None
+    self.thread = threading.Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def run(self):
+    """Writes whatever is queued until close()"""
+    while True:
+      data = self.queue.get()
+      if data is None:
+        break
+      if self.error is None:
+        try:
+          self.target.write(data)
+        except Exception, e:
+          self.error = e
+    try:
+      self.target.close()
+    except Exception, e:
+      self.error = self.error or e
+
+  def write(self, data):
+    """Queues data for writing, raises the error of a previous write if any"""
+    if self.error is not None:
+      raise self.error
+    self.queue.put(data)
+
+  def close(self):
+    """Waits until everything is written and the target file is closed"""
+    self.queue.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+class ZstdFile:
+  """Write-only file object adding one zstd frame to the end of a file"""
+
+  def __init__(self, filename):
+    """ZstdFile constructor"""
+    self.file = open(filename, 'ab')
+    self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+  def write(self, data):
+    """Compresses and writes data"""
+    self.file.write(self.compressor.compress(data))
+
+  def close(self):
+    """Ends the frame, closes the file"""
+    self.file.write(self.compressor.flush())
+    self.file.close()
+
+class ChunkFile:
+  """Read-only file object over an iterator of data chunks"""
+
+  def __init__(self, chunks, raw):
+    """ChunkFile constructor, raw is the file to close at the end"""
+    self.chunks = chunks
+    self.raw = raw
+    self.buf = ''
+    self.pos = 0
+
+  def fill(self):
+    """Appends the next chunk to the buffer, returns False at the end"""
+    try:
+      chunk = self.chunks.next()
+    except StopIteration:
+      return False
+    self.buf = self.buf[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def readline(self):
+    """Reads a line, including its newline"""
+    while True:
+      newline = self.buf.find('\n', self.pos)
+      if newline != -1:
+        line = self.buf[self.pos:newline+1]
+        self.pos = newline + 1
+        return line
+      if not self.fill():
+        line = self.buf[self.pos:]
+        self.buf, self.pos = '', 0
+        return line
+
+  def read(self, size=-1):
+    """Reads up to size bytes, everything left if size is negative"""
+    while size < 0 or len(self.buf) - self.pos < size:
+      if not self.fill():
+        break
+    if size < 0:
+      size = len(self.buf) - self.pos
+    data = self.buf[self.pos:self.pos+size]
+    self.pos += len(data)
+    return data
+
+  def __iter__(self):
+    return iter(self.readline, '')
+
+  def close(self):
+    """Closes the underlying file"""
+    self.raw.close()
+
+def read_exactly(fileobj, size):
+  """Reads size bytes, raises IOError if the file ends before"""
+  data = fileobj.read(size)
+  if len(data) != size:
+    raise IOError("Truncated compressed file")
+  return data
 
-  # Open disk file
-  if config['compress'] == 'gzip':
-    mbox = gzip.GzipFile(filename, 'ab', 9)
-  elif config['compress'] == 'bzip2':
-    mbox = bz2.BZ2File(filename, 'wb', 512*1024, 9)
+def read_zstd(zfile):
+  """Decompresses the frames of a zstd file one after the other, yields the data
+
+  The end of each frame is found by walking its block headers, so that the
+  decompressor is only ever given the bytes of a single frame."""
+  while True:
+    magic = zfile.read(4)
+    if not magic:
+      return
+    if len(magic) != 4:
+      raise IOError("Truncated compressed file")
+    (number,) = struct.unpack('<I', magic)
+    if number & 0xFFFFFFF0 == 0x184D2A50:
+      # skippable frame
+      (size,) = struct.unpack('<I', read_exactly(zfile, 4))
+      zfile.seek(size, 1)
+      continue
+    if number != 0xFD2FB528:
+      raise IOError("Not a zstd file")
+
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    descriptor = read_exactly(zfile, 1)
+    flags = ord(descriptor)
+    single_segment = (flags >> 5) & 1
+    header_size = (1 - single_segment) + [0, 1, 2, 4][flags & 3] + \
+                  [single_segment, 2, 4, 8][flags >> 6]
+    yield decompressor.decompress(magic + descriptor + read_exactly(zfile, header_size))
+
+    last = False
+    while not last:
+      header = read_exactly(zfile, 3)
+      (value,) = struct.unpack('<I', header + '\0')
+      last, block_type, size = value & 1, (value >> 1) & 3, value >> 3
+      if block_type == 1:
+        # RLE block: one byte, repeated size times
+        size = 1
+      elif block_type == 3:
+        raise IOError("Corrupt zstd file")
+      yield decompressor.decompress(header)
+      while size:
+        chunk = read_exactly(zfile, min(size, READ_CHUNK))
+        size -= len(chunk)
+        yield decompressor.decompress(chunk)
+    if flags & 4:
+      # content checksum
+      yield decompressor.decompress(read_exactly(zfile, 4))
+
+def open_mbox_for_append(filename, compress):
+  """Opens a mbox for appending, each run adding a new gzip member or zstd frame"""
+  if compress == 'gzip':
+    return ThreadedWriter(gzip.GzipFile(filename, 'ab', 9))
+  elif compress == 'zstd':
+    return ThreadedWriter(ZstdFile(filename))
+  elif compress == 'bzip2':
+    return ThreadedWriter(bz2.BZ2File(filename, 'wb', 512*1024, 9))
   else:
-    mbox = open(filename, 'ab')
+    return open(filename, 'ab')
+
+def open_mbox_for_reading(filename, compress, start=0):
+  """Opens a mbox for reading its uncompressed data
+
+  start is where reading begins in the (compressed) file, the beginning of a
+  gzip member or zstd frame for compressed mboxes."""
+  if compress == 'bzip2':
+    return bz2.BZ2File(filename, 'rb')
+  mbox = open(filename, 'rb')
+  mbox.seek(start)
+  if compress == 'gzip':
+    return gzip.GzipFile(filename, 'rb', fileobj=mbox)
+  elif compress == 'zstd':
+    return ChunkFile(read_zstd(mbox), mbox)
+  return mbox
+
+class MboxIndex:
+  """Sidecar index of a mbox: offset, length and Message-Id of each message
+
+  The FOLDER.mbox.idx file is only ever appended to, except when rebuilt.  It
+  holds a "M<tab>offset<tab>length<tab>Message-Id" line per message, offsets
+  counting in the uncompressed mbox, with "name=value" fields before the
+  Message-Id for what is only known of some messages, like the "size=" the
+  server gave for the messages downloaded.  A "S<tab>size<tab>mtime<tab>end" line
+  each time the mbox is closed or checkpointed, telling what the mbox file
+  looked like then and where the next message goes, followed by a "W" line
+  while messages are being added.  An index whose last S line doesn't match
+  the mbox any more is stale, and torn when lines follow it: those of a run
+  which was killed, see MboxStore.recover().  For compressed mboxes, a "G<tab>file
+  offset<tab>offset" line tells where each gzip member or zstd frame starts,
+  both in the file and in the uncompressed mbox."""
+
+  def __init__(self, filename):
+    """MboxIndex constructor"""
+    self.mboxname = filename
+    self.filename = filename + '.idx'
+    self.entries = []
+    self.members = []
+    self.size = 0
+    self.end = 0
+    self.synced = False # an S line was found
+    self.torn = False # lines follow the last S line
+    self.file = None
+
+  def load(self):
+    """Reads all entries, returns False if the index is missing or stale
+
+    Either way, entries and members are left as they were at the last S line,
+    with size and end the size of the mbox file and of its data then."""
+    entries, members = [], []
+    at_sync = (0, 0)
+    signature = None
+    self.entries, self.members = [], []
+    self.size = self.end = 0
+    self.synced = self.torn = False
+    try:
+      idx = open(self.filename, 'rb')
+    except IOError:
+      return False
+    try:
+      try:
+        for line in idx:
+          fields = line.rstrip('\n').split('\t')
+          if fields[0] == 'M':
+            extra = dict([field.split('=', 1) for field in fields[3:-1]])
+            size = extra.get('size')
+            if size is not None:
+              size = int(size)
+            entries.append((int(fields[1]), int(fields[2]), fields[-1], size))
+          elif fields[0] == 'G':
+            members.append((int(fields[1]), int(fields[2])))
+          elif fields[0] == 'S':
+            self.size, self.end = int(fields[1]), int(fields[3])
+            at_sync = (len(entries), len(members))
+            signature = [self.size, int(fields[2])]
+            self.synced, self.torn = True, False
+            continue
+          signature = None
+          self.torn = True
+      except (ValueError, IndexError):
+        signature = None
+        self.torn = True
+    finally:
+      idx.close()
+    self.entries, self.members = entries[:at_sync[0]], members[:at_sync[1]]
+    return signature is not None and signature == mbox_signature(self.mboxname)
+
+  def check(self):
+    """Like load() but only reads the last line of the index, not the entries"""
+    try:
+      idx = open(self.filename, 'rb')
+    except IOError:
+      return False
+    try:
+      idx.seek(0, 2)
+      idx.seek(max(0, idx.tell() - 4096))
+      lines = idx.read().split('\n')
+    finally:
+      idx.close()
+    fields = (lines[-2:-1] or [''])[0].split('\t')
+    try:
+      if fields[0] != 'S' or [int(fields[1]), int(fields[2])] != mbox_signature(self.mboxname):
+        return False
+      self.end = int(fields[3])
+    except (ValueError, IndexError):
+      return False
+    return True
+
+  def open(self, rebuild=False):
+    """Opens the index for appending entries, or for rewriting all of them"""
+    if rebuild:
+      self.entries, self.members = [], []
+      self.size = self.end = 0
+      self.file = open(self.filename, 'wb')
+    else:
+      self.file = open(self.filename, 'ab')
+
+  def add(self, offset, length, msg_id, size=None):
+    """Appends an entry for a message written at offset in the mbox
+
+    size is the RFC822.SIZE of the message, when known."""
+    self.entries.append((offset, length, msg_id, size))
+    self.end = offset + length
+    if size is None:
+      self.file.write("M\t%d\t%d\t%s\n" % (offset, length, msg_id))
+    else:
+      self.file.write("M\t%d\t%d\tsize=%d\t%s\n" % (offset, length, size, msg_id))
+
+  def add_member(self, position, offset):
+    """Appends an entry for a gzip member or zstd frame starting at position"""
+    self.members.append((position, offset))
+    self.file.write("G\t%d\t%d\n" % (position, offset))
+
+  def rewrite(self, entries, members, end):
+    """Rebuilds the index with only these entries and members, leaving it open"""
+    self.open(rebuild=True)
+    for position, offset in members:
+      self.add_member(position, offset)
+    for entry in entries:
+      self.add(*entry)
+    self.end = end
+
+  def sync(self):
+    """Records the current state of the mbox, flushed to disk, and flushes the index"""
+    signature = mbox_signature(self.mboxname) or [0, 0]
+    self.file.write("S\t%d\t%d\t%d\n" % (signature[0], signature[1], self.end))
+    sync_file(self.file)
+
+  def checkpoint(self):
+    """Records the state of the mbox, flushed to disk, before adding messages to it"""
+    self.sync()
+    self.file.write("W\n")
+    self.file.flush()
+
+  def close(self):
+    """Records the current state of the (closed) mbox and closes the index"""
+    self.sync()
+    self.file.close()
+    self.file = None
+
+class Sums:
+  """The FOLDER.sums file, telling what the messages stored were like on the server
+
+  It holds a "UIDVALIDITY<tab>UID<tab>RFC822.SIZE<tab>INTERNALDATE<tab>SHA-1<tab>
+  Message-Id" line per message downloaded, the SHA-1 being that of the message
+  as the server sent it, for --verify to check the server against.  Only ever
+  appended to, unless the store is overwritten."""
+
+  # {filename: {copy_key(): (date, digest)}} of the .sums read by record_copy()
+  copies = {}
+  lock = threading.Lock()
+
+  def __init__(self, filename, uidvalidity):
+    """Sums constructor"""
+    self.filename = filename + '.sums'
+    self.uidvalidity = uidvalidity
+    self.file = None
+
+  def load(self):
+    """Returns {uid: (size, date, digest, msg_id)} of the lines of the current UIDVALIDITY"""
+    recorded = {}
+    try:
+      sums = open(self.filename, 'rb')
+    except IOError:
+      return recorded
+    try:
+      for line in sums:
+        # the last line may have been cut by a killed run
+        fields = line.rstrip('\n').split('\t', 5)
+        if len(fields) == 6 and line.endswith('\n') and fields[0] == str(self.uidvalidity):
+          recorded[int(fields[1])] = (int(fields[2]), fields[3], fields[4], fields[5])
+    finally:
+      sums.close()
+    return recorded
+
+  def open(self, overwrite):
+    """Opens the file for appending, or for rewriting it when overwriting"""
+    if not overwrite:
+      cut_partial_line(self.filename)
+    self.file = open(self.filename, overwrite and 'wb' or 'ab')
+
+  def add(self, uid, size, date, writer, msg_id):
+    """Records a message once stored, writer being the MessageWriter it went to"""
+    self.record(uid, size, date, writer.received.hexdigest(), msg_id)
+
+  def record(self, uid, size, date, digest, msg_id):
+    """Records a message once stored, digest being the SHA-1 of its text from the server"""
+    if uid is None:
+      return
+    self.file.write("%d\t%d\t%d\t%s\t%s\t%s\n" % (self.uidvalidity, uid, size or 0, date or '',
+                                                  digest, msg_id))
+
+  def checkpoint(self):
+    """Flushes the file to disk"""
+    sync_file(self.file)
+
+  def close(self):
+    """Closes the file, for record_copy() to read it again"""
+    self.file.close()
+    self.file = None
+    Sums.lock.acquire()
+    try:
+      Sums.copies.pop(self.filename, None)
+    finally:
+      Sums.lock.release()
+
+def record_copy(sums, uid, source, msg_id, size):
+  """Records in sums a message copied from the store source, as the .sums of source has it
+
+  Returns False when it has no line for the message.  The .sums of a store
+  is read the first time a message is copied from it, and again once
+  closed after more messages were recorded in it."""
+  filename = source + '.sums'
+  Sums.lock.acquire()
+  try:
+    if filename not in Sums.copies:
+      Sums.copies[filename] = {}
+      try:
+        lines = open(filename, 'rb')
+      except IOError:
+        lines = []
+      for line in lines:
+        fields = line.rstrip('\n').split('\t', 5)
+        if len(fields) == 6 and line.endswith('\n'):
+          Sums.copies[filename][copy_key(fields[5], int(fields[2]))] = (fields[3], fields[4])
+      if lines:
+        lines.close()
+    recorded = Sums.copies[filename].get(copy_key(msg_id, size or 0))
+  finally:
+    Sums.lock.release()
+  if recorded is None:
+    return False
+  sums.record(uid, size, recorded[0], recorded[1], msg_id)
+  return True
+
+def download_messages(server, store, sums, messages, config, countlocal, countremote, countnew):
+  """Download messages from folder and add them to its store, recording them in sums
+
+  Messages are downloaded in config['order'] as long as they fit in the
+  budget of config['throttle'], the store being checkpointed along the way.
+  Returns (bytes downloaded, biggest message, bytes of messages copied from
+  other folders instead of being downloaded, {msg_id: (num, uid, size)} of
+  the messages left for a later run)."""
 
   # the folder has already been selected by scanFolder()
-  # nothing to do
-  if not countnew:
-    mbox.close()
-    return 0, 0
-  
-#x  spinner = Spinner("   Downloading %s new messages to %s" % (countnew, filename))
-  total = biggest = 0
- 
-  # each new message
-  for msg_id in messages.keys():
+  # nothing to do (and no empty gzip member to add)
+  if not messages and not config['overwrite']:
+    return 0, 0, 0, {}
+
+  total = biggest = saved = 0
+  throttle = config['throttle']
+  checkpoints = Checkpoints()
+  metrics = server.metrics
+  metrics.start('disk write')
+  store.open()
+  sums.open(config['overwrite'])
+  metrics.stop()
+  metrics.start('fetch')
+  try:
+    # address messages by UID when the server gave us one, by number otherwise
+    use_uid = None not in [uid for num, uid, size in messages.values()]
+    wanted = {}
+    for msg_id, (num, uid, size) in messages.items():
+      # copies of messages already stored for other folders aren't downloaded
+      if store.reuse(msg_id, size, sums, uid):
+        saved += size or 0
+      else:
+        wanted[use_uid and uid or num] = (msg_id, size)
+
+    def stream(num, attrs):
+      """Starts writing a message as soon as it is known which one it is"""
+      key = use_uid and attrs.get('UID') or num
+      if key not in wanted:
+        return None
+      return TimedWriter(store.start(*wanted[key]), metrics)
+
+    keys, later = schedule_downloads(wanted, config['order'], throttle)
+    left = {}
+    for key in later:
+      msg_id, size = wanted.pop(key)
+      left[msg_id] = messages[msg_id]
+      throttle.leave(size or 0)
+
+    # fetch many new messages per command, write each one as it arrives
+    batches = make_fetch_batches(dict([(key, wanted[key][1]) for key in wanted]),
+                                 config['inflight'], FETCH_PIPELINE, keys)
+    for num, attrs in fetch_pipelined(server, batches, DOWNLOAD_ITEMS, use_uid,
+                                      stream=stream, throttle=throttle):
+      key = use_uid and attrs.get('UID') or num
+      if key not in wanted or 'BODY' not in attrs:
+        continue
+      msg_id, size = wanted.pop(key)
+      metrics.start('disk write')
+      writer = attrs['BODY']
+      if isinstance(writer, str):
+        # the UID came after the message, which had to be read in memory
+        writer = store.start(msg_id, size)
+        writer.write(attrs['BODY'])
+      else:
+        writer = writer.writer
+      stored = store.finish(writer)
+      sums.add(messages[msg_id][1], size, attrs.get('INTERNALDATE'), writer, msg_id)
+      biggest = max(stored, biggest)
+      total += stored
+      metrics.add('downloaded_messages')
+      if checkpoints.due(stored):
+        store.checkpoint()
+        sums.checkpoint()
+      metrics.stop()
+  finally:
+    metrics.start('disk write')
+    try:
+      store.close()
+    finally:
+      sums.close()
+    metrics.stop()
+    metrics.stop()
+  return total, biggest, saved, left
+
+def scan_mbox(mbox):
+  """Splits an open mbox into messages, yields (offset, length, headers) for each
+
+  headers are the raw header lines of the message, as rfc822 would read them."""
+  start = headers = None
+  in_headers = False
+  offset = 0
+  for line in mbox:
+    if line.startswith('From '):
+      if start is not None:
+        yield start, offset - start, headers
+      start = offset
+      headers = []
+      in_headers = True
+    elif in_headers:
+      if line in ('\n', '\r\n') or not (':' in line or line[:1] in ' \t'):
+        # end of headers: blank line, or a line which isn't a header
+        in_headers = False
+      else:
+        headers.append(line)
+    offset += len(line)
+  if start is not None:
+    yield start, offset - start, headers
+
+def scan_mbox_mmap(filename, start=0):
+  """Same as scan_mbox() for a plain mbox file, without reading message bodies
+
+  The file is memory mapped, messages separators and the end of each header
+  block are found with plain bytes searches, and only header blocks are split
+  into lines.  Scanning begins at offset start, which must begin a line."""
+  mboxfile = open(filename, 'rb')
+  try:
+    size = os.fstat(mboxfile.fileno()).st_size
+    if not size:
+      return
+    data = mmap.mmap(mboxfile.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    mboxfile.close()
+  if start >= size:
+    data.close()
+    return
+
+  try:
+    if data[start:start+5] != 'From ':
+      start = data.find('\nFrom ', start) + 1 or None
+    while start is not None:
+      end = data.find('\nFrom ', start) + 1 or size
+      # headers start after the "From " line, end at the first blank line
+      head = data.find('\n', start, end) + 1 or end
+      blank = data.find('\n\n', head-1, end)
+      if blank == -1:
+        blank = end - 1
+      # CRLF mboxes, only looked for in the headers found so far
+      crlf = data.find('\n\r\n', head-1, blank+2)
+      if crlf != -1:
+        blank = min(blank, crlf)
+      block = data[head:blank+1]
+      lines = block.split('\n')
+      lines = [line + '\n' for line in lines[:-1]] + [line for line in lines[-1:] if line]
+      headers = []
+      for line in lines:
+        if line in ('\n', '\r\n') or not (':' in line or line[:1] in ' \t'):
+          # end of headers: blank line, or a line which isn't a header
+          break
+        headers.append(line)
+      yield start, end - start, headers
+      if end == size:
+        break
+      start = end
+  finally:
+    data.close()
+
+def find_message_id(headers):
+  """Gets the Message-Id out of raw header lines, returns None if there is none"""
+  lines = []
+  for line in headers or []:
+    if lines:
+      # continuation lines of a folded header start with blanks
+      if not line[:1].isspace():
+        break
+      lines.append(line)
+    elif line[:max(line.find(':'), 0)].lower() == 'message-id':
+      lines.append(line)
+  if not lines:
+    return None
+  return parse_message_id(''.join(lines))
+
+def reindex_file(filename, compress, index):
+  """Rebuilds the index of a mbox file from its contents
+
+  When the mbox was only appended to since the index was last in sync with it,
+  only the new part of the mbox is read (and decompressed)."""
+  entries, members = index.entries, index.members
+  start = offset = 0
+  if index.size and index.size < os.path.getsize(filename) and \
+     compress != 'bzip2' and mbox_appended(filename, compress, index):
+    start, offset = index.size, index.end
+  else:
+    entries, members = [], []
+
+  # open the file
+  mbox = None
+  if compress != 'none':
+    mbox = open_mbox_for_reading(filename, compress, start)
+
+  index.open(rebuild=True)
+  try:
+    for position, member_offset in members:
+      index.add_member(position, member_offset)
+    if compress != 'none' and start:
+      index.add_member(start, offset)
+    for entry in entries:
+      index.add(*entry)
+
+    if mbox is None:
+      messages = scan_mbox_mmap(filename, start)
+    else:
+      messages = scan_mbox(mbox)
+
+    # each message
+    i = len(entries)
+    for message_offset, length, headers in messages:
+      msg_id = find_message_id(headers)
+      if msg_id is None and config_message_id_warning:
+        debugprint("")
+        if MSGID_HEADER_RE.search(''.join(headers or [])):
+          # Message-Id was found but could somehow not be parsed by regexp
+          # (highly bloody unlikely)
+          debugprint("WARNING: Message #%d in %s %s" % (i, filename, "has a malformed Message-Id header."))
+        else:
+          # No message ID was found. Warn the user and move on
+          debugprint("WARNING: Message #%d in %s %s" % (i, filename, "has no Message-Id header."))
+      if mbox is not None:
+        message_offset += offset
+      index.add(message_offset, length, msg_id or '')
+      i = i + 1
+  finally:
+    # done
+    if mbox is not None:
+      mbox.close()
+    index.close()
+
+def mbox_appended(filename, compress, index):
+  """Tells whether the part of the mbox known to its index is still in place
+
+  The data past the size recorded in the index must start with a message, and
+  for plain mboxes the last indexed message must still be where it was."""
+  try:
+    mbox = open_mbox_for_reading(filename, compress, index.size)
+    try:
+      if mbox.read(5) != 'From ':
+        return False
+      if compress == 'none' and index.entries:
+        mbox.seek(index.entries[-1][0])
+        return mbox.read(5) == 'From '
+      return True
+    finally:
+      mbox.close()
+  except (IOError, EOFError):
+    return False
+
+def unique_name():
+  """Returns a file name no other message stored on this host will get"""
+  now = time.time()
+  return "%d.M%dP%dQ%d.%s" % (now, (now % 1) * 1000000, os.getpid(),
+                              UNIQUE_COUNTER.next(), HOSTNAME)
+
+def read_headers(filename):
+  """Returns the header lines of a message file"""
+  headers = []
+  message = open(filename, 'rb')
+  try:
+    for line in message:
+      if not line.strip():
+        break
+      headers.append(line)
+  finally:
+    message.close()
+  return headers
+
+def id_hash(msg_id):
+  """64-bit hash of a Message-Id"""
+  return struct.unpack('<Q', sha.new(msg_id).digest()[:8])[0]
+
+# an array of 64-bit hashes takes 8 bytes a message, where longs have 64 bits
+if array.array('L').itemsize == 8:
+  hash_array = lambda hashes: array.array('L', hashes)
+else:
+  hash_array = list
+
+class IdSet:
+  """A set of Message-Ids, kept as their sorted 64-bit hashes
+
+  Ids sharing a hash are also kept whole in collisions, to tell them apart.
+  An id of the server with the hash of a different local one would be taken
+  for it: for a million ids on each side, one chance in 18 million."""
+
+  def __init__(self, ids=()):
+    """IdSet constructor"""
+    pairs = sorted(set([(id_hash(msg_id), msg_id) for msg_id in ids]))
+    hashes = []
+    self.collisions = {} # hash: set of ids
+    for i in range(len(pairs)):
+      if hashes and hashes[-1] == pairs[i][0]:
+        self.collisions.setdefault(pairs[i][0], set([pairs[i-1][1]])).add(pairs[i][1])
+      else:
+        hashes.append(pairs[i][0])
+    self.hashes = hash_array(hashes)
+    self.count = len(pairs)
+
+  def __contains__(self, msg_id):
+    digest = id_hash(msg_id)
+    if digest in self.collisions:
+      return msg_id in self.collisions[digest]
+    i = bisect.bisect_left(self.hashes, digest)
+    return i < len(self.hashes) and self.hashes[i] == digest
+
+  def __len__(self):
+    return self.count
+
+  def __getstate__(self):
+    # sent back by the processes of LocalScans, 8 bytes a hash
+    hashes = list(self.hashes)
+    return (struct.pack('<%dQ' % len(hashes), *hashes), self.collisions, self.count)
+
+  def __setstate__(self, state):
+    packed, self.collisions, self.count = state
+    self.hashes = hash_array(struct.unpack('<%dQ' % (len(packed) / 8), packed))
+
+  def missing(self, ids):
+    """The ids not in the set, their sorted hashes merged with those of the set"""
+    missing = []
+    i = 0
+    for digest, msg_id in sorted([(id_hash(msg_id), msg_id) for msg_id in ids]):
+      # the hashes of the set only ever looked at forward
+      i = bisect.bisect_left(self.hashes, digest, i)
+      if i == len(self.hashes) or self.hashes[i] != digest:
+        missing.append(msg_id)
+      elif digest in self.collisions and msg_id not in self.collisions[digest]:
+        missing.append(msg_id)
+    return missing
+
+def count_ids(ids):
+  """Returns (IdSet, number of messages without a Message-Id) for scan()"""
+  miwarnings = 0
+  for msg_id in ids:
+    if not msg_id:
+      miwarnings = miwarnings + 1
+  return IdSet([msg_id for msg_id in ids if msg_id]), miwarnings
+
+def mbox_compression(filename):
+  """Compression of a mbox file, going by its name"""
+  for compress, suffix in (('gzip', '.gz'), ('bzip2', '.bz2'), ('zstd', '.zst')):
+    if filename.endswith(suffix):
+      return compress
+  return 'none'
+
+def copy_key(msg_id, size):
+  """64-bit hash a message is looked for in LocalCopies by"""
+  return id_hash('%s\t%d' % (msg_id, size))
+
+class LocalCopies:
+  """Where the messages of the indexed mbox files are, by Message-Id and RFC822.SIZE
+
+  Each mbox added is kept as arrays sorted by copy_key(), of the offset,
+  length and gzip member or zstd frame of its messages, some 32 bytes a
+  message rather than their whole Message-Ids.  Messages are found with
+  one bisection per mbox added, those added last first.  Those of bzip2
+  mboxes, which can only be read from their beginning, aren't added."""
+
+  def __init__(self):
+    """LocalCopies constructor"""
+    self.mboxes = [] # (filename, compress, members, keys, offsets, lengths, member indexes)
+
+  def add(self, filename, compress, entries, members):
+    """Adds indexed messages of a mbox, members being the gzip members or zstd frames they are in"""
+    if compress == 'bzip2':
+      return
+    starts = [offset for position, offset in members]
+    rows = []
+    for offset, length, msg_id, size in entries:
+      if not msg_id or size is None:
+        continue
+      member = 0
+      if compress != 'none':
+        member = max(bisect.bisect_right(starts, offset) - 1, 0)
+      rows.append((copy_key(msg_id, size), offset, length, member))
+    if not rows:
+      return
+    rows.sort()
+    columns = [hash_array([row[i] for row in rows]) for i in range(4)]
+    self.mboxes.append((filename, compress, list(members)) + tuple(columns))
+
+  def forget(self, filename):
+    """Drops the messages of a mbox, before its index is added again"""
+    self.mboxes = [mbox for mbox in self.mboxes if mbox[0] != filename]
+
+  def find(self, msg_id, size):
+    """Returns (filename, compress, member, offset, length) of a message, None if not found"""
+    key = copy_key(msg_id, size)
+    for filename, compress, members, keys, offsets, lengths, indexes in reversed(self.mboxes):
+      i = bisect.bisect_left(keys, key)
+      if i < len(keys) and keys[i] == key:
+        member = (0, 0)
+        if compress != 'none':
+          member = members[indexes[i]]
+        return filename, compress, member, offsets[i], lengths[i]
+    return None
+
+def find_local_copy(msg_id, size):
+  """Looks for a message in the mbox files of the current directory
+
+  Returns (filename, compress, member, offset, length), None if no indexed
+  mbox has a message with that Message-Id and RFC822.SIZE.  The index of all
+  mboxes is read the first time it is needed, that of a mbox LocalScans was
+  rescanning again once its scan is done, see refresh_local_copies()."""
+  global LOCAL_COPIES
+  LOCAL_COPIES_LOCK.acquire()
+  try:
+    if LOCAL_COPIES is None:
+      LOCAL_COPIES = LocalCopies()
+      for idxname in glob.glob('*.idx'):
+        index = MboxIndex(idxname[:-len('.idx')])
+        if index.load():
+          LOCAL_COPIES.add(index.mboxname, mbox_compression(index.mboxname),
+                           index.entries, index.members)
+    return LOCAL_COPIES.find(msg_id, size)
+  finally:
+    LOCAL_COPIES_LOCK.release()
+
+def refresh_local_copies(filename):
+  """Reads the index of a mbox into LOCAL_COPIES again, once a scan rewrote it"""
+  LOCAL_COPIES_LOCK.acquire()
+  try:
+    if LOCAL_COPIES is None:
+      # read once its scan is done
+      return
+    LOCAL_COPIES.forget(filename)
+    index = MboxIndex(filename)
+    if index.load():
+      LOCAL_COPIES.add(filename, mbox_compression(filename), index.entries, index.members)
+  finally:
+    LOCAL_COPIES_LOCK.release()
+
+def read_local_copy(copy, msg_id):
+  """Reads a message found by find_local_copy(), returns None if it isn't there"""
+  filename, compress, (position, member_offset), offset, length = copy
+  try:
+    mbox = open_mbox_for_reading(filename, compress, position)
+    try:
+      if compress == 'none':
+        mbox.seek(offset)
+      else:
+        # data is read from the start of its gzip member or zstd frame
+        skip = offset - member_offset
+        while skip > 0:
+          data = mbox.read(min(skip, READ_CHUNK))
+          if not data:
+            return None
+          skip -= len(data)
+      text = mbox.read(length)
+    finally:
+      mbox.close()
+  except (IOError, EOFError):
+    return None
+
+  # the index may be stale: check it is the right message
+  if len(text) != length or not text.startswith('From '):
+    return None
+  headers = text[:text.find('\n\n') + 1].splitlines(True)[1:]
+  if find_message_id(headers) != msg_id:
+    return None
+  return text
+
+class MboxStore:
+  """Stores a folder in a mbox file, plain or compressed, along with its index
+
+  All stores have the same methods: signature() to tell whether the files
+  changed since a state was saved, scan() to get the Message-Ids of the
+  messages already stored, and open(), then start() and finish() for each new
+  message and close() to store new messages, start() returning the
+  MessageWriter the message is written to as it is downloaded.  Between
+  open() and close(), reuse() stores a message without downloading it when
+  the store has a copy of it, and checkpoint() flushes the messages stored so
+  far to disk, for a killed run to be resumed from there."""
+
+  def __init__(self, filename, config):
+    """MboxStore constructor"""
+    self.filename = filename
+    self.compress = config['compress']
+    self.overwrite = config['overwrite']
+    self.index = MboxIndex(filename)
+    self.mbox = None
+    self.writer = None
+    self.message = None
+    self.added = 0
+    self.first_member = 0
+
+  def signature(self):
+    """Returns what the files look like, None if there are none"""
+    return mbox_signature(self.filename)
+
+  def scan(self):
+    """Gets IDs of messages in the mbox file, returns (IdSet of their IDs, warnings)"""
+    # file will be overwritten
+    if self.overwrite:
+      return IdSet(), 0
+    else:
+      assert('bzip2' != self.compress)
+
+    # file doesn't exist
+    if not os.path.exists(self.filename):
+      debugprint("File %s: not found" % (self.filename))
+      return IdSet(), 0
+
+    # read the ids from the index, unless the mbox changed behind its back
+    if not self.index.load() and not self.recover():
+      reindex_file(self.filename, self.compress, self.index)
+    return count_ids([entry[2] for entry in self.index.entries])
+
+  def open(self):
+    """Opens the mbox for appending, after deleting it when overwriting"""
+    if self.overwrite:
+      if os.path.exists(self.filename):
+        if config_messahe_info_overwrite:
+          report("   Deleting %s" % (self.filename))
+        os.remove(self.filename)
+    else:
+      assert('bzip2' != self.compress)
+      # find out where new messages go, reindexing the mbox if it changed
+      if os.path.exists(self.filename) and not self.index.check():
+        if not self.index.load() and not self.recover():
+          reindex_file(self.filename, self.compress, self.index)
+        self.index.check()
+
+    # compressed data of this run goes in a member of its own
+    position = (mbox_signature(self.filename) or [0])[0]
+    self.mbox = open_mbox_for_append(self.filename, self.compress)
+    self.index.open(rebuild=self.overwrite or not self.index.end)
+    # what a killed run leaves is cut back to here, see recover()
+    self.index.checkpoint()
+    self.added = len(self.index.entries)
+    self.first_member = len(self.index.members)
+    if self.compress != 'none':
+      self.index.add_member(position, self.index.end)
+
+  def recover(self):
+    """Cuts what a killed run left past its last checkpoint, returns False if it can't
+
+    Called when load() found the index out of sync with the mbox.  Only done
+    when the index is torn and the mbox was only appended to since its last
+    S line, the data there starting like a message, a gzip member or a zstd
+    frame does.  The messages of the killed run stored before its last
+    checkpoint stay, the others will be downloaded again."""
+    if not (self.index.synced and self.index.torn) or self.compress == 'bzip2':
+      return False
+    try:
+      mbox = open(self.filename, 'r+b')
+    except IOError:
+      return False
+    try:
+      mbox.seek(0, 2)
+      size = mbox.tell()
+      if size < self.index.size:
+        return False
+      mbox.seek(self.index.size)
+      if size > self.index.size and not mbox.read(5).startswith(MEMBER_MAGIC[self.compress]):
+        return False
+      if size > self.index.size:
+        debugprint("File %s: cutting the %d bytes past the last checkpoint" %
+                   (self.filename, size - self.index.size))
+        mbox.truncate(self.index.size)
+    finally:
+      mbox.close()
+
+    self.index.rewrite(self.index.entries, self.index.members, self.index.end)
+    self.index.close()
+    return self.index.load()
+
+  def checkpoint(self):
+    """Flushes the messages stored so far to disk, for recover() to start from"""
+    if self.compress == 'bzip2':
+      return
+    if self.compress == 'none':
+      sync_file(self.mbox)
+    else:
+      # the member ends here, the next messages go in a new one
+      self.mbox.close()
+      self.mbox = None
+      mbox = open(self.filename, 'ab')
+      try:
+        os.fsync(mbox.fileno())
+      finally:
+        mbox.close()
+      position = mbox_signature(self.filename)[0]
+      self.mbox = open_mbox_for_append(self.filename, self.compress)
+      self.index.add_member(position, self.index.end)
+    self.index.checkpoint()
+
+  def reuse(self, msg_id, size, sums, uid):
+    """Stores a copy of a message found elsewhere, recording it in sums, returns False if there is none"""
+    # a message moved from another folder is copied from its mbox
+    copy = find_local_copy(msg_id, size)
+    if copy is None or copy[0] == self.filename:
+      return False
+    text = read_local_copy(copy, msg_id)
+    if text is None:
+      return False
+    self.mbox.write(text)
+    self.index.add(self.index.end, len(text), msg_id, size)
+    record_copy(sums, uid, copy[0], msg_id, size)
+    return True
+
+  def start(self, msg_id, size):
+    """Starts storing a downloaded message, returns a MessageWriter to write it to"""
+    self.writer = MessageWriter(self.mbox, quote=True)
+    self.message = (msg_id, size)
+
     # This "From" and the terminating newline below delimit messages
     # in mbox files
 
     # Mutt expects the first line of each message to have a particular format :
     # From [ <return-path> ] <weekday> <month> <day> <time> [ <timezone> ] <year>
     # Sample: From - Fri Nov 22 15:01:23 2013
-    buf = "From - %s\n" % time.strftime('%a %b %d %H:%M:%S %Y') 
+    self.writer.emit("From - %s\n" % time.strftime('%a %b %d %H:%M:%S %Y'))
     # If this is one of our synthesised Message-IDs, insert it before
     # the other headers
     if UUID in msg_id:
-      buf = buf + "Message-Id: %s\n" % msg_id
-    mbox.write(buf)
-
-    # fetch message
-    typ, data = server.fetch(messages[msg_id], "RFC822")
-    assert('OK' == typ)
-    text = data[0][1].strip().replace('\r','')
-    mbox.write(text)
-    mbox.write('\n\n')
-    
-    size = len(text)
-    biggest = max(size, biggest)
-    total += size
-    
-    del data
-    gc.collect()
-#x    spinner.spin()
-  
-  mbox.close()
-#x  spinner.stop()
-  return total, biggest
+      self.writer.emit("Message-Id: %s\n" % msg_id)
+    return self.writer
+
+  def finish(self, writer):
+    """Ends storing a downloaded message, returns its size"""
+    writer.finish('\n\n')
+    msg_id, size = self.message
+    self.index.add(self.index.end, writer.length, msg_id, size)
+    self.writer = None
+    return writer.size
+
+  def drop_member(self):
+    """Cuts the gzip member or zstd frame being written from the mbox, and its messages
+
+    A compressed message can't be cut where it started, so the messages of
+    the member, stored since the last checkpoint, go with it, to be
+    downloaded again as after a killed run, see recover()."""
+    self.mbox.close()
+    self.mbox = None
+    position, offset = self.index.members[-1]
+    mbox = open(self.filename, 'r+b')
+    try:
+      mbox.truncate(position)
+    finally:
+      mbox.close()
+    debugprint("File %s: dropping a partial message and the %d stored since the last checkpoint" %
+               (self.filename, len([entry for entry in self.index.entries if entry[0] >= offset])))
+    self.index.file.close()
+    self.index.rewrite([entry for entry in self.index.entries if entry[0] < offset],
+                       self.index.members[:-1], offset)
+
+  def close(self):
+    """Closes the mbox and its index"""
+    if self.writer is not None:
+      # the download of a message failed half way
+      if self.compress == 'none':
+        self.mbox.flush()
+        self.mbox.truncate(self.index.end)
+      else:
+        self.drop_member()
+      self.writer = None
+    if self.mbox is not None:
+      self.mbox.close()
+    self.index.close()
+    # messages of other folders may now be copied from this one
+    LOCAL_COPIES_LOCK.acquire()
+    try:
+      if LOCAL_COPIES is not None:
+        LOCAL_COPIES.add(self.filename, self.compress, self.index.entries[self.added:],
+                         self.index.members[self.first_member:])
+    finally:
+      LOCAL_COPIES_LOCK.release()
+
+class MaildirStore:
+  """Stores a folder in a Maildir, a file per message
+
+  FOLDER.maildir/.ids lists the "name<tab>Message-Id" of the messages stored,
+  name being the file name in cur/ up to the ":2,FLAGS" mail readers change.
+  Only the messages it doesn't list are read by scan()."""
+
+  def __init__(self, filename, config):
+    """MaildirStore constructor"""
+    self.filename = filename
+    self.overwrite = config['overwrite']
+    self.manifest = os.path.join(filename, '.ids')
+    self.file = None
+    self.writer = None
+    self.message = None
+
+  def signature(self):
+    """Returns what the files look like, None if there are none"""
+    manifest = mbox_signature(self.manifest)
+    cur = mbox_signature(os.path.join(self.filename, 'cur'))
+    if manifest is None or cur is None:
+      return None
+    return [manifest[0], cur[1]]
+
+  def list_files(self):
+    """Returns {name: path} of the message files in new/ and cur/"""
+    files = {}
+    for subdir in ('new', 'cur'):
+      try:
+        names = os.listdir(os.path.join(self.filename, subdir))
+      except OSError:
+        continue
+      for name in names:
+        if not name.startswith('.'):
+          files[name.split(':')[0]] = os.path.join(self.filename, subdir, name)
+    return files
+
+  def read_manifest(self):
+    """Returns the {name: msg_id} listed in the .ids file"""
+    known = {}
+    try:
+      manifest = open(self.manifest, 'rb')
+    except IOError:
+      return known
+    try:
+      for line in manifest:
+        # the last line may have been cut by a killed run
+        fields = line.rstrip('\n').split('\t', 1)
+        if len(fields) == 2 and line.endswith('\n'):
+          known[fields[0]] = fields[1]
+    finally:
+      manifest.close()
+    return known
+
+  def scan(self):
+    """Gets IDs of messages in the Maildir, returns (IdSet of their IDs, warnings)"""
+    if self.overwrite:
+      return IdSet(), 0
+    if not os.path.isdir(self.filename):
+      debugprint("Maildir %s: not found" % (self.filename))
+      return IdSet(), 0
+
+    known = self.read_manifest()
+    files = self.list_files()
+    names = {}
+    for name, path in files.items():
+      if name in known:
+        names[name] = known[name]
+      else:
+        names[name] = find_message_id(read_headers(path)) or ''
+
+    # rewrite the list when messages were added or removed behind its back
+    if names != known:
+      tmpname = self.manifest + '.tmp'
+      manifest = open(tmpname, 'wb')
+      try:
+        for name in sorted(names.keys()):
+          manifest.write("%s\t%s\n" % (name, names[name]))
+      finally:
+        manifest.close()
+      os.rename(tmpname, self.manifest)
+    return count_ids(names.values())
+
+  def open(self):
+    """Creates the Maildir if needed, after emptying it when overwriting"""
+    if self.overwrite and os.path.isdir(self.filename):
+      if config_messahe_info_overwrite:
+        report("   Deleting %s" % (self.filename))
+      for path in self.list_files().values():
+        os.remove(path)
+    for subdir in ('tmp', 'new', 'cur'):
+      if not os.path.isdir(os.path.join(self.filename, subdir)):
+        os.makedirs(os.path.join(self.filename, subdir))
+    self.file = open(self.manifest, self.overwrite and 'wb' or 'ab')
+
+  def reuse(self, msg_id, size, sums, uid):
+    """Stores a copy of a message found elsewhere, recording it in sums, returns False if there is none"""
+    return False
+
+  def start(self, msg_id, size):
+    """Starts storing a downloaded message, returns a MessageWriter to write it to"""
+    name = unique_name()
+    self.message = (msg_id, name, open(os.path.join(self.filename, 'tmp', name), 'wb'))
+    self.writer = MessageWriter(self.message[2])
+    # If this is one of our synthesised Message-IDs, insert it before
+    # the other headers
+    if UUID in msg_id:
+      self.writer.emit("Message-Id: %s\n" % msg_id)
+    return self.writer
+
+  def finish(self, writer):
+    """Ends storing a downloaded message, returns its size"""
+    msg_id, name, message = self.message
+    writer.finish('\n')
+    message.close()
+    os.rename(os.path.join(self.filename, 'tmp', name),
+              os.path.join(self.filename, 'cur', name + ':2,'))
+    self.file.write("%s\t%s\n" % (name, msg_id))
+    self.writer = self.message = None
+    return writer.size
+
+  def checkpoint(self):
+    """Flushes the .ids file to disk, the messages being in files of their own"""
+    sync_file(self.file)
+
+  def close(self):
+    """Closes the .ids file"""
+    if self.writer is not None:
+      # the download of a message failed half way
+      msg_id, name, message = self.message
+      message.close()
+      os.remove(os.path.join(self.filename, 'tmp', name))
+      self.writer = self.message = None
+    self.file.close()
+    self.file = None
+
+class ContentStore:
+  """Stores a folder as a list of messages kept once for all folders
+
+  Messages are objects/XX/XXX... files named after the SHA-1 of their text.
+  FOLDER.manifest lists the "hash<tab>Message-Id" of the messages of the
+  folder, and objects/ids the "Message-Id<tab>hash<tab>size<tab>manifest" of
+  every message stored, size being its RFC822.SIZE, so that a message also
+  in another folder, or moved to another folder, is neither downloaded nor
+  stored again, and is recorded as the .sums of that manifest has it."""
+
+  # {(msg_id, size): (hash, manifest)} of objects/ids, shared by the stores of all folders
+  known = None
+  ids_file = None
+  lock = threading.Lock()
+
+  def __init__(self, filename, config):
+    """ContentStore constructor"""
+    self.filename = filename
+    self.overwrite = config['overwrite']
+    self.file = None
+    self.writer = None
+    self.message = None
+
+  def signature(self):
+    """Returns what the files look like, None if there are none"""
+    return mbox_signature(self.filename)
+
+  def scan(self):
+    """Gets IDs of messages in the manifest, returns (IdSet of their IDs, warnings)"""
+    if self.overwrite:
+      return IdSet(), 0
+    try:
+      manifest = open(self.filename, 'rb')
+    except IOError:
+      debugprint("File %s: not found" % (self.filename))
+      return IdSet(), 0
+    try:
+      # the last line may have been cut by a killed run
+      ids = [line.rstrip('\n').split('\t', 1)[-1] for line in manifest if line.endswith('\n')]
+    finally:
+      manifest.close()
+    return count_ids(ids)
+
+  def open(self):
+    """Opens the manifest for appending, or for rewriting it when overwriting"""
+    if self.overwrite and os.path.exists(self.filename):
+      if config_messahe_info_overwrite:
+        report("   Deleting %s" % (self.filename))
+      os.remove(self.filename)
+    else:
+      cut_partial_line(self.filename)
+    self.file = open(self.filename, 'ab')
+    try:
+      os.makedirs(CAS_ROOT)
+    except OSError:
+      # already there
+      pass
+    ContentStore.lock.acquire()
+    try:
+      if ContentStore.known is None:
+        ContentStore.known = {}
+        cut_partial_line(CAS_IDS)
+        try:
+          ids = open(CAS_IDS, 'rb')
+        except IOError:
+          ids = []
+        for line in ids:
+          fields = line.rstrip('\n').split('\t', 3)
+          if len(fields) == 3:
+            # written before manifests were
+            fields.append(None)
+          if len(fields) == 4:
+            ContentStore.known[(fields[0], int(fields[2]))] = (fields[1], fields[3])
+        if ids:
+          ids.close()
+    finally:
+      ContentStore.lock.release()
+
+  def object_name(self, digest):
+    """Name of the file of the message whose text hashes to digest"""
+    return os.path.join(CAS_ROOT, digest[:2], digest[2:])
+
+  def reuse(self, msg_id, size, sums, uid):
+    """Stores a copy of a message found elsewhere, recording it in sums, returns False if there is none"""
+    ContentStore.lock.acquire()
+    try:
+      known = ContentStore.known.get((msg_id, size or 0))
+    finally:
+      ContentStore.lock.release()
+    if known is None or known[1] is None or not os.path.exists(self.object_name(known[0])):
+      return False
+    # one stored by a folder still being backed up may not be in its .sums yet
+    if not record_copy(sums, uid, known[1], msg_id, size):
+      return False
+    self.file.write("%s\t%s\n" % (known[0], msg_id))
+    return True
+
+  def start(self, msg_id, size):
+    """Starts storing a downloaded message, returns a MessageWriter to write it to"""
+    # written aside until its hash is known
+    tmpname = os.path.join(CAS_ROOT, unique_name())
+    self.message = (msg_id, size, tmpname, open(tmpname, 'wb'))
+    self.writer = MessageWriter(self.message[3], digest=True)
+    # If this is one of our synthesised Message-IDs, insert it before
+    # the other headers
+    if UUID in msg_id:
+      self.writer.emit("Message-Id: %s\n" % msg_id)
+    return self.writer
+
+  def finish(self, writer):
+    """Ends storing a downloaded message, unless its text was already stored, returns its size"""
+    msg_id, size, tmpname, message = self.message
+    writer.finish('\n')
+    message.close()
+    self.writer = self.message = None
+    digest = writer.digest.hexdigest()
+    filename = self.object_name(digest)
+    if os.path.exists(filename):
+      os.remove(tmpname)
+    else:
+      try:
+        os.makedirs(os.path.dirname(filename))
+      except OSError:
+        # created by another thread, or by a previous run
+        pass
+      os.rename(tmpname, filename)
+    self.file.write("%s\t%s\n" % (digest, msg_id))
+
+    ContentStore.lock.acquire()
+    try:
+      ContentStore.known[(msg_id, size or 0)] = (digest, self.filename)
+      if ContentStore.ids_file is None:
+        ContentStore.ids_file = open(CAS_IDS, 'ab')
+      ContentStore.ids_file.write("%s\t%s\t%d\t%s\n" % (msg_id, digest, size or 0, self.filename))
+    finally:
+      ContentStore.lock.release()
+    return writer.size
+
+  def checkpoint(self):
+    """Flushes the manifest and objects/ids to disk"""
+    sync_file(self.file)
+    ContentStore.lock.acquire()
+    try:
+      if ContentStore.ids_file is not None:
+        sync_file(ContentStore.ids_file)
+    finally:
+      ContentStore.lock.release()
+
+  def close(self):
+    """Closes the manifest, saves the ids of the messages stored so far"""
+    if self.writer is not None:
+      # the download of a message failed half way
+      msg_id, size, tmpname, message = self.message
+      message.close()
+      os.remove(tmpname)
+      self.writer = self.message = None
+    self.file.close()
+    self.file = None
+    ContentStore.lock.acquire()
+    try:
+      if ContentStore.ids_file is not None:
+        ContentStore.ids_file.flush()
+    finally:
+      ContentStore.lock.release()
+
+STORES = {'mbox':MboxStore, 'maildir':MaildirStore, 'cas':ContentStore}
+STORE_SUFFIXES = {'mbox':'.mbox', 'maildir':'.maildir', 'cas':'.manifest'}
+
+def open_store(filename, config):
+  """Returns the store of the configured format for the folder saved in filename"""
+  return STORES[config['store']](filename, config)
+
+def scan_store(filename, config):
+  """Scans the store of a folder in a process of the pool, returns (IdSet, warnings)"""
+  return open_store(filename, config).scan()
+
+class LocalScans:
+  """Scans the stores of folders in a pool of processes, while the server is scanned
+
+  The folders whose store will have to be scanned again are all given to the
+  pool when the run starts, in the order they are backed up in."""
+
+  def __init__(self, config):
+    """LocalScans constructor"""
+    self.processes = config['scanprocesses']
+    self.pool = None
+    self.pending = {} # filename: AsyncResult
+    self.lock = threading.Lock()
+
+  def start(self, names, config):
+    """Starts scanning the stores of the folders without a usable state"""
+    filenames = []
+    for foldername, filename, priority in names:
+      store = open_store(filename, config)
+      if os.path.exists(filename) and not previous_state(store, filename, config):
+        filenames.append(filename)
+    if not filenames or not self.processes:
+      return
+    self.pool = multiprocessing.Pool(min(self.processes, len(filenames)))
+    # only what the stores need, a config being mostly locks and threads
+    options = {'store':config['store'], 'compress':config['compress'],
+               'overwrite':config['overwrite']}
+    for filename in filenames:
+      self.pending[filename] = self.pool.apply_async(scan_store, (filename, options))
+
+  def result(self, store):
+    """What store.scan() returns, from the pool if it scanned the store"""
+    self.lock.acquire()
+    try:
+      pending = self.pending.pop(store.filename, None)
+    finally:
+      self.lock.release()
+    if pending is None:
+      return store.scan()
+    result = pending.get()
+    if isinstance(store, MboxStore):
+      # its index may have been read for local copies while rewritten
+      refresh_local_copies(store.filename)
+    return result
+
+  def close(self):
+    """Stops the pool, scans still running included"""
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
 
-def scan_file(filename, compress, overwrite):
-  """Gets IDs of messages in the specified mbox file"""
-  # file will be overwritten
-  if overwrite:
-    return [], 0
-  else:
-    assert('bzip2' != compress)
+def parse_sequence_set(text):
+  """Parses a sequence set of UIDs, returns a list of (first, last) ranges"""
+  ranges = []
+  for part in text.split(','):
+    bounds = [int(bound) for bound in part.split(':')]
+    ranges.append((min(bounds), max(bounds)))
+  return ranges
 
-  # file doesn't exist
-  if not os.path.exists(filename):
-    debugprint("File %s: not found" % (filename))
-    return [], 0
+def in_sequence_set(ranges, num):
+  """Tells whether num is in the ranges of parse_sequence_set()"""
+  for first, last in ranges:
+    if first <= num <= last:
+      return True
+  return False
 
-#x  spinner = Spinner("   File %s" % (filename))
+def make_sequence_set(nums):
+  """Compresses a sorted list of message numbers into an IMAP set, eg: 1:5,7,9:12"""
+  ranges = []
+  for num in nums:
+    if ranges and ranges[-1][1] + 1 == num:
+      ranges[-1][1] = num
+    else:
+      ranges.append([num, num])
+  return ','.join([(first == last and "%d" % first) or "%d:%d" % (first, last)
+                   for first, last in ranges])
 
-  # open the file
-  if compress == 'gzip':
-    mbox = gzip.GzipFile(filename,'rb')
-  elif compress == 'bzip2':
-    mbox = bz2.BZ2File(filename,'rb')
-  else:
-    mbox = file(filename,'rb')
+def parse_fetch_response(data):
+  """Parses the data returned by a FETCH command, returns {num: {item: value}} dict
+
+  The literal of the (single) body section requested is stored as 'BODY'."""
+  results = {}
+  attrs = None
+  for item in data:
+    if item is None:
+      continue
+    if isinstance(item, tuple):
+      text, literal = item
+    else:
+      text, literal = item, None
+    # a new message starts with its number, the rest continues the current one
+    match = FETCH_START_RE.match(text)
+    if match:
+      attrs = results.setdefault(int(match.group(1)), {})
+      text = text[match.end():]
+    if attrs is None:
+      continue
+    for name, regex, convert in FETCH_ITEMS:
+      match = regex.search(text)
+      if match:
+        attrs[name] = convert(match.group(1))
+    if literal is not None:
+      attrs['BODY'] = literal
+  return results
 
+def parse_message_id(header):
+  """Extracts the Message-Id from a raw header, returns None if there is none"""
+  # remove newlines inside Message-Id (a dumb Exchange trait)
+  header = BLANKS_RE.sub(' ', header.strip())
+  match = MSGID_RE.match(header)
+  if match is None:
+    return None
+  return match.group(1)
+
+def scan_folder(server, foldername, chunk=SCAN_CHUNK, since_uid=None, qresync=None, vanished=None,
+                criteria=None):
+  """Gets IDs of messages in the specified folder, returns id:(num, uid, size) dict
+
+  With since_uid, only the messages whose UID is at least since_uid are scanned.
+  With qresync, see select_folder(), the UID ranges expunged since are added
+  to the vanished list.  With criteria, see search_criteria(), only the
+  messages the server finds with them are scanned."""
   messages = {}
+  server.metrics.start('select')
+  num_msgs = select_folder(server, foldername, qresync, vanished)
+  server.metrics.stop()
 
-  # each message
-  i = 0
-  miwarnings = 0
-  for message in mailbox.PortableUnixMailbox(mbox):
-    header = ''
-    # We assume all messages on disk have message-ids
-    try:
-      header =  ''.join(message.getfirstmatchingheader('message-id'))
-    except KeyError:
-      miwarnings = miwarnings + 1
-      if config_message_id_warning:
-        # No message ID was found. Warn the user and move on
-        debugprint("")
-        debugprint("WARNING: Message #%d in %s %s" % (i, filename, "has no Message-Id header."))
-    
-    header = BLANKS_RE.sub(' ', header.strip())
-    try:
-      msg_id = MSGID_RE.match(header).group(1)
-      if msg_id not in messages.keys():
-        # avoid adding dupes
-        messages[msg_id] = msg_id
-    except AttributeError:
-      miwarnings = miwarnings + 1
-      if config_message_id_warning:
-        # Message-Id was found but could somehow not be parsed by regexp
-        # (highly bloody unlikely)
-        debugprint("")
-        debugprint("WARNING: Message #%d in %s %s" % (i, filename, "has a malformed Message-Id header."))
-      
-#x    spinner.spin()
-    i = i + 1
+  if criteria is not None and num_msgs:
+    # let the server pick the messages
+    typ, data = server.uid('SEARCH', search_keys(criteria, since_uid))
+    if 'OK' != typ:
+      raise SkipFolderException("SEARCH failed: %s" % (data))
+    uids = [int(uid) for uid in ' '.join([line or '' for line in data]).split()]
+    msgsets, use_uid = search_sequence_sets(uids, chunk, since_uid), True
+  else:
+    msgsets, use_uid = scan_sequence_sets(num_msgs, chunk, since_uid), since_uid is not None
+
+  # Retrieve Message-Ids, a whole range of messages per command
+  missing = []
+  for msgset in msgsets:
+    if not use_uid:
+      typ, data = server.fetch(msgset, SCAN_ITEMS)
+    else:
+      typ, data = server.uid('FETCH', msgset, SCAN_ITEMS)
+    if 'OK' != typ:
+      raise SkipFolderException("FETCH %s failed: %s" % (msgset, data))
+    add_scanned_messages(messages, missing, parse_fetch_response(data), since_uid)
+
+  # Some messages may have no Message-Id, so we'll synthesise one
+  # (this usually happens with Sent, Drafts and .Mac news)
+  for first in range(0, len(missing), chunk):
+    batch = dict(missing[first:first+chunk])
+    msgset = make_sequence_set(sorted(batch.keys()))
+    typ, data = server.fetch(msgset, SYNTHESIS_ITEMS)
+    if 'OK' != typ:
+      raise SkipFolderException("FETCH %s failed: %s" % (msgset, data))
+    add_synthesized_ids(messages, batch, parse_fetch_response(data), msgset)
 
   # done
-  mbox.close()
-#x  spinner.stop()
-  #print ": %d messages" % (len(messages.keys()))
-  return messages, miwarnings
+  return messages
 
-def scan_folder(server, foldername):
-  """Gets IDs of messages in the specified folder, returns id:num dict"""
-  messages = {}
-#x  spinner = Spinner("   Folder %s" % (foldername))
-  try:
+def select_folder(server, foldername, qresync=None, vanished=None):
+  """Selects a folder read-only, returns its number of messages
+
+  qresync is (UIDVALIDITY, HIGHESTMODSEQ) of the last run, given when QRESYNC
+  is enabled: the server then tells which UIDs were expunged since, as
+  (first, last) ranges added to the vanished list."""
+  if qresync is None:
     typ, data = server.select(foldername, readonly=True)
     if 'OK' != typ:
       raise SkipFolderException("SELECT failed: %s" % (data))
-    num_msgs = int(data[0])
-    
-    # each message
-    for num in range(1, num_msgs+1):
-      # Retrieve Message-Id
-      typ, data = server.fetch(num, '(BODY[HEADER.FIELDS (MESSAGE-ID)])')
-      if 'OK' != typ:
-        raise SkipFolderException("FETCH %s failed: %s" % (num, data))
-      
-      header = data[0][1].strip()
-      # remove newlines inside Message-Id (a dumb Exchange trait)
-      header = BLANKS_RE.sub(' ', header)
-      try:
-        msg_id = MSGID_RE.match(header).group(1) 
-        if msg_id not in messages.keys():
-          # avoid adding dupes
-          messages[msg_id] = num
-      except (IndexError, AttributeError):
-        # Some messages may have no Message-Id, so we'll synthesise one
-        # (this usually happens with Sent, Drafts and .Mac news)
-        typ, data = server.fetch(num, '(BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT)])')
-        if 'OK' != typ:
-          raise SkipFolderException("FETCH %s failed: %s" % (num, data))
-        header = data[0][1].strip()
-        header = header.replace('\r\n','\t')
-        messages['<' + UUID + '.' + sha.sha(header).hexdigest() + '>'] = num
-#x      spinner.spin()
-  finally:
-#x    spinner.stop()
-    pass
-  
-  # done
-  return messages
+    return int(data[0])
+
+  # like server.select(), which has no room for the QRESYNC parameters
+  server.untagged_responses = {}
+  server.is_readonly = True
+  typ, data = server._simple_command('EXAMINE', foldername, '(QRESYNC (%d %d))' % qresync)
+  if 'OK' != typ:
+    server.state = 'AUTH'
+    raise SkipFolderException("SELECT failed: %s" % (data))
+  server.state = 'SELECTED'
+  for response in server.untagged_responses.pop('VANISHED', []):
+    vanished.extend(parse_sequence_set(response.split()[-1]))
+  return int(server.untagged_responses.get('EXISTS', ['0'])[-1])
+
+def scan_sequence_sets(num_msgs, chunk, since_uid=None):
+  """Message sets to FETCH for scanning a folder of num_msgs messages"""
+  if since_uid is None:
+    return ["%d:%d" % (first, min(first+chunk-1, num_msgs))
+            for first in range(1, num_msgs+1, chunk)]
+  elif num_msgs:
+    return ["%d:*" % (since_uid)]
+  return []
+
+def search_criteria(config):
+  """The UID SEARCH keys matching the messages to back up, None for all of them"""
+  keys = []
+  if config['since'] is not None:
+    keys.append('SINCE %s' % (imap_date(parse_since(config['since']))))
+  if config['larger']:
+    keys.append('LARGER %d' % (config['larger']))
+  if config['smaller']:
+    keys.append('SMALLER %d' % (config['smaller']))
+  if config['skipdeleted']:
+    keys.append('NOT DELETED')
+  if config['search']:
+    keys.append(config['search'])
+  return keys and ' '.join(keys) or None
+
+def filter_key(config):
+  """What picks the messages to back up, as saved in the state of folders
+
+  A --since counting days is kept as given: its date moving every day
+  doesn't change what the state of a folder holds."""
+  options = ['%s=%s' % (name, config[name]) for name in FILTER_OPTIONS
+             if config[name] not in (None, 0, False)]
+  return options and ' '.join(options) or None
+
+def parse_since(value):
+  """Converts a --since value, a number of days or YYYY-MM-DD, into a (year, month, day)"""
+  if value.isdigit():
+    return time.localtime(time.time() - int(value) * 86400)[:3]
+  return time.strptime(value, '%Y-%m-%d')[:3]
+
+def imap_date(date):
+  """Formats a (year, month, day) the way SEARCH wants it, eg. 1-Jan-2018"""
+  year, month, day = date
+  return "%d-%s-%d" % (day, MONTHS[month - 1], year)
+
+def search_keys(criteria, since_uid=None):
+  """The argument of UID SEARCH, for the messages matching criteria from since_uid on"""
+  if since_uid is not None:
+    return '(UID %d:* %s)' % (since_uid, criteria)
+  return '(%s)' % (criteria)
+
+def search_sequence_sets(uids, chunk, since_uid=None):
+  """UID sets to FETCH for scanning the messages found by UID SEARCH"""
+  # "n:*" always matches the last message, even below n
+  uids = sorted([uid for uid in uids if since_uid is None or uid >= since_uid])
+  return [make_sequence_set(uids[first:first+chunk]) for first in range(0, len(uids), chunk)]
+
+def add_scanned_messages(messages, missing, fetched, since_uid=None):
+  """Adds the messages of a parsed SCAN_ITEMS response to messages
+
+  Messages without a Message-Id are appended to missing as (num, attrs)."""
+  for num in sorted(fetched.keys()):
+    attrs = fetched[num]
+    if since_uid is not None and attrs.get('UID', 0) < since_uid:
+      # "n:*" always matches the last message, even below n
+      continue
+    msg_id = parse_message_id(attrs.get('BODY', ''))
+    if msg_id is None:
+      missing.append((num, attrs))
+    elif msg_id not in messages:
+      # avoid adding dupes
+      messages[msg_id] = (num, attrs.get('UID'), attrs.get('RFC822.SIZE'))
+
+def add_synthesized_ids(messages, batch, fetched, msgset):
+  """Adds the messages of batch to messages, under Message-Ids made from
+  their headers in a parsed SYNTHESIS_ITEMS response"""
+  for num in sorted(batch.keys()):
+    if num not in fetched:
+      raise SkipFolderException("FETCH %s failed: no data for message %d" % (msgset, num))
+    header = fetched[num].get('BODY', '').strip()
+    header = header.replace('\r\n','\t')
+    attrs = batch[num]
+    messages['<' + UUID + '.' + sha.sha(header).hexdigest() + '>'] = \
+      (num, attrs.get('UID'), attrs.get('RFC822.SIZE'))
 
 def parse_paren_list(row):
   """Parses the nested list of attributes at the start of a LIST response"""
@@ -376,18 +2727,24 @@ def get_hierarchy_delimiter(server):
   typ, data = server.list('', '')
   assert(typ == 'OK')
   assert(len(data) == 1)
-  lst = parse_list(data[0]) # [attribs, hierarchy delimiter, root name]
+  return parse_hierarchy_delimiter(data[0])
+
+def parse_hierarchy_delimiter(row):
+  """Gets the hierarchy delimiter out of the LIST "" "" response"""
+  lst = parse_list(row) # [attribs, hierarchy delimiter, root name]
   hierarchy_delim = lst[1]
   # NIL if there is no hierarchy
   if 'NIL' == hierarchy_delim:
     hierarchy_delim = '.'
   return hierarchy_delim
 
-def get_names(server, compress):
+def get_names(server, config):
   """Get list of folders, returns [(FolderName,FileName)]"""
 
 #x  spinner = Spinner("   Finding Folders")
   
+  config['metrics'].account.start('list')
+
   # Get hierarchy delimiter
   delim = get_hierarchy_delimiter(server)
 #x  spinner.spin()
@@ -396,38 +2753,111 @@ def get_names(server, compress):
   typ, data = server.list()
   assert(typ == 'OK')
 #x  spinner.spin()
-  
+
+  subscribed = None
+  if config['subscribed']:
+    typ, lsub = server.lsub()
+    assert(typ == 'OK')
+    subscribed = [row for row in lsub if row]
+
+  names = folder_names(data, delim, config, subscribed)
+  config['metrics'].account.stop()
+
+  # done
+#x  spinner.stop()
+  #print ": %s folders" % (len(names))
+  return names
+
+def folder_names(rows, delim, config, subscribed=None):
+  """Parses the LIST of all folders, returns [(FolderName,FileName,Priority)]
+
+  Folders are left out as configured, see skipped_folder(), subscribed
+  being the LSUB rows of the subscribed folders when only those are wanted.
+  The others come in the order they are to be backed up in, see
+  folder_priority()."""
   names = []
+  if subscribed is not None:
+    subscribed = set([parse_list(row)[2] for row in subscribed])
 
   # parse each LIST, find folder name
-  for row in data:
+  for row in rows:
     lst = parse_list(row)
     foldername = lst[2]
-    suffix = {'none':'', 'gzip':'.gz', 'bzip2':'.bz2'}[compress]
-    filename = '.'.join(foldername.split(delim)) + '.mbox' + suffix
-    if foldername.find("[Gmail]/") != -1:
-       print "Ignore([Gmail]): '%s' '%s'" % (foldername, filename)
+    attribs = [attrib.lower() for attrib in lst[0] if isinstance(attrib, str)]
+    if '\\noselect' in attribs or '\\nonexistent' in attribs:
+      # a level of the hierarchy, not a folder
+      continue
+    suffix = {'none':'', 'gzip':'.gz', 'bzip2':'.bz2', 'zstd':'.zst'}[config['compress']]
+    filename = '.'.join(foldername.split(delim)) + STORE_SUFFIXES[config['store']] + suffix
+    reason = skipped_folder(foldername, attribs, config, subscribed)
+    if reason is not None:
+       report("Ignore(%s): '%s' '%s'" % (reason, foldername, filename))
        continue
-    names.append((foldername, filename))
+    # in the order of LIST backwards, within a priority
+    names.append((folder_priority(foldername, attribs, delim), -len(names), foldername, filename))
+  names.sort()
+  return [(foldername, filename, priority) for priority, order, foldername, filename in names]
 
-  # done
-#x  spinner.stop()
-  #print ": %s folders" % (len(names))
-  return names
+def skipped_folder(foldername, attribs, config, subscribed=None):
+  """Tells why a folder isn't to be backed up, None if it is
+
+  attribs are the lowercase attributes LIST gave for it."""
+  if config['include'] and not [regex for regex in config['include'] if regex.search(foldername)]:
+    return "not included"
+  for regex in config['exclude']:
+    if regex.search(foldername):
+      return "excluded: %s" % (regex.pattern)
+  for use in config['skipspecial']:
+    if use.lower() in attribs:
+      return use
+  if subscribed is not None and foldername not in subscribed and foldername.upper() != 'INBOX':
+    return "not subscribed"
+  return None
+
+def folder_priority(foldername, attribs, delim):
+  """Rank of a folder in the order folders are backed up in, lowest first
+
+  INBOX comes first, then the other folders, then Junk and Trash, known by
+  their SPECIAL-USE attribute (RFC 6154) or, without one, by their name."""
+  leaf = foldername.split(delim)[-1].lower()
+  if foldername.upper() == 'INBOX':
+    return 0
+  elif '\\trash' in attribs or leaf in TRASH_NAMES:
+    return 3
+  elif '\\junk' in attribs or leaf in JUNK_NAMES:
+    return 2
+  return 1
 
 def process_cline():
   """Uses getopt to process command line, returns (config, warnings, errors)"""
   # read command line
   try:
-    short_args = "aynzbek:c:s:u:p:"
+    short_args = "aynzbek:c:s:u:p:j:"
     long_args = ["append-to-mboxes", "yes-overwrite-mboxes", "compress=",
-                 "ssl", "keyfile=", "certfile=", "server=", "user=", "pass="]
+                 "ssl", "keyfile=", "certfile=", "server=", "user=", "pass=",
+                 "scan-chunk=", "inflight=", "full-scan",
+                 "jobs=", "store=", "order=", "max-rate=", "budget=",
+                 "since=", "larger=", "smaller=", "skip-deleted", "search=",
+                 "include=", "exclude=", "subscribed", "skip-special=",
+                 "metrics=", "prometheus=", "profile=", "scan-processes=",
+                 "verify", "verify-sample=", "verify-time=", "reconnects=", "timeout=",
+                 "no-deflate", "rcvbuf=", "read-chunk=", "plan",
+                 "quota=", "quota-warning=", "disk-reserve="]
     opts, extraargs = getopt.getopt(sys.argv[1:], short_args, long_args)
   except getopt.GetoptError:
     print_usage()
   
   warnings = []
-  config = {'compress':'none', 'overwrite':False, 'usessl':False}
+  config = {'compress':'none', 'overwrite':False, 'usessl':False,
+            'scanchunk':SCAN_CHUNK, 'inflight':FETCH_INFLIGHT, 'fullscan':False,
+            'jobs':1, 'store':'mbox', 'order':'oldest', 'maxrate':0, 'budget':0,
+            'since':None, 'larger':0, 'smaller':0, 'skipdeleted':False, 'search':None,
+            'include':[], 'exclude':None, 'subscribed':False, 'skipspecial':SKIP_SPECIAL,
+            'metricsfile':None, 'prometheusfile':None, 'profile':None,
+            'scanprocesses':multiprocessing.cpu_count(), 'verify':False,
+            'verifysample':VERIFY_SAMPLE, 'verifytime':VERIFY_TIME, 'reconnects':RECONNECTS,
+            'timeout':TIMEOUT, 'deflate':True, 'rcvbuf':0, 'readchunk':LITERAL_CHUNK, 'plan':False,
+            'quota':0, 'quotawarning':QUOTA_WARNING, 'diskreserve':DISK_RESERVE}
   errors = []
 
   # empty command line
@@ -448,7 +2878,7 @@ def process_cline():
     elif option == "-b":
       config['compress'] = 'bzip2'
     elif option == "--compress":
-      if value in ('none', 'gzip', 'bzip2'):
+      if value in ('none', 'gzip', 'bzip2', 'zstd'):
         config['compress'] = value
       else:
         errors.append("Invalid compression type specified.")
@@ -464,9 +2894,163 @@ def process_cline():
       config['user'] = value
     elif option in ("-p", "--pass"):
       config['pass'] = value
+    elif option == "--scan-chunk":
+      try:
+        config['scanchunk'] = int(value)
+        if config['scanchunk'] < 1:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid scan chunk.  Must be a positive integer.")
+    elif option == "--inflight":
+      try:
+        config['inflight'] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid in-flight budget.  Must be a byte count, eg. 16M.")
+    elif option == "--full-scan":
+      config['fullscan'] = True
+    elif option in ("-j", "--jobs"):
+      try:
+        config['jobs'] = int(value)
+        if config['jobs'] < 1:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid number of jobs.  Must be a positive integer.")
+    elif option == "--store":
+      if value in STORES:
+        config['store'] = value
+      else:
+        errors.append("Invalid store format specified.")
+    elif option == "--order":
+      if value in ORDERS:
+        config['order'] = value
+      else:
+        errors.append("Invalid download order specified.")
+    elif option == "--max-rate":
+      try:
+        config['maxrate'] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid rate.  Must be a byte count per second, eg. 1M.")
+    elif option == "--budget":
+      try:
+        config['budget'] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid budget.  Must be a byte count, eg. 2G.")
+    elif option == "--since":
+      try:
+        parse_since(value)
+        config['since'] = value
+      except ValueError:
+        errors.append("Invalid date.  Must be a number of days or YYYY-MM-DD.")
+    elif option in ("--larger", "--smaller"):
+      try:
+        config[option[2:]] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid size.  Must be a byte count, eg. 10M.")
+    elif option == "--skip-deleted":
+      config['skipdeleted'] = True
+    elif option == "--search":
+      config['search'] = value
+    elif option in ("--include", "--exclude"):
+      regexes = config[option[2:]] or []
+      try:
+        if value:
+          regexes.append(re.compile(value))
+        config[option[2:]] = regexes
+      except re.error:
+        errors.append("Invalid regular expression: %s" % (value))
+    elif option == "--subscribed":
+      config['subscribed'] = True
+    elif option == "--metrics":
+      config['metricsfile'] = value
+    elif option == "--prometheus":
+      config['prometheusfile'] = value
+    elif option == "--profile":
+      config['profile'] = value
+    elif option == "--scan-processes":
+      try:
+        config['scanprocesses'] = int(value)
+        if config['scanprocesses'] < 0:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid number of scan processes.  Must be 0 or more.")
+    elif option == "--reconnects":
+      try:
+        config['reconnects'] = int(value)
+        if config['reconnects'] < 0:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid number of reconnects.  Must be 0 or more.")
+    elif option == "--timeout":
+      try:
+        config['timeout'] = float(value)
+        if config['timeout'] < 0:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid timeout.  Must be 0 or more seconds.")
+    elif option == "--plan":
+      config['plan'] = True
+    elif option == "--quota":
+      try:
+        config['quota'] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid quota.  Must be a byte count, eg. 45G.")
+    elif option == "--quota-warning":
+      try:
+        config['quotawarning'] = float(value.rstrip('%'))
+        if not 0 <= config['quotawarning'] <= 100:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid quota warning.  Must be a percentage, eg. 90%.")
+    elif option == "--disk-reserve":
+      try:
+        config['diskreserve'] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid disk reserve.  Must be a byte count, eg. 1G.")
+    elif option == "--no-deflate":
+      config['deflate'] = False
+    elif option == "--rcvbuf":
+      try:
+        config['rcvbuf'] = parse_byte_count(value)
+      except ValueError:
+        errors.append("Invalid receive buffer.  Must be a byte count, eg. 4M.")
+    elif option == "--read-chunk":
+      try:
+        config['readchunk'] = parse_byte_count(value)
+        if config['readchunk'] < 1:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid read chunk.  Must be a byte count, eg. 256K.")
+    elif option == "--verify":
+      config['verify'] = True
+    elif option == "--verify-sample":
+      try:
+        config['verifysample'] = float(value)
+        if not 0 <= config['verifysample'] <= 1:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid sample.  Must be a ratio between 0 and 1.")
+    elif option == "--verify-time":
+      try:
+        config['verifytime'] = int(value)
+        if config['verifytime'] < 0:
+          raise ValueError
+      except ValueError:
+        errors.append("Invalid verify time.  Must be a number of seconds.")
+    elif option == "--skip-special":
+      config['skipspecial'] = []
+      for use in value.split(','):
+        special = [special for special in SPECIAL_USES if special[1:].lower() == use.strip('\\ ').lower()]
+        if special:
+          config['skipspecial'].append(special[0])
+        elif use.strip():
+          errors.append("Unknown SPECIAL-USE attribute: %s" % (use))
     else:
       errors.append("Unknown option: " + option)
 
+  # Gmail shows the messages of its labels in [Gmail]/All Mail
+  if config['exclude'] is None:
+    config['exclude'] = [re.compile(r'\[Gmail\]/')]
+
   # don't ignore extra arguments
   for arg in extraargs:
     errors.append("Unknown argument: " + arg)
@@ -477,12 +3061,14 @@ def process_cline():
 def check_config(config, warnings, errors):
   """Checks the config for consistency, returns (config, warnings, errors)"""
 
+  if config['store'] != 'mbox' and config['compress'] != 'none':
+    errors.append("Only mbox files can be compressed.")
   if config['compress'] == 'bzip2' and config['overwrite'] == False:
     errors.append("Cannot append new messages to mbox.bz2 files.  Please specify -y.")
-  if config['compress'] == 'gzip' and config['overwrite'] == False:
-    warnings.append(
-      "Appending new messages to mbox.gz files is very slow.  Please Consider\n"
-      "  using -y and compressing the files yourself with gzip -9 *.mbox")
+  if config['verify'] and config['overwrite']:
+    errors.append("Cannot verify mbox files that are to be overwritten.")
+  if config['compress'] == 'zstd' and zstandard is None:
+    errors.append("Cannot write mbox.zst files without the zstandard module.")
   if 'server' not in config :
     errors.append("No server specified.")
   if 'user' not in config:
@@ -511,7 +3097,7 @@ def check_config(config, warnings, errors):
 def get_config():
   """Gets config from command line and console, returns config"""
   # config = {
-  #   'compress': 'none' or 'gzip' or 'bzip2'
+  #   'compress': 'none' or 'gzip' or 'bzip2' or 'zstd'
   #   'overwrite': True or False
   #   'server': String
   #   'port': Integer
@@ -520,6 +3106,45 @@ def get_config():
   #   'usessl': True or False
   #   'keyfilename': String or None
   #   'certfilename': String or None
+  #   'scanchunk': Integer
+  #   'inflight': Integer
+  #   'fullscan': True or False
+  #   'jobs': Integer
+  #   'store': 'mbox' or 'maildir' or 'cas'
+  #   'order': 'oldest' or 'smallest'
+  #   'maxrate': Integer
+  #   'budget': Integer
+  #   'throttle': Throttle
+  #   'metrics': MetricsReport
+  #   'profiles': [cProfile.Profile]
+  #   'localscans': LocalScans
+  #   'since': String or None
+  #   'larger': Integer
+  #   'smaller': Integer
+  #   'skipdeleted': True or False
+  #   'search': String or None
+  #   'include': [Regex]
+  #   'exclude': [Regex]
+  #   'subscribed': True or False
+  #   'skipspecial': [String]
+  #   'metricsfile': String or None
+  #   'prometheusfile': String or None
+  #   'profile': String or None
+  #   'scanprocesses': Integer
+  #   'reconnects': Integer
+  #   'timeout': Float
+  #   'deflate': True or False
+  #   'rcvbuf': Integer
+  #   'readchunk': Integer
+  #   'plan': True or False
+  #   'quota': Integer
+  #   'quotawarning': Float
+  #   'diskreserve': Integer
+  #   'diskspace': DiskSpace
+  #   'verify': True or False
+  #   'verifysample': Float
+  #   'verifytime': Integer
+  #   'verification': Verification
   # }
   
   config, warnings, errors = process_cline()
@@ -545,31 +3170,28 @@ def get_config():
       config['port'] = 993
     else:
       config['port'] = 143
+  config['throttle'] = Throttle(config['maxrate'], config['budget'])
+  config['metrics'] = MetricsReport(config)
+  config['profiles'] = []
+  config['localscans'] = LocalScans(config)
+  config['verification'] = Verification(config)
+  config['diskspace'] = DiskSpace(config['diskreserve'])
   
   # done!
   return config
 
+def report_left(config):
+  """Tells how much the budget of the run left to download, if anything"""
+  throttle = config['throttle']
+  if throttle.left:
+    eta = throttle.eta(throttle.left)
+    report("Budget reached: %s left for next runs%s" % (pretty_byte_count(throttle.left),
+           eta is not None and ", ETA %s" % pretty_duration(eta) or ""))
+
 def connect_and_login(config):
   """Connects to the server and logs in.  Returns IMAP4 object."""
   try:
-    assert(not (('keyfilename' in config) ^ ('certfilename' in config)))
-    
-    if config['usessl'] and 'keyfilename' in config:
-      print "Connecting to '%s' TCP port %d," % (config['server'], config['port']),
-      print "SSL, key from %s," % (config['keyfilename']),
-      print "cert from %s " % (config['certfilename'])
-      server = imaplib.IMAP4_SSL(config['server'], config['port'],
-                                 config['keyfilename'], config['certfilename'])
-    elif config['usessl']:
-      print "Connecting to '%s' TCP port %d, SSL" % (config['server'], config['port'])
-      server = imaplib.IMAP4_SSL(config['server'], config['port'])
-    else:
-      print "Connecting to '%s' TCP port %d" % (config['server'], config['port'])
-      server = imaplib.IMAP4(config['server'], config['port'])
-    
-    tweaksocket(server)
-    print "Logging in as '%s'" % (config['user'])
-    server.login(config['user'], config['pass'])
+    return open_server(config, config['metrics'].account)
   except socket.gaierror, e:
     (err, desc) = e
     print "ERROR: problem looking up server '%s' (%s %s)" % (config['server'], err, desc)
@@ -584,66 +3206,941 @@ def connect_and_login(config):
     
     sys.exit(4)
 
+def open_server(config, metrics):
+  """Connects to the server and logs in, timed as the 'login' phase of metrics
+
+  Returns the IMAP4 object, raises the errors connect_and_login() reports."""
+  metrics.start('login')
+  assert(not (('keyfilename' in config) ^ ('certfilename' in config)))
+  
+  if config['usessl'] and 'keyfilename' in config:
+    report("Connecting to '%s' TCP port %d, SSL, key from %s, cert from %s " % (
+      config['server'], config['port'], config['keyfilename'], config['certfilename']))
+    server = imaplib.IMAP4_SSL(config['server'], config['port'],
+                               config['keyfilename'], config['certfilename'])
+  elif config['usessl']:
+    report("Connecting to '%s' TCP port %d, SSL" % (config['server'], config['port']))
+    server = imaplib.IMAP4_SSL(config['server'], config['port'])
+  else:
+    report("Connecting to '%s' TCP port %d" % (config['server'], config['port']))
+    server = imaplib.IMAP4(config['server'], config['port'])
+  
+  # imaplib connects before the socket can be tweaked, a larger --rcvbuf
+  # may then not be scaled into the TCP window by every OS
+  tweaksocket(server.sock, config)
+  # a read waiting longer raises socket.timeout, and Session connects again;
+  # the socket of SSL connections is shared with their sslobj
+  server.sock.settimeout(config['timeout'] or None)
+  server.read_chunk = config['readchunk']
+  server.metrics = metrics
+  count_traffic(server)
+  report("Logging in as '%s'" % (config['user']))
+  server.login(config['user'], config['pass'])
+  enable_qresync(server)
+  enable_deflate(server, config)
+  metrics.stop()
   return server
 
-def submain(server, foldername, filename, config):
-        fol_messages = scan_folder(server, foldername) ;# remote scan
-        fil_messages, miwarnings = scan_file(filename, config['compress'], config['overwrite']) ;# local scan
-
-        countremote = len(fol_messages) # remote total emails
-        countlocal = len(fil_messages)  # already got (localy) emails
-        countnew = countremote - countlocal
-        new_messages = {}
-        for msg_id in fol_messages:
-          if msg_id not in fil_messages:
-            new_messages[msg_id] = fol_messages[msg_id]
-        
-        #for f in new_messages:
-        #  print "%s : %s" % (f, new_messages[f])
-
-        sizetotal, sizebiggest = download_messages(server, filename, new_messages, config, countlocal, countremote, countnew)
-        sizenew = 0
-
-	if(countnew == 0 and sizetotal == 0):
-          sizetotal = sizenew = "-"
-        else:
-          sizenew     = pretty_byte_count(sizenew)
-          sizetotal   = pretty_byte_count(sizetotal)
+class Session:
+  """A connection to the server, opened again when it breaks
 
-	miwarntxt = ""
-        if(miwarnings > 0):
-          miwarntxt = " (%d warnings)" % miwarnings
+  call() runs a function with the IMAP4 object of the session.  When the
+  connection breaks meanwhile, it is opened again, waiting longer each time,
+  up to config['reconnects'] times for a call, and the function is called
+  again.  The functions backing up a folder select it again, and go
+  on from the messages stored before the connection broke, or the server
+  sent nothing for config['timeout'] seconds."""
 
-        part1 = "[%5d new] [local %5d/%5d remote] [%s/%s] %s" % (countnew, countlocal, countremote, sizenew, sizetotal, filename)
-        if(sizebiggest > 0):
-          part2 = " (%s for largest message)%s" % ( pretty_byte_count(sizebiggest), miwarntxt)
-        else:
-          part2 = "%s" % (miwarntxt)
-        print part1+part2
+  def __init__(self, server, config):
+    """Session constructor"""
+    self.server = server
+    self.config = config
+
+  def call(self, function, *args):
+    """Returns function(IMAP4 object, *args), calling it again after reconnecting"""
+    tries = 0
+    while True:
+      try:
+        return function(self.server, *args)
+      except CONNECTION_ERRORS, e:
+        error = e
+      metrics = self.server.metrics
+      metrics.stop_all()
+      try:
+        self.server.shutdown()
+      except CONNECTION_ERRORS:
+        pass
+      while True:
+        if tries >= self.config['reconnects']:
+          raise error
+        delay = min(RECONNECT_DELAY * 2 ** tries, RECONNECT_MAX_DELAY)
+        tries += 1
+        report("Connection lost (%s), connecting again in %ds" % (error, delay))
+        time.sleep(delay)
+        try:
+          self.server = open_server(self.config, metrics)
+          metrics.add('reconnects')
+          break
+        except CONNECTION_ERRORS, e:
+          error = e
+          metrics.stop_all()
+
+def enable_qresync(server):
+  """Enables QRESYNC when the server has it, which sets server.qresync"""
+  # servers may tell more capabilities once logged in
+  typ, data = server.capability()
+  if 'OK' == typ and data and data[-1]:
+    server.capabilities = tuple(data[-1].upper().split())
+  server.qresync = False
+  if 'QRESYNC' in server.capabilities:
+    typ, data = server._simple_command('ENABLE', 'QRESYNC')
+    server.qresync = ('OK' == typ)
+
+def enable_deflate(server, config):
+  """Compresses the connection when the server has COMPRESS=DEFLATE, unless --no-deflate"""
+  if not config['deflate'] or 'COMPRESS=DEFLATE' not in server.capabilities:
+    return
+  typ, data = server._simple_command('COMPRESS', 'DEFLATE')
+  if 'OK' == typ:
+    server.deflate = Deflate(server, server.read_chunk)
+    server.file = server.deflate
+
+def state_filename(filename):
+  """Name of the file keeping the state of the folder backed up in filename"""
+  return filename + '.state'
+
+def mbox_signature(filename):
+  """Returns (size, mtime) of a mbox file, None if it doesn't exist"""
+  try:
+    stat = os.stat(filename)
+  except OSError:
+    return None
+  return [stat.st_size, int(stat.st_mtime)]
+
+def load_state(filename, with_ids=True):
+  """Loads the saved state of a folder, returns None if there is none
+
+  The state file starts with a JSON line of STATUS values and the signature of
+  the mbox when it was saved, followed by one "UID<tab>Message-Id" line per
+  message backed up, with a third "deleted" field for the messages known to
+  have been expunged from the folder since.  With with_ids=False only the
+  first line is read."""
+  try:
+    statefile = open(state_filename(filename), 'rb')
+  except IOError:
+    return None
+  try:
+    try:
+      state = json.loads(statefile.readline())
+      state['ids'] = {}
+      state['deleted'] = {}
+      if with_ids:
+        for line in statefile:
+          fields = line.rstrip('\n').split('\t')
+          if len(fields) > 2 and fields[2] == 'deleted':
+            state['deleted'][int(fields[0])] = fields[1]
+          else:
+            state['ids'][int(fields[0])] = fields[1]
+    except ValueError:
+      debugprint("File %s: unreadable, ignored" % (state_filename(filename)))
+      return None
+  finally:
+    statefile.close()
+  return state
+
+def save_state(filename, state):
+  """Saves the state of a folder, atomically replacing the previous one"""
+  header = dict([(key, state[key]) for key in state if key not in ('ids', 'deleted')])
+  tmpname = state_filename(filename) + '.tmp'
+  statefile = open(tmpname, 'wb')
+  try:
+    statefile.write(json.dumps(header, sort_keys=True) + '\n')
+    for uid in sorted(state['ids'].keys()):
+      statefile.write("%d\t%s\n" % (uid, state['ids'][uid]))
+    for uid in sorted(state['deleted'].keys()):
+      statefile.write("%d\t%s\tdeleted\n" % (uid, state['deleted'][uid]))
+  finally:
+    statefile.close()
+  os.rename(tmpname, state_filename(filename))
+
+def get_folder_status(server, foldername):
+  """Gets STATUS values of a folder, returns {item: Integer} dict"""
+  typ, data = server.status(foldername, status_items(server.capabilities))
+  if 'OK' != typ:
+    raise SkipFolderException("STATUS failed: %s" % (data))
+  return parse_status(data[-1])
+
+def get_folder_statuses(server, names):
+  """Gets the STATUS values of all folders in one round, returns {foldername: status}
+
+  With LIST-STATUS (RFC 5819) a single LIST returns them, otherwise a STATUS
+  command per folder is sent before any answer is read.  Folders whose
+  STATUS fails are left out, see plan_folders()."""
+  items = status_items(server.capabilities)
+  statuses = {}
+  if 'LIST-STATUS' in server.capabilities:
+    typ, data = server._simple_command('LIST', '""', '"*"', 'RETURN', '(STATUS %s)' % (items))
+    server.untagged_responses.pop('LIST', None)
+    for response in server.untagged_responses.pop('STATUS', []):
+      # names sent as literals are asked for again below
+      if 'OK' == typ and isinstance(response, str):
+        foldername, status = parse_named_status(response)
+        statuses[foldername] = status
+
+  inflight = []
+  for foldername, filename, priority in names:
+    if foldername not in statuses:
+      tag = server._new_tag()
+      server.send('%s STATUS %s %s\r\n' % (tag, server._checkquote(foldername), items))
+      inflight.append((tag, foldername))
+  response = None
+  while inflight:
+    line = server._get_line()
+    tag, foldername = inflight[0]
+    if line.startswith(tag + ' '):
+      inflight.pop(0)
+      del server.tagged_commands[tag]
+      if line.split(' ', 2)[1] == 'OK' and response is not None:
+        statuses[foldername] = parse_status(response)
+      else:
+        report("STATUS %s failed: %s" % (foldername, line))
+      response = None
+    elif line.startswith('* BYE'):
+      raise server.abort(line)
+    elif line.startswith('* STATUS '):
+      match = LITERAL_RE.search(line)
+      if match:
+        # folder name sent as a literal, the values follow it
+        server.read(int(match.group(1)))
+        line = server._get_line()
+      response = line
+  return statuses
+
+def get_quota(server):
+  """Gets the STORAGE quota of INBOX, returns (bytes used, bytes allowed), None without QUOTA"""
+  if 'QUOTA' not in server.capabilities:
+    return None
+  try:
+    typ, data = server.getquotaroot('INBOX')
+  except imaplib.IMAP4.error:
+    return None
+  if 'OK' != typ:
+    return None
+  return parse_quota([row for row in data[-1] if isinstance(row, str)])
+
+def parse_quota(rows):
+  """Parses QUOTA responses (RFC 2087), returns (bytes used, bytes allowed) of the first STORAGE"""
+  for row in rows:
+    match = QUOTA_RE.search(row)
+    if match:
+      # counted in units of 1024 octets
+      return int(match.group(1)) * 1024, int(match.group(2)) * 1024
+  return None
+
+def measure_folders(server, plan):
+  """Adds up the RFC822.SIZE of the messages of the folders of the plan of unknown size
+
+  A FETCH of only their sizes, for --plan to tell the size of every folder."""
+  for folder in plan:
+    if folder['size'] is not None:
+      continue
+    try:
+      num_msgs = select_folder(server, folder['folder'])
+      size = 0
+      for msgset in scan_sequence_sets(num_msgs, SCAN_CHUNK):
+        typ, data = server.fetch(msgset, '(RFC822.SIZE)')
+        if 'OK' != typ:
+          raise SkipFolderException("FETCH %s failed: %s" % (msgset, data))
+        size += sum([attrs.get('RFC822.SIZE', 0) for attrs in parse_fetch_response(data).values()])
+      folder['size'] = size
+    except SkipFolderException, e:
+      report(str(e))
+
+def status_items(capabilities):
+  """STATUS items telling whether a folder changed, and its size with STATUS=SIZE"""
+  items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+  # QRESYNC implies CONDSTORE (RFC 7162), which servers may not repeat
+  if 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities:
+    items.append('HIGHESTMODSEQ')
+  if 'STATUS=SIZE' in capabilities:
+    items.append('SIZE')
+  return '(%s)' % ' '.join(items)
+
+def parse_status(response):
+  """Parses a STATUS response, returns {item: Integer} dict"""
+  values = STATUS_RE.search(response).group(1).split()
+  status = {}
+  for i in range(0, len(values)-1, 2):
+    status[values[i].lower()] = int(values[i+1])
+  return status
+
+def parse_named_status(response):
+  """Parses a STATUS response with the name of its folder, returns (foldername, status)"""
+  match = STATUS_RE.search(response)
+  return parse_string_list(response[:match.start()])[0], parse_status(response)
+
+def folder_unchanged(state, status):
+  """Tells whether the folder state matches fresh STATUS values"""
+  for key in status:
+    # SIZE tells nothing the others don't, older states don't have it
+    if key != 'size' and state.get(key) != status[key]:
+      return False
+  return True
+
+def plan_folders(names, statuses, config):
+  """Decides what to do with each folder, returns the plan in the order to follow
+
+  The plan is a list of dicts, one per folder of names: its 'action' is
+  'skip' when its state tells it didn't change, 'incremental' when only
+  the messages since its last run are to be scanned, 'full' otherwise, or
+  'verify' with --verify.  Its 'size' is the one STATUS gave with
+  STATUS=SIZE, or that of the last plan when it didn't change since, None
+  if unknown.  A folder without STATUS is planned as 'full' of unknown
+  size, its 'status' None, for its backup to ask again.  Within a
+  priority, folders to scan come first, largest first, so that none of
+  them is left alone at the end."""
+  last = dict([(folder['folder'], folder) for folder in load_plan()])
+  plan = []
+  for foldername, filename, priority in names:
+    if foldername not in statuses:
+      report("WARNING: no STATUS for %s, its size is unknown" % (foldername))
+      plan.append({'folder':foldername, 'file':filename, 'priority':priority,
+                   'action':config['verify'] and 'verify' or 'full', 'status':None, 'size':None,
+                   'local':0})
+      continue
+    status = statuses[foldername]
+    state = previous_state(open_store(filename, config), filename, config)
+    if config['verify']:
+      action = 'verify'
+    elif state and folder_unchanged(state, status):
+      action = 'skip'
+    elif state and state.get('uidvalidity') == status['uidvalidity']:
+      action = 'incremental'
+    else:
+      action = 'full'
+    size = status.get('size')
+    if size is None and state and folder_unchanged(state, status):
+      # added up by the scan of its last run
+      size = state.get('size')
+    if (size is None and foldername in last and last[foldername]['status'] is not None
+        and folder_unchanged(last[foldername]['status'], status)):
+      size = last[foldername]['size']
+    plan.append({'folder':foldername, 'file':filename, 'priority':priority, 'action':action,
+                 'status':status, 'size':size, 'local':state and state.get('local') or 0})
+  # sorted() keeps the order of LIST among equals
+  return sorted(plan, key=lambda folder: (folder['priority'], folder['action'] == 'skip',
+                                          -(folder['size'] or 0), -planned_messages(folder)))
+
+def planned_messages(folder):
+  """Number of messages STATUS gave for a folder of the plan, 0 without STATUS"""
+  if folder['status'] is None:
+    return 0
+  return folder['status']['messages']
+
+def load_plan():
+  """The plan of the last run, an empty one if there is none"""
+  try:
+    planfile = open(PLAN_FILENAME, 'rb')
+  except IOError:
+    return []
+  try:
+    try:
+      return json.load(planfile)['folders']
+    except (ValueError, KeyError):
+      debugprint("File %s: unreadable, ignored" % (PLAN_FILENAME))
+      return []
+  finally:
+    planfile.close()
+
+def save_plan(plan):
+  """Saves the plan for the next run, atomically replacing the last one"""
+  tmpname = PLAN_FILENAME + '.tmp'
+  planfile = open(tmpname, 'wb')
+  try:
+    json.dump({'time':int(time.time()), 'folders':plan}, planfile, sort_keys=True, indent=1)
+  finally:
+    planfile.close()
+  os.rename(tmpname, PLAN_FILENAME)
+
+def report_plan(plan, config):
+  """Tells what the plan is: with --plan for each folder, otherwise only in total"""
+  if config['plan']:
+    for folder in plan:
+      size = folder['size'] is not None and pretty_byte_count(folder['size']) or "?"
+      messages = folder['status'] is not None and str(planned_messages(folder)) or "?"
+      report("[%-11s] [%6s messages] [%10s] %s" % (folder['action'], messages, size, folder['file']))
+  counts = dict([(action, len([folder for folder in plan if folder['action'] == action]))
+                 for action in ('full', 'incremental', 'skip', 'verify')])
+  line = "Plan: %d folders" % (len(plan))
+  if counts['verify']:
+    line += ", %d to verify" % (counts['verify'])
+  else:
+    line += ", %d to scan fully, %d since their last run, %d unchanged" % (
+      counts['full'], counts['incremental'], counts['skip'])
+  line += "; %d messages" % (sum([planned_messages(folder) for folder in plan]))
+  unknown = len([folder for folder in plan if folder['size'] is None])
+  if unknown < len(plan):
+    line += ", %s" % (pretty_byte_count(sum([folder['size'] or 0 for folder in plan])))
+  if unknown:
+    line += " (size of %d folders unknown)" % (unknown)
+  report(line)
+
+def report_quota(quota, plan, config):
+  """Tells how much of the quota of the account is used, warning past --quota-warning
+
+  quota is what get_quota() returned.  --quota gives the quota when the
+  server doesn't, the use being then the size of the folders of the plan."""
+  used = limit = None
+  if quota is not None:
+    used, limit = quota
+  if config['quota']:
+    limit = config['quota']
+  atleast = ""
+  if used is None:
+    used = sum([folder['size'] or 0 for folder in plan])
+    if [folder for folder in plan if folder['size'] is None]:
+      atleast = "at least "
+  if not limit:
+    return
+  percent = 100.0 * used / limit
+  report("Quota: %s%s of %s used (%.0f%%)" % (atleast, pretty_byte_count(used),
+                                              pretty_byte_count(limit), percent))
+  if percent >= config['quotawarning']:
+    report("WARNING: %.0f%% of the quota is used" % (percent))
+
+def skip_folder(folder, config):
+  """Prints the summary line of a folder the plan found unchanged, counts it in the metrics"""
+  report(folder_summary(folder['file'], 0, folder['local'], folder['status']['messages'],
+                        0, 0, 0, 0))
+  config['metrics'].add(Metrics(folder['folder'], folder['file']))
+
+def submain(session, foldername, filename, config, status=None):
+  """Backs up one folder into filename, or verifies it with --verify, prints a summary line
+
+  status is the result of get_folder_status(), when it was already known.
+  The metrics of the folder are added to those of the run, see Metrics."""
+  metrics = Metrics(foldername, filename)
+  session.server.metrics = metrics
+  try:
+    if config['verify']:
+      session.call(verify_folder, foldername, filename, config, status)
+    else:
+      session.call(backup_folder, foldername, filename, config, status)
+  finally:
+    session.server.metrics = config['metrics'].account
+    config['metrics'].add(metrics)
+
+def backup_folder(server, foldername, filename, config, status=None):
+  """Backs up one folder into filename, for submain()"""
+  metrics = server.metrics
+  store = open_store(filename, config)
+  metrics.start('local scan')
+  state = previous_state(store, filename, config)
+  metrics.stop()
+  if status is None:
+    metrics.start('status')
+    status = get_folder_status(server, foldername)
+    metrics.stop()
+
+  if state and folder_unchanged(state, status):
+    # nothing came or went since last run
+    report("[%5d new] [local %5d/%5d remote] [-/-] %s" % (0, state['local'], status['messages'], filename))
+    return
+
+  if state and state.get('uidvalidity') == status['uidvalidity']:
+    # only look at messages which arrived since last run
+    metrics.start('local scan')
+    state = load_state(filename)
+    metrics.stop()
+    qresync, vanished = qresync_since(server, state), []
+    since, size = resume_point(state)
+    metrics.start('id scan')
+    fol_messages = scan_folder(server, foldername, config['scanchunk'], since,
+                               qresync, vanished, search_criteria(config)) ;# remote scan
+    countdeleted = record_deletions(server, state, status, fol_messages, qresync, vanished,
+                                    search_criteria(config))
+    metrics.stop()
+    fil_messages, miwarnings = IdSet(state['ids'].values() + state['deleted'].values()), 0 ;# local scan
+    countremote = status['messages']
+    countlocal = len(fil_messages)
+    # those past the resume point may be stored already
+    countnew = len(fil_messages.missing(fol_messages))
+    if size is not None and not countdeleted:
+      size += messages_size(fol_messages)
+    else:
+      size = None
+  else:
+    state = {'ids':{}, 'deleted':{}, 'filter':filter_key(config)}
+    metrics.start('id scan')
+    fol_messages = scan_folder(server, foldername, config['scanchunk'],
+                               criteria=search_criteria(config)) ;# remote scan
+    metrics.stop()
+    metrics.start('local scan')
+    fil_messages, miwarnings = config['localscans'].result(store) ;# local scan
+    metrics.stop()
+    countremote = len(fol_messages) # remote total emails
+    countlocal = len(fil_messages)  # already got (localy) emails
+    countnew = countremote - countlocal
+    countdeleted = 0
+    size = None
+    if search_criteria(config) is None:
+      size = messages_size(fol_messages)
+  status = sized_status(status, state, size)
+
+  new_messages = find_new_messages(fol_messages, fil_messages)
+
+  #for f in new_messages:
+  #  print "%s : %s" % (f, new_messages[f])
+
+  needed = disk_needed(new_messages, config)
+  if not config['diskspace'].reserve(filename, needed):
+    raise SkipFolderException("Not enough disk space: %s not downloaded, %s needed" % (
+                              filename, pretty_byte_count(needed)))
+  sums = Sums(filename, status['uidvalidity'])
+  try:
+    sizetotal, sizebiggest, sizesaved, left = download_messages(server, store, sums, new_messages, config, countlocal, countremote, countnew)
+  except CONNECTION_ERRORS:
+    save_stored(store, filename, state, status, fol_messages, new_messages, countlocal)
+    raise
+  finally:
+    config['diskspace'].release(needed)
+  metrics.start('disk write')
+  update_state(store, filename, state, status, fol_messages,
+               countlocal + len(new_messages) - len(left), left)
+  metrics.stop()
+  sizenew = sum([size or 0 for num, uid, size in new_messages.values()])
+  count_folder(metrics, countnew, sizetotal, sizebiggest, sizesaved)
+  report(folder_summary(filename, countnew, countlocal, countremote,
+                        sizetotal, sizebiggest, sizesaved, miwarnings, countdeleted,
+                        sum([size or 0 for num, uid, size in left.values()]), sizenew))
 
+class Verification:
+  """What --verify found in all folders, and the time it has left to hash messages"""
 
+  def __init__(self, config):
+    """Verification constructor"""
+    self.sample = config['verifysample']
+    self.deadline = config['verifytime'] and time.time() + config['verifytime'] or None
+    self.lock = threading.Lock()
+    self.checked = self.hashed = self.hashed_bytes = self.failed = self.unrecorded = 0
+
+  def expired(self):
+    """Tells whether the time to hash messages in is spent"""
+    return self.deadline is not None and time.time() > self.deadline
+
+  def add(self, checked, hashed, hashed_bytes, failed, unrecorded):
+    """Adds what was found in a folder"""
+    self.lock.acquire()
+    try:
+      self.checked += checked
+      self.hashed += hashed
+      self.hashed_bytes += hashed_bytes
+      self.failed += failed
+      self.unrecorded += unrecorded
+    finally:
+      self.lock.release()
+
+  def finish(self):
+    """Tells what was found in all folders, returns the exit status of the run"""
+    report("Verified %d messages, %d of them (%s) downloaded again: %d failed%s" %
+           (self.checked, self.hashed, pretty_byte_count(self.hashed_bytes), self.failed,
+            self.unrecorded and ", %d stored without .sums" % self.unrecorded or ""))
+    return self.failed and 6 or 0
+
+class HashingWriter:
+  """Hashes a message as it is downloaded, instead of storing it"""
+
+  def __init__(self):
+    """HashingWriter constructor"""
+    self.digest = sha.new()
+
+  def write(self, data):
+    self.digest.update(data)
+
+def verify_folder(server, foldername, filename, config, status=None):
+  """Checks the messages of a folder recorded in its .sums against the server, for submain()
+
+  The RFC822.SIZE and INTERNALDATE of each message recorded and still on the
+  server are compared to those it gives now, and its Message-Id looked for
+  in the store.  A sample of those that pass is downloaded again, hashed as
+  it comes and compared to the SHA-1 recorded, until the time of
+  config['verification'] is spent: the folders verified after that only get
+  the first checks."""
+  metrics = server.metrics
+  verification = config['verification']
+  store = open_store(filename, config)
+  if status is None:
+    metrics.start('status')
+    status = get_folder_status(server, foldername)
+    metrics.stop()
+  recorded = Sums(filename, status['uidvalidity']).load()
+  metrics.start('local scan')
+  local, miwarnings = config['localscans'].result(store)
+  metrics.stop()
+  metrics.start('select')
+  select_folder(server, foldername)
+  metrics.stop()
+
+  # sizes and dates only, a chunk of messages per FETCH
+  metrics.start('id scan')
+  uids = sorted(recorded.keys())
+  batches = [uids[first:first+config['scanchunk']]
+             for first in range(0, len(uids), config['scanchunk'])]
+  remote = {}
+  for num, attrs in fetch_pipelined(server, batches, VERIFY_ITEMS):
+    if 'UID' in attrs:
+      remote[attrs['UID']] = (attrs.get('RFC822.SIZE'), attrs.get('INTERNALDATE'))
+  metrics.stop()
+
+  failed = 0
+  passed = []
+  for uid in uids:
+    size, date, digest, msg_id = recorded[uid]
+    if uid not in remote:
+      # expunged since it was stored
+      continue
+    if remote[uid] != (size, date):
+      report("   UID %d: RFC822.SIZE %s, INTERNALDATE %s on the server, %d, %s when stored" %
+             (uid, remote[uid][0], remote[uid][1], size, date))
+      failed += 1
+    elif msg_id not in local:
+      report("   UID %d: %s not in %s" % (uid, msg_id, filename))
+      failed += 1
+    else:
+      passed.append(uid)
+
+  # the sample is hashed a few FETCH commands at a time, so as to stop in time
+  sample = random.sample(passed, int(math.ceil(len(passed) * verification.sample)))
+  sizes = dict([(uid, recorded[uid][0]) for uid in sample])
+  batches = make_fetch_batches(sizes, config['inflight'], FETCH_PIPELINE)
+
+  def stream(num, attrs):
+    """Hashes a message of the sample as it comes"""
+    if attrs.get('UID') not in sizes:
+      return None
+    return HashingWriter()
+
+  hashed = hashed_bytes = 0
+  metrics.start('fetch')
+  for first in range(0, len(batches), FETCH_PIPELINE):
+    if verification.expired():
+      break
+    for num, attrs in fetch_pipelined(server, batches[first:first+FETCH_PIPELINE],
+                                      '(UID BODY.PEEK[])', stream=stream,
+                                      throttle=config['throttle']):
+      uid = attrs.get('UID')
+      if uid not in sizes or 'BODY' not in attrs:
+        continue
+      if isinstance(attrs['BODY'], str):
+        # the UID came after the message, which had to be read in memory
+        digest = sha.new(attrs['BODY']).hexdigest()
+      else:
+        digest = attrs['BODY'].digest.hexdigest()
+      hashed += 1
+      hashed_bytes += sizes[uid]
+      if digest != recorded[uid][2]:
+        report("   UID %d: %s differs from the message stored" % (uid, recorded[uid][3]))
+        failed += 1
+  metrics.stop()
+
+  unrecorded = max(status['messages'] - len(remote), 0)
+  verification.add(len(remote), hashed, hashed_bytes, failed, unrecorded)
+  report("[%5d checked] [%5d hashed, %s] [%5d failed] %s%s" %
+         (len(remote), hashed, pretty_byte_count(hashed_bytes), failed, filename,
+          unrecorded and " (%d without .sums)" % unrecorded or ""))
+
+def qresync_since(server, state):
+  """QRESYNC parameters to select a folder with, None when QRESYNC can't be used"""
+  if getattr(server, 'qresync', False) and state.get('highestmodseq'):
+    return (state['uidvalidity'], state['highestmodseq'])
+  return None
+
+def record_deletions(server, state, status, fol_messages, qresync, vanished, criteria=None):
+  """Moves the UIDs expunged from the folder to state['deleted'], returns their number
+
+  With QRESYNC the server told which UIDs vanished; otherwise the UIDs left
+  are searched, only when the number of messages doesn't add up.  With
+  criteria, see search_criteria(), the messages that arrived are counted
+  apart, those scanned being only some of them."""
+  if qresync is not None:
+    return move_deleted(state, [uid for uid in state['ids'] if in_sequence_set(vanished, uid)])
+  arrived = None
+  if criteria is not None:
+    typ, data = server.uid('SEARCH', '(UID %d:*)' % (state['uidnext']))
+    if 'OK' != typ:
+      raise SkipFolderException("SEARCH failed: %s" % (data))
+    arrived = count_arrived(data, state)
+  if not expunged_since(state, status, fol_messages, arrived):
+    return 0
+  typ, data = server.uid('SEARCH', 'ALL')
+  if 'OK' != typ:
+    raise SkipFolderException("SEARCH failed: %s" % (data))
+  left = set([int(uid) for uid in ' '.join([line or '' for line in data]).split()])
+  return move_deleted(state, [uid for uid in state['ids'] if uid not in left])
+
+def expunged_since(state, status, fol_messages, arrived=None):
+  """Tells whether some messages of the state may have been expunged
+
+  fol_messages are those scanned from resume_point(), the ones of the state
+  past it being among them.  arrived, when only the messages matching
+  search criteria were scanned, is the number of all those from the
+  UIDNEXT of the state on, the MESSAGES of the state then being compared."""
+  if arrived is not None:
+    return status['messages'] != state['messages'] + arrived
+  since = resume_point(state)[0]
+  kept = len([uid for uid in state['ids'] if uid < since])
+  return status['messages'] != kept + len(fol_messages)
+
+def count_arrived(lines, state):
+  """Number of UIDs of UID SEARCH response lines from the UIDNEXT of the state on"""
+  # "n:*" always matches the last message, even below n
+  return len([uid for uid in ' '.join([line or '' for line in lines]).split()
+              if int(uid) >= state['uidnext']])
+
+def resume_point(state):
+  """Returns (UID, bytes of the messages below it) the next scan of a folder starts from
+
+  That is the UIDNEXT of its last complete run, or the first message left by
+  a run stopped by its budget or a broken connection, whose messages past
+  that may only be partly stored.  The size is None if unknown."""
+  if 'resume' in state:
+    return state['resume'], state.get('resume_size')
+  return state['uidnext'], state.get('size')
+
+def move_deleted(state, gone):
+  """Moves the UIDs of gone from state['ids'] to state['deleted'], returns their number"""
+  for uid in gone:
+    state['deleted'][uid] = state['ids'].pop(uid)
+  return len(gone)
+
+def previous_state(store, filename, config):
+  """State saved by the last run of a folder, if its files haven't been touched since"""
+  if config['overwrite'] or config['fullscan']:
+    return None
+  state = load_state(filename, with_ids=False)
+  if state and (state.get('mbox') != store.signature()):
+    return None
+  if state and (state.get('filter') != filter_key(config)):
+    # other messages are wanted now
+    return None
+  return state
+
+def find_new_messages(fol_messages, fil_messages):
+  """Returns the part of the id:(num, uid, size) dict of the folder not stored yet
+
+  fil_messages is the IdSet of the store, merged in one pass with the ids."""
+  new_messages = {}
+  for msg_id in fil_messages.missing(fol_messages):
+    new_messages[msg_id] = fol_messages[msg_id]
+  return new_messages
+
+def update_state(store, filename, state, status, fol_messages, countlocal, left=None):
+  """Saves the state of a folder once the messages seen on the server are stored
+
+  When some were left for a later run, the STATUS values of the last complete
+  run are kept, for the next run to look at them again, and it goes on from
+  the first of them, see resume_point()."""
+  left = left or {}
+  for msg_id, (num, uid, size) in fol_messages.items():
+    if uid is not None and msg_id not in left:
+      state['ids'][uid] = msg_id
+  state.pop('resume', None)
+  state.pop('resume_size', None)
+  uids = [uid for num, uid, size in left.values() if uid is not None]
+  if not left:
+    state.update(status)
+  elif uids:
+    # see resume_point()
+    state['resume'] = min(uids)
+    if 'size' in status:
+      state['resume_size'] = status['size'] - messages_size(
+        dict([(msg_id, message) for msg_id, message in fol_messages.items()
+              if message[1] is None or message[1] >= state['resume']]))
+  state['local'] = countlocal
+  state['mbox'] = store.signature()
+  save_state(filename, state)
+
+def messages_size(messages):
+  """Bytes of the messages of an id:(num, uid, size) dict, as RFC822.SIZE gave them"""
+  return sum([size or 0 for num, uid, size in messages.values()])
+
+def sized_status(status, state, size):
+  """The STATUS values to save for a folder, with its size added up from RFC822.SIZE
+
+  size is None when it isn't known, the one of state then being dropped.
+  The SIZE of STATUS=SIZE is kept as it is."""
+  if 'size' in status:
+    return status
+  state.pop('size', None)
+  if size is None:
+    return status
+  return dict(status, size=size)
+
+def save_stored(store, filename, state, status, fol_messages, new_messages, countlocal):
+  """Saves the state of a folder whose download broke off, with the messages stored
+
+  The messages the store doesn't have are left for the next try, which only
+  downloads those, as if the budget of the run had been reached."""
+  stored, miwarnings = store.scan()
+  left = dict([(msg_id, new_messages[msg_id]) for msg_id in stored.missing(new_messages)])
+  update_state(store, filename, state, status, fol_messages,
+               countlocal + len(new_messages) - len(left), left)
+
+def count_folder(metrics, countnew, sizetotal, sizebiggest, sizesaved):
+  """Adds what was done for a folder to its metrics"""
+  metrics.add('new_messages', countnew)
+  metrics.add('written_bytes', sizetotal)
+  metrics.add('largest_message_bytes', sizebiggest)
+  metrics.add('copied_bytes', sizesaved)
+
+def folder_summary(filename, countnew, countlocal, countremote,
+                   sizetotal, sizebiggest, sizesaved, miwarnings, countdeleted=0, sizeleft=0,
+                   sizenew=0):
+  """The line telling what was done for a folder
+
+  sizenew is the size of the new messages on the server, sizetotal the bytes
+  of those downloaded."""
+  if(countnew == 0 and sizetotal == 0):
+    sizetotal = sizenew = "-"
+  else:
+    sizenew     = pretty_byte_count(sizenew)
+    sizetotal   = pretty_byte_count(sizetotal)
+
+  miwarntxt = ""
+  if(miwarnings > 0):
+    miwarntxt = " (%d warnings)" % miwarnings
+  savedtxt = ""
+  if(sizesaved > 0):
+    savedtxt = " (%s copied locally)" % pretty_byte_count(sizesaved)
+  if(countdeleted > 0):
+    savedtxt += " (%d deleted)" % countdeleted
+  if(sizeleft > 0):
+    savedtxt += " (%s left for next runs)" % pretty_byte_count(sizeleft)
+
+  part1 = "[%5d new] [local %5d/%5d remote] [%s/%s] %s" % (countnew, countlocal, countremote, sizenew, sizetotal, filename)
+  if(sizebiggest > 0):
+    part2 = " (%s for largest message)%s%s" % ( pretty_byte_count(sizebiggest), savedtxt, miwarntxt)
+  else:
+    part2 = "%s%s" % (savedtxt, miwarntxt)
+  return part1+part2
+
+
+
+def backup_worker(session, work, failures, config):
+  """Backs up the folders of the work queue until it is empty, then logs out"""
+  try:
+    while True:
+      try:
+        foldername, filename, status = work.get_nowait()
+      except Queue.Empty:
+        break
+      try:
+        submain(session, foldername, filename, config, status)
+      except SkipFolderException, e:
+        report(str(e))
+    session.server.logout()
+  except socket.error, e:
+    report("ERROR: %s" % (e))
+    failures.append(4)
+  except imaplib.IMAP4.error, e:
+    report("ERROR: %s" % (e))
+    failures.append(5)
+  except Exception:
+    # what a serial run would die of, with the same traceback
+    report(traceback.format_exc().rstrip())
+    failures.append(1)
+
+def backup_parallel(session, plan, config):
+  """Backs up the folders of the plan over a pool of connections, returns the exit status"""
+  work = Queue.Queue()
+  for folder in plan:
+    if folder['action'] == 'skip':
+      skip_folder(folder, config)
+    else:
+      work.put((folder['folder'], folder['file'], folder['status']))
+
+  sessions = [session]
+  for i in range(1, min(config['jobs'], work.qsize())):
+    sessions.append(Session(connect_and_login(config), config))
+
+  failures = []
+  workers = []
+  for session in sessions:
+    worker = threading.Thread(target=profiled,
+                              args=(config, backup_worker, session, work, failures, config))
+    worker.setDaemon(True)
+    worker.start()
+    workers.append(worker)
+  for worker in workers:
+    # join with a timeout, a plain join() would not let CTRL-C through
+    while worker.isAlive():
+      worker.join(1)
+
+  if failures:
+    return failures[0]
+  return 0
 
 def main():
   """Main entry point"""
+  config = get_config()
   try:
-    config = get_config()
-    server = connect_and_login(config)
-    names = get_names(server, config['compress'])
-    names.reverse()
+    profiled(config, backup_account, config)
+  finally:
+    config['localscans'].close()
+    config['metrics'].close()
+    dump_profiles(config)
+
+def backup_account(config):
+  """Backs up the folders of the account, exits with the status of the run"""
+  try:
+    session = Session(connect_and_login(config), config)
+    names = session.call(get_names, config)
+    config['metrics'].account.start('status')
+    statuses = session.call(get_folder_statuses, names)
+    config['metrics'].account.stop()
+    plan = plan_folders(names, statuses, config)
+    if config['plan']:
+      session.call(measure_folders, plan)
+    save_plan(plan)
+    report_plan(plan, config)
+    report_quota(session.call(get_quota), plan, config)
+    if config['plan']:
+      session.server.logout()
+      sys.exit(0)
+    config['localscans'].start([(folder['folder'], folder['file'], folder['priority'])
+                                for folder in plan if folder['action'] != 'skip'], config)
 
     #for n in range(len(names)):
     #  print n, names[n]
 
-    for name_pair in names:
-      foldername, filename = name_pair
-      
+    if config['jobs'] > 1:
+      status = backup_parallel(session, plan, config)
+      report_left(config)
+      # each summary is printed whatever the status of the others
+      disk_status = config['diskspace'].finish()
+      status = status or disk_status
+      if config['verify']:
+        verify_status = config['verification'].finish()
+        status = status or verify_status
+      sys.exit(status)
+
+    for folder in plan:
+      if folder['action'] == 'skip':
+        skip_folder(folder, config)
+        continue
       try:
-        submain(server, foldername, filename, config)
+        submain(session, folder['folder'], folder['file'], config, folder['status'])
       except SkipFolderException, e:
-        print e
+        report(str(e))
     
     #print "Disconnecting"
-    server.logout()
+    session.server.logout()
+    report_left(config)
+    status = config['diskspace'].finish()
+    if config['verify']:
+      verify_status = config['verification'].finish()
+      status = status or verify_status
+    sys.exit(status)
   except socket.error, e:
     (err, desc) = e
     print "ERROR: %s %s" % (err, desc)
@@ -0,0 +1,737 @@
+#!/usr/bin/env python
+
+"""Benchmarks for imapbackup.py"""
+
+# imapbench mbox FILE   writes a synthetic mbox, as big as wanted
+# imapbench scan FILE   times each way of scanning a mbox for Message-Ids
+# imapbench backup DIR  times backups into DIR from a fake IMAP server, run
+#                       in this process with made up folders and messages
+import os, re, sys, time, getopt, random, select, socket, resource, mailbox
+import itertools, threading, multiprocessing, zlib
+import imapbackup
+
+BENCH_DATE = '01-Jan-2018 00:00:00 +0000' # INTERNALDATE of every fake message
+PHASES = ['remote scan', 'local scan', 'download']
+VOCABULARY = 5000 # Made up words bodies are written with
+ATTACHMENT_RATIO = 0.3 # Part of the bodies carrying a base64 attachment
+
+def print_usage():
+  """Prints usage, exits"""
+  print "Usage: imapbench [OPTIONS] mbox FILE"
+  print "       imapbench [OPTIONS] scan FILE"
+  print "       imapbench [OPTIONS] backup DIR [-- IMAPBACKUP OPTIONS]"
+  print "\nmbox: generates a synthetic mbox file"
+  print " --size=BYTES              Size of the mbox file. (2G)"
+  print " --message-size=BYTES      Median message size. (20K)"
+  print " --no-id-ratio=RATIO       Part of the messages without Message-Id. (0.02)"
+  print " --folded-ratio=RATIO      Part of the Message-Ids folded, Exchange style. (0.1)"
+  print "\nscan: compares the ways of scanning a mbox for Message-Ids"
+  print " --no-legacy               Skip the (slow) rfc822/PortableUnixMailbox parser."
+  print "\nbackup: times a full backup into DIR, a run finding nothing new, a run after"
+  print "new messages came and a run without the .state files, which scans DIR"
+  print "again.  Messages are made up as for mbox, with the same options."
+  print " --folders=N               Number of folders of the fake server. (4)"
+  print " --messages=N              Number of messages per folder. (1000)"
+  print " --new-ratio=RATIO         Messages added to each folder before the third run,"
+  print "                           as a part of its messages. (0.05)"
+  print " --latency=SECONDS         Delay of the fake server before answering, once per"
+  print "                           round trip, however many commands came at once. (0)"
+  print " --capabilities=CAPS       CAPABILITY of the fake server. (IMAP4rev1 UIDPLUS)"
+  print "                           COMPRESS=DEFLATE compresses what it sends,"
+  print "                           LIST-STATUS and STATUS=SIZE are supported too."
+  print " --engine                  Time imapengine.py instead of imapbackup.py."
+  print " --verbose                 Show the output of the backups."
+  print "The options after -- are given to the backups, eg. -- -j 4 --store=maildir"
+  sys.exit(2)
+
+def make_bodies(rnd, message_size, eol="\n"):
+  """A pool of bodies, sizes log-normally spread around message_size
+
+  Made up text, words drawn more or less often like in a language, and some
+  base64 attachments of random data, for COMPRESS=DEFLATE to do about as
+  well as on real mail."""
+  words = make_words(rnd)
+  bodies = []
+  for i in range(64):
+    length = int(rnd.lognormvariate(0, 1) * message_size)
+    if rnd.random() < ATTACHMENT_RATIO:
+      text = make_text(rnd, words, min(length, rnd.randint(200, 2000)), eol)
+      body = make_attachment(rnd, text, length - len(text), eol)
+    else:
+      body = make_text(rnd, words, length, eol)
+    bodies.append(body)
+  return bodies
+
+def make_words(rnd):
+  """The made up words of make_text(), some letters more frequent than others"""
+  letters = 'eeeeeeeeeeeettttttttaaaaaaaooooooiiiiiiinnnnnnnsssssshhhhhhrrrrrrddddllllcccuuummwwffggyyppbbvk'
+  return [''.join([rnd.choice(letters) for j in range(rnd.randint(1, 10))])
+          for i in range(VOCABULARY)]
+
+def make_text(rnd, words, length, eol):
+  """About length bytes of text in lines of up to 72 characters
+
+  The n-th word of words comes about 1/n as often as the first one."""
+  lines = []
+  line = []
+  size = width = 0
+  while size < length:
+    word = words[int(len(words) ** rnd.random()) - 1]
+    if width + len(word) > 72:
+      lines.append(' '.join(line))
+      size += width + len(eol)
+      line, width = [], 0
+    line.append(word)
+    width += len(word) + 1
+  lines.append(' '.join(line))
+  return eol.join(lines) + eol
+
+def make_attachment(rnd, text, length, eol):
+  """A MIME body of text and about length bytes of base64 of random data"""
+  size = max(length * 3 / 4, 1)
+  data = ('%0*x' % (size * 2, rnd.getrandbits(size * 8))).decode('hex')
+  encoded = data.encode('base64').replace('\n', eol)
+  return eol.join(['--boundary', 'Content-Type: text/plain', '', text,
+                   '--boundary', 'Content-Type: application/octet-stream',
+                   'Content-Transfer-Encoding: base64', '', encoded,
+                   '--boundary--', ''])
+
+def draw_id_style(rnd, no_id_ratio, folded_ratio):
+  """How a message shows its Message-Id: None, 'folded' or 'plain'"""
+  draw = rnd.random()
+  if draw < no_id_ratio:
+    return None
+  elif draw < no_id_ratio + folded_ratio:
+    return 'folded'
+  return 'plain'
+
+def make_message(count, style, body, eol="\n"):
+  """Text of the count-th synthetic message, without mbox From_ line"""
+  headers = ["Return-Path: <sender%d@example.com>" % (count % 97),
+             "Received: from mx.example.com by imap.example.com;",
+             "\tMon, 1 Jan 2018 00:00:00 +0000",
+             "From: Sender <sender%d@example.com>" % (count % 97),
+             "To: Recipient <rcpt@example.com>",
+             "Subject: message %d" % (count)]
+  if style == 'folded':
+    headers += ["Message-ID:", " <%d.%x@exchange.example.com>" % (count, count)]
+  elif style == 'plain':
+    headers.append("Message-Id: <%d.%x@example.com>" % (count, count))
+  headers += ["Date: Mon, 1 Jan 2018 00:00:00 +0000", ""]
+  return eol.join(headers) + eol + body
+
+def generate_mbox(filename, size, message_size, no_id_ratio, folded_ratio):
+  """Writes a mbox of about size bytes, returns its number of messages"""
+  rnd = random.Random(size)
+  bodies = make_bodies(rnd, message_size)
+
+  mbox = open(filename, 'wb')
+  written = count = 0
+  try:
+    while written < size:
+      style = draw_id_style(rnd, no_id_ratio, folded_ratio)
+      text = ("From - Mon Jan  1 00:00:00 2018\n" +
+              make_message(count, style, bodies[count % len(bodies)]) + "\n")
+      mbox.write(text)
+      written += len(text)
+      count += 1
+  finally:
+    mbox.close()
+  return count
+
+def scan_legacy(filename):
+  """Message-Ids the way imapbackup got them before the index and scan_mbox()"""
+  mbox = open(filename, 'rb')
+  ids = []
+  for message in mailbox.PortableUnixMailbox(mbox):
+    header = ''.join(message.getfirstmatchingheader('message-id'))
+    ids.append(imapbackup.parse_message_id(header))
+  mbox.close()
+  return ids
+
+def scan_lines(filename):
+  """Message-Ids with scan_mbox(), reading the mbox line by line"""
+  mbox = open(filename, 'rb')
+  ids = [imapbackup.find_message_id(headers)
+         for offset, length, headers in imapbackup.scan_mbox(mbox)]
+  mbox.close()
+  return ids
+
+def scan_mmap(filename):
+  """Message-Ids with scan_mbox_mmap()"""
+  return [imapbackup.find_message_id(headers)
+          for offset, length, headers in imapbackup.scan_mbox_mmap(filename)]
+
+def run_scan(scanner, filename, results):
+  """Runs one scanner, in a process of its own to measure its peak memory"""
+  start = time.time()
+  ids = scanner(filename)
+  elapsed = time.time() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+  results.put((elapsed, peak, len(ids), hash(tuple(ids))))
+
+def bench_scan(filename, legacy):
+  """Prints the time each scanner takes on filename, checks they agree
+
+  The peak RSS of scan_mbox_mmap() counts the pages of the file it mapped,
+  which the kernel can drop at will, unlike the heap of the other scanners."""
+  size = os.path.getsize(filename)
+  scanners = [('scan_mbox_mmap', scan_mmap), ('scan_mbox', scan_lines)]
+  if legacy:
+    scanners.append(('rfc822', scan_legacy))
+
+  print "%s: %s" % (filename, imapbackup.pretty_byte_count(size))
+  digests = []
+  for name, scanner in scanners:
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_scan, args=(scanner, filename, results))
+    child.start()
+    elapsed, peak, count, digest = results.get()
+    child.join()
+    digests.append(digest)
+    print "%-16s %8.2fs %10s/s %9d msgs/s  peak RSS %s" % (name, elapsed,
+      imapbackup.pretty_byte_count(int(size / max(elapsed, 1e-6))),
+      int(count / max(elapsed, 1e-6)), imapbackup.pretty_byte_count(peak))
+
+  if len(set(digests)) != 1:
+    print "ERROR: scanners disagree on the Message-Ids"
+    return 1
+  print "%d messages, same Message-Ids from every scanner" % (count)
+  return 0
+
+class FakeError(Exception):
+  """A command the fake server answers NO to"""
+  pass
+
+class FakeFolder:
+  """A folder of the fake server, its messages only made up when fetched
+
+  UIDs are the message numbers, nothing is ever expunged."""
+
+  def __init__(self, name, bodies):
+    """FakeFolder constructor"""
+    self.name = name
+    self.bodies = bodies
+    self.messages = [] # (serial number, Message-Id style, body, size)
+
+  def add(self, rnd, count, serial, no_id_ratio, folded_ratio):
+    """Adds count messages, numbered from serial on"""
+    for i in range(serial, serial + count):
+      style = draw_id_style(rnd, no_id_ratio, folded_ratio)
+      body = self.bodies[rnd.randrange(len(self.bodies))]
+      self.messages.append((i, style, body, len(make_message(i, style, body, "\r\n"))))
+
+  def text(self, num):
+    """Text of message num"""
+    serial, style, body, size = self.messages[num-1]
+    return make_message(serial, style, body, "\r\n")
+
+  def status(self):
+    """STATUS values of the folder"""
+    return {'MESSAGES':len(self.messages), 'RECENT':0, 'UNSEEN':0,
+            'UIDNEXT':len(self.messages) + 1, 'UIDVALIDITY':1,
+            'HIGHESTMODSEQ':len(self.messages) + 1,
+            'SIZE':sum([message[3] for message in self.messages])}
+
+class FakeServer:
+  """An IMAP server on localhost, in threads of this process, counting its work"""
+
+  def __init__(self, capabilities, latency):
+    """FakeServer constructor, starts listening"""
+    self.capabilities = capabilities
+    self.latency = latency
+    self.folders = []
+    self.lock = threading.Lock()
+    self.counters = {'commands':0, 'round trips':0, 'sent':0, 'downloads':0, 'downloaded':0}
+    self.listener = socket.socket()
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(16)
+    self.port = self.listener.getsockname()[1]
+    acceptor = threading.Thread(target=self.accept)
+    acceptor.setDaemon(True)
+    acceptor.start()
+
+  def accept(self):
+    """Serves each connection in a thread of its own"""
+    while True:
+      sock, address = self.listener.accept()
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      session = threading.Thread(target=FakeSession(self, sock).run)
+      session.setDaemon(True)
+      session.start()
+
+  def find(self, name):
+    """The folder called name"""
+    for folder in self.folders:
+      if folder.name == name:
+        return folder
+    raise FakeError("no such folder: %s" % (name))
+
+  def count(self, counter, value=1):
+    """Adds value to one of the counters"""
+    self.lock.acquire()
+    try:
+      self.counters[counter] += value
+    finally:
+      self.lock.release()
+
+  def snapshot(self):
+    """A copy of the counters"""
+    self.lock.acquire()
+    try:
+      return dict(self.counters)
+    finally:
+      self.lock.release()
+
+COMMAND_RE = re.compile(r'(\S+) (?:(UID) )?(\S+) ?(.*)$')
+ARGUMENT_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+SECTION_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\]|RFC822(?!\.)', re.IGNORECASE)
+
+class FakeSession:
+  """A connection to the fake server"""
+
+  def __init__(self, server, sock):
+    """FakeSession constructor"""
+    self.server = server
+    self.sock = sock
+    self.buffer = ''
+    self.folder = None
+    self.compressing = False # once the answer to COMPRESS is sent
+    self.inflater = self.deflater = None
+
+  def recv(self):
+    """Reads what the client sent, inflated with COMPRESS=DEFLATE, None once it closed"""
+    data = self.sock.recv(65536)
+    if not data:
+      return None
+    if self.inflater is not None:
+      data = self.inflater.decompress(data)
+    return data
+
+  def sendall(self, data):
+    """Sends data, deflated with COMPRESS=DEFLATE, counting the bytes sent"""
+    if self.deflater is not None:
+      data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+    self.sock.sendall(data)
+    self.server.count('sent', len(data))
+
+  def read_line(self):
+    """Reads a line from the client, returns (line, whether it waited for us)
+
+    The client waited when it sent nothing more before this line came: its
+    next command needed an answer first, that is one more round trip."""
+    waited = False
+    while '\r\n' not in self.buffer:
+      if not select.select([self.sock], [], [], 0)[0]:
+        waited = True
+      data = self.recv()
+      if data is None:
+        return None, waited
+      self.buffer += data
+    line, self.buffer = self.buffer.split('\r\n', 1)
+    return line, waited
+
+  def read_command(self):
+    """Reads a command with its literals, returns (command, whether the client waited)"""
+    line, waited = self.read_line()
+    command = line
+    while command is not None:
+      literal = imapbackup.LITERAL_RE.search(command) or re.search(r'\{(\d+)\+\}$', command)
+      if not literal:
+        break
+      if not literal.group(0).endswith('+}'):
+        self.sendall('+ go ahead\r\n')
+      size = int(literal.group(1))
+      while len(self.buffer) < size:
+        data = self.recv()
+        if data is None:
+          return None, waited
+        self.buffer += data
+      text, self.buffer = self.buffer[:size], self.buffer[size:]
+      line, more = self.read_line()
+      if line is None:
+        return None, waited
+      command = command[:literal.start()] + '"%s"' % (text) + line
+    return command, waited
+
+  def run(self):
+    """Answers the commands of the client until it logs out"""
+    try:
+      self.send(['* OK [CAPABILITY %s] imapbench ready\r\n' % (self.server.capabilities)])
+      while True:
+        line, waited = self.read_command()
+        if line is None:
+          break
+        self.server.count('commands')
+        if waited:
+          self.server.count('round trips')
+          time.sleep(self.server.latency)
+        match = COMMAND_RE.match(line)
+        if not match:
+          self.send(['* BAD no command\r\n'])
+          continue
+        tag, uid, command, args = match.groups()
+        handler = getattr(self, 'do_' + command.lower(), None)
+        if handler is None:
+          self.send(['%s BAD unknown command\r\n' % (tag)])
+          continue
+        try:
+          # the tagged answer in the same packet, not held back by Nagle
+          self.send(itertools.chain(handler(args, uid is not None),
+                                    ['%s OK %s completed\r\n' % (tag, command.upper())]))
+        except FakeError, e:
+          self.send(['%s NO %s\r\n' % (tag, e)])
+        if command.upper() == 'LOGOUT':
+          break
+        if self.compressing and self.deflater is None:
+          self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+          self.deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    except socket.error:
+      pass
+    self.sock.close()
+
+  def send(self, responses):
+    """Sends responses, a few at a time"""
+    pending = []
+    size = 0
+    for response in responses:
+      pending.append(response)
+      size += len(response)
+      if size >= imapbackup.LITERAL_CHUNK:
+        self.sendall(''.join(pending))
+        pending = []
+        size = 0
+    if pending:
+      self.sendall(''.join(pending))
+
+  def arguments(self, args):
+    """Splits args, unquoting quoted strings"""
+    arguments = []
+    for match in ARGUMENT_RE.finditer(args):
+      if match.group(1) is not None:
+        arguments.append(re.sub(r'\\(.)', r'\1', match.group(1)))
+      else:
+        arguments.append(match.group(2))
+    return arguments
+
+  def message_numbers(self, sequence_set):
+    """Numbers of the messages of the selected folder in a sequence set"""
+    last = len(self.folder.messages)
+    ranges = imapbackup.parse_sequence_set(sequence_set.replace('*', str(last)))
+    return [num for num in range(1, last + 1) if imapbackup.in_sequence_set(ranges, num)]
+
+  def do_capability(self, args, uid):
+    return ['* CAPABILITY %s\r\n' % (self.server.capabilities)]
+
+  def do_login(self, args, uid):
+    return []
+
+  def do_noop(self, args, uid):
+    return []
+
+  do_check = do_noop
+
+  def do_logout(self, args, uid):
+    return ['* BYE logging out\r\n']
+
+  def do_compress(self, args, uid):
+    if 'COMPRESS=DEFLATE' not in self.server.capabilities.split() or args.upper() != 'DEFLATE':
+      raise FakeError("no such compression")
+    if self.compressing:
+      raise FakeError("already compressing")
+    self.compressing = True
+    return []
+
+  def do_enable(self, args, uid):
+    enabled = [name for name in args.upper().split() if name in self.server.capabilities.split()]
+    return ['* ENABLED %s\r\n' % (' '.join(enabled))]
+
+  def do_list(self, args, uid, command='LIST'):
+    # LIST-STATUS, RFC 5819
+    args, items = (args.split(' RETURN (STATUS (', 1) + [None])[:2]
+    if items is not None and 'LIST-STATUS' not in self.server.capabilities.split():
+      raise FakeError("no RETURN options")
+    if self.arguments(args)[-1] == '':
+      return ['* %s (\\Noselect) "/" ""\r\n' % (command)]
+    responses = []
+    for folder in self.server.folders:
+      responses.append('* %s (\\HasNoChildren) "/" "%s"\r\n' % (command, folder.name))
+      if items is not None:
+        responses += self.do_status('"%s" (%s' % (folder.name, items.rstrip(')') + ')'), uid)
+    return responses
+
+  def do_lsub(self, args, uid):
+    return self.do_list(args, uid, 'LSUB')
+
+  def do_select(self, args, uid):
+    self.folder = self.server.find(self.arguments(args)[0])
+    status = self.folder.status()
+    responses = ['* %d EXISTS\r\n' % (status['MESSAGES']), '* 0 RECENT\r\n',
+                 '* OK [UIDVALIDITY %d] UIDs valid\r\n' % (status['UIDVALIDITY']),
+                 '* OK [UIDNEXT %d] predicted next UID\r\n' % (status['UIDNEXT'])]
+    if 'CONDSTORE' in self.server.capabilities.split():
+      responses.append('* OK [HIGHESTMODSEQ %d] modseq\r\n' % (status['HIGHESTMODSEQ']))
+    return responses
+
+  do_examine = do_select
+
+  def do_status(self, args, uid):
+    name, items = re.match(r'("(?:[^"\\]|\\.)*"|\S+) \((.*)\)', args).groups()
+    folder = self.server.find(self.arguments(name)[0])
+    status = folder.status()
+    values = ' '.join(["%s %d" % (item, status[item]) for item in items.upper().split()])
+    return ['* STATUS "%s" (%s)\r\n' % (folder.name, values)]
+
+  def do_search(self, args, uid):
+    messages = self.folder.messages
+    found = set(range(1, len(messages) + 1))
+    tokens = args.replace('(', ' ').replace(')', ' ').split()
+    negate = False
+    while tokens:
+      key = tokens.pop(0).upper()
+      if key == 'NOT':
+        negate = not negate
+        continue
+      if key in ('ALL', 'UNDELETED'):
+        matches = range(1, len(messages) + 1)
+      elif key == 'DELETED':
+        matches = []
+      elif key in ('LARGER', 'SMALLER'):
+        size = int(tokens.pop(0))
+        matches = [num for num in range(1, len(messages) + 1)
+                   if (messages[num-1][3] > size) == (key == 'LARGER') and messages[num-1][3] != size]
+      elif key in ('SINCE', 'BEFORE', 'ON'):
+        date = time.strptime(tokens.pop(0), '%d-%b-%Y')
+        internal = time.strptime(BENCH_DATE.split()[0], '%d-%b-%Y')
+        if (key == 'SINCE' and internal >= date or key == 'BEFORE' and internal < date or
+            key == 'ON' and internal == date):
+          matches = range(1, len(messages) + 1)
+        else:
+          matches = []
+      elif key == 'UID':
+        matches = self.message_numbers(tokens.pop(0))
+      elif re.match(r'^[0-9*:,]+$', key):
+        matches = self.message_numbers(key)
+      else:
+        raise FakeError("unknown search key %s" % (key))
+      if negate:
+        found -= set(matches)
+      else:
+        found &= set(matches)
+      negate = False
+    return ['* SEARCH %s\r\n' % (' '.join([str(num) for num in sorted(found)]))]
+
+  def do_fetch(self, args, uid):
+    """Answers FETCH as a generator, one message after the other"""
+    sequence_set, items = args.split(' ', 1)
+    items = items.upper()
+    for num in self.message_numbers(sequence_set):
+      serial, style, body, size = self.folder.messages[num-1]
+      values = []
+      if uid or re.search(r'\bUID\b', items):
+        values.append("UID %d" % (num))
+      if 'RFC822.SIZE' in items:
+        values.append("RFC822.SIZE %d" % (size))
+      if 'INTERNALDATE' in items:
+        values.append('INTERNALDATE "%s"' % (BENCH_DATE))
+      if re.search(r'\bFLAGS\b', items):
+        values.append("FLAGS ()")
+      for match in SECTION_RE.finditer(items):
+        text = self.folder.text(num)
+        section = match.group(1) or ''
+        if match.group(0) == 'RFC822':
+          name = 'RFC822'
+        else:
+          name = 'BODY[%s]' % (section)
+        if section.startswith('HEADER.FIELDS'):
+          text = header_fields(text, section[len('HEADER.FIELDS'):].strip(' ()').split())
+        elif section:
+          raise FakeError("unknown section %s" % (section))
+        else:
+          self.server.count('downloads')
+          self.server.count('downloaded', len(text))
+        values.append("%s {%d}\r\n%s" % (name, len(text), text))
+      yield "* %d FETCH (%s)\r\n" % (num, ' '.join(values))
+
+def header_fields(text, names):
+  """The header lines of text for the fields called names, folded lines included"""
+  lines = []
+  keep = False
+  for line in text.split("\r\n\r\n", 1)[0].split("\r\n"):
+    if not line[:1].isspace():
+      keep = line.split(':', 1)[0].strip().upper() in names
+    if keep:
+      lines.append(line + "\r\n")
+  return ''.join(lines) + "\r\n"
+
+def timed(phases, lock, name, function):
+  """Wraps function to add the time of each of its calls to phases[name]"""
+  def timed_function(*args, **kwargs):
+    start = time.time()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      lock.acquire()
+      try:
+        phases[name] = phases.get(name, 0.0) + time.time() - start
+      finally:
+        lock.release()
+  return timed_function
+
+def run_backup(directory, argv, engine, verbose, results):
+  """Runs a backup into directory, in a process of its own for its peak memory
+
+  The phases of imapbackup.py are timed by wrapping its functions, over all
+  connections together with --jobs.  Those of imapengine.py are coroutines,
+  only its local scans are timed."""
+  os.chdir(directory)
+  if not verbose:
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+  phases = {}
+  lock = threading.Lock()
+  imapbackup.scan_folder = timed(phases, lock, 'remote scan', imapbackup.scan_folder)
+  imapbackup.download_messages = timed(phases, lock, 'download', imapbackup.download_messages)
+  imapbackup.LocalScans.result = timed(phases, lock, 'local scan', imapbackup.LocalScans.result)
+  if engine:
+    import imapengine
+    sys.argv = ['imapengine.py'] + argv
+    main = imapengine.main
+  else:
+    sys.argv = ['imapbackup.py'] + argv
+    main = imapbackup.main
+
+  status = 0
+  start = time.time()
+  try:
+    main()
+  except SystemExit, e:
+    status = e.code or 0
+  elapsed = time.time() - start
+  sys.stdout.flush()
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+  results.put((status, elapsed, peak, phases))
+
+def bench_backup(directory, folders, messages, message_size, no_id_ratio, folded_ratio,
+                 new_ratio, latency, capabilities, argv, engine, verbose):
+  """Prints what backups into directory from a fake server cost, returns 1 if one failed"""
+  if not os.path.isdir(directory):
+    os.mkdir(directory)
+  if os.listdir(directory):
+    print "ERROR: %s is not empty" % (directory)
+    return 1
+
+  rnd = random.Random(folders * messages)
+  bodies = make_bodies(rnd, message_size, "\r\n")
+  server = FakeServer(capabilities, latency)
+  serial = 0
+  for i in range(folders):
+    folder = FakeFolder(i and "Folder%d" % (i) or "INBOX", bodies)
+    folder.add(rnd, messages, serial, no_id_ratio, folded_ratio)
+    serial += messages
+    server.folders.append(folder)
+  total = sum([sum([message[3] for message in folder.messages]) for folder in server.folders])
+  print "%d folders of %d messages, %s, %.0fms latency, %s" % (folders, messages,
+    imapbackup.pretty_byte_count(total), latency * 1000, engine and "imapengine" or "imapbackup")
+
+  argv = ['-s', '127.0.0.1:%d' % (server.port), '-u', 'bench', '-p', 'bench'] + argv
+  failed = 0
+  for run in ('full', 'unchanged', 'new', 'rescan'):
+    if run == 'new':
+      for folder in server.folders:
+        count = max(1, int(messages * new_ratio))
+        folder.add(rnd, count, serial, no_id_ratio, folded_ratio)
+        serial += count
+    elif run == 'rescan':
+      for name in os.listdir(directory):
+        if name.endswith('.state'):
+          os.remove(os.path.join(directory, name))
+
+    before = server.snapshot()
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_backup,
+                                    args=(directory, argv, engine, verbose, results))
+    child.start()
+    status, elapsed, peak, phases = results.get()
+    child.join()
+    after = server.snapshot()
+    counts = dict([(name, after[name] - before[name]) for name in after])
+
+    print "%-9s %7.2fs %6d msgs %7d msgs/s %10s/s %10s sent %6d round trips %6d commands  peak RSS %s" % (
+      run, elapsed, counts['downloads'], int(counts['downloads'] / max(elapsed, 1e-6)),
+      imapbackup.pretty_byte_count(int(counts['downloaded'] / max(elapsed, 1e-6))),
+      imapbackup.pretty_byte_count(counts['sent']), counts['round trips'], counts['commands'],
+      imapbackup.pretty_byte_count(peak))
+    print "%-9s %s" % ('', '  '.join(["%s %s" % (phase, phase in phases and "%.2fs" % (phases[phase]) or "-")
+                                      for phase in PHASES]))
+    if status:
+      print "ERROR: backup exited with status %s" % (status)
+      failed = 1
+  return failed
+
+def main():
+  """Main entry point"""
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["size=", "message-size=",
+      "no-id-ratio=", "folded-ratio=", "no-legacy", "folders=", "messages=",
+      "new-ratio=", "latency=", "capabilities=", "engine", "verbose"])
+  except getopt.GetoptError:
+    print_usage()
+  if len(args) < 2 or args[0] not in ('mbox', 'scan', 'backup'):
+    print_usage()
+  if args[0] != 'backup' and len(args) != 2:
+    print_usage()
+
+  size, message_size = 2*1073741824, 20*1024
+  no_id_ratio, folded_ratio = 0.02, 0.1
+  legacy = True
+  folders, messages, new_ratio = 4, 1000, 0.05
+  latency, capabilities = 0.0, "IMAP4rev1 UIDPLUS"
+  engine = verbose = False
+  try:
+    for option, value in opts:
+      if option == "--size":
+        size = imapbackup.parse_byte_count(value)
+      elif option == "--message-size":
+        message_size = imapbackup.parse_byte_count(value)
+      elif option == "--no-id-ratio":
+        no_id_ratio = float(value)
+      elif option == "--folded-ratio":
+        folded_ratio = float(value)
+      elif option == "--no-legacy":
+        legacy = False
+      elif option == "--folders":
+        folders = int(value)
+      elif option == "--messages":
+        messages = int(value)
+      elif option == "--new-ratio":
+        new_ratio = float(value)
+      elif option == "--latency":
+        latency = float(value)
+      elif option == "--capabilities":
+        capabilities = value
+      elif option == "--engine":
+        engine = True
+      elif option == "--verbose":
+        verbose = True
+  except ValueError:
+    print_usage()
+
+  command, filename = args[:2]
+  if command == 'backup':
+    argv = args[2:]
+    if argv[:1] == ['--']:
+      argv = argv[1:]
+    sys.exit(bench_backup(filename, folders, messages, message_size, no_id_ratio,
+                          folded_ratio, new_ratio, latency, capabilities, argv, engine, verbose))
+  elif command == 'mbox':
+    start = time.time()
+    count = generate_mbox(filename, size, message_size, no_id_ratio, folded_ratio)
+    print "%s: %d messages, %s in %.1fs" % (filename, count,
+      imapbackup.pretty_byte_count(os.path.getsize(filename)), time.time() - start)
+  else:
+    sys.exit(bench_scan(filename, legacy))
+
+if __name__ == '__main__':
+  main()
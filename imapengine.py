@@ -0,0 +1,1258 @@
+#!/usr/bin/env python
+
+"""Backs up all the folders of an account at once, from a single thread"""
+
+# imapengine.py takes the same options as imapbackup.py and stores folders the
+# same way.  Instead of a thread per connection blocking in imaplib, a Loop
+# drives non-blocking connections, each folder being backed up by a coroutine:
+# a generator which yields what it waits for (a socket, a Future or another
+# coroutine) and raises Return(value) to return a value.  Commands are
+# pipelined, literals are sent without waiting when the server has LITERAL+,
+# and the disk work (scanning and writing the stores) is handed to a few
+# worker threads, so that the connections go on while files are written.
+import os, sys, re, time, errno, select, socket, ssl, threading, Queue, collections, heapq, zlib
+import imapbackup
+from imapbackup import report, SkipFolderException
+
+WRITER_THREADS = 4 # Threads doing the disk work of all folders
+WRITE_BACKLOG = 8*1024*1024 # Bytes of a folder waiting to be written to disk
+SEND_CHUNK = 64*1024 # Bytes sent at once to a connection
+MUSTQUOTE_RE = re.compile(r"[^\w!#$%&'*+,.:;<=>?^`|~-]")
+EXISTS_RE = re.compile(r'^(\d+) EXISTS$')
+
+class ImapError(Exception):
+  """Indicates a failed command or a protocol error"""
+  pass
+
+class Abort(ImapError):
+  """Indicates a connection which can't be used any more"""
+  pass
+
+# What a broken connection raises, see reconnect()
+CONNECTION_ERRORS = (socket.error, Abort)
+
+class Cancelled(Exception):
+  """Thrown into a coroutine to cancel it"""
+  pass
+
+class Return(Exception):
+  """Raised by a coroutine to return a value"""
+  def __init__(self, value=None):
+    Exception.__init__(self)
+    self.value = value
+
+class Wait:
+  """Yielded by a coroutine to wait for a socket to be readable ('r') or writable ('w')
+
+  With a timeout, socket.timeout is thrown into the coroutine once it waited
+  that many seconds."""
+  def __init__(self, sock, mode, timeout=None):
+    """Wait constructor"""
+    self.sock = sock
+    self.mode = mode
+    self.timeout = timeout
+
+class Future:
+  """Result of something done elsewhere, yielded by a coroutine to wait for it"""
+
+  def __init__(self):
+    """Future constructor"""
+    self.done = False
+    self.result = None
+    self.error = None
+    self.callbacks = []
+
+  def set(self, result=None, error=None):
+    """Completes the future, must be called from the thread of the loop"""
+    self.done = True
+    self.result, self.error = result, error
+    callbacks, self.callbacks = self.callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+class Task:
+  """A coroutine run by a Loop, with the stack of coroutines it called"""
+
+  def __init__(self, coroutine):
+    """Task constructor"""
+    self.stack = [coroutine]
+    self.future = Future()
+    self.waiting = None # socket or Future the task waits for
+    self.wakeups = 0 # counts the waits, to ignore late wakeups
+
+class Loop:
+  """Runs tasks over non-blocking sockets from a single thread
+
+  Other threads hand results back with call_soon_threadsafe(), which wakes
+  the loop up through a pipe."""
+
+  def __init__(self):
+    """Loop constructor"""
+    self.ready = collections.deque() # (task, wakeup, value, error)
+    self.timers = [] # heap of (deadline, number, future)
+    self.timer_count = 0
+    self.readers = {}
+    self.writers = {}
+    self.deadlines = {} # socket: time its wait times out
+    self.tasks = set()
+    self.lock = threading.Lock()
+    self.calls = []
+    self.wakeup_read, self.wakeup_write = os.pipe()
+
+  def spawn(self, coroutine):
+    """Starts running a coroutine, returns its Task"""
+    task = Task(coroutine)
+    self.tasks.add(task)
+    self.ready.append((task, task.wakeups, None, None))
+    return task
+
+  def cancel(self, task):
+    """Throws Cancelled into a task, where it waits"""
+    if task.future.done:
+      return
+    self.forget(task)
+    task.wakeups += 1
+    self.ready.append((task, task.wakeups, None, Cancelled()))
+
+  def cancel_all(self):
+    """Cancels every task"""
+    for task in list(self.tasks):
+      self.cancel(task)
+
+  def sleep(self, seconds):
+    """Returns a Future done once seconds have passed"""
+    future = Future()
+    self.timer_count += 1
+    heapq.heappush(self.timers, (time.time() + seconds, self.timer_count, future))
+    return future
+
+  def call_soon_threadsafe(self, function, *args):
+    """Has the loop call function(*args), may be called from any thread"""
+    self.lock.acquire()
+    try:
+      self.calls.append((function, args))
+    finally:
+      self.lock.release()
+    os.write(self.wakeup_write, 'x')
+
+  def forget(self, task):
+    """Stops watching what the task waits for"""
+    if task.waiting is not None and not isinstance(task.waiting, Future):
+      self.readers.pop(task.waiting, None)
+      self.writers.pop(task.waiting, None)
+      self.deadlines.pop(task.waiting, None)
+    task.waiting = None
+
+  def wake(self, task, wakeup, value=None, error=None):
+    """Resumes a task, unless it was resumed since it started waiting"""
+    if wakeup == task.wakeups:
+      self.forget(task)
+      task.wakeups += 1
+      self.ready.append((task, task.wakeups, value, error))
+
+  def step(self, task, value, error):
+    """Runs a task until it waits for something or ends"""
+    while True:
+      coroutine = task.stack[-1]
+      try:
+        if error is not None:
+          yielded = coroutine.throw(*error)
+        else:
+          yielded = coroutine.send(value)
+        value = error = None
+      except Return, e:
+        value, error = e.value, None
+        yielded = None
+      except StopIteration:
+        value = error = None
+        yielded = None
+      except Exception:
+        value, error = None, sys.exc_info()
+        yielded = None
+      else:
+        if hasattr(yielded, 'send') and hasattr(yielded, 'throw'):
+          # a coroutine calling another one
+          task.stack.append(yielded)
+          continue
+        if isinstance(yielded, Task):
+          yielded = yielded.future
+        if isinstance(yielded, Future):
+          if yielded.done:
+            value, error = yielded.result, yielded.error
+            continue
+          task.waiting = yielded
+          wakeup = task.wakeups
+          yielded.callbacks.append(lambda future: self.wake(task, wakeup, future.result, future.error))
+          return
+        if isinstance(yielded, Wait):
+          task.waiting = yielded.sock
+          if yielded.mode == 'r':
+            watched = self.readers
+          else:
+            watched = self.writers
+          watched[yielded.sock] = (task, task.wakeups)
+          if yielded.timeout:
+            self.deadlines[yielded.sock] = time.time() + yielded.timeout
+          return
+        error = (TypeError, TypeError("coroutine yielded %r" % (yielded,)), None)
+        continue
+
+      # the coroutine ended, return to its caller
+      task.stack.pop()
+      if not task.stack:
+        self.tasks.discard(task)
+        task.future.set(value, error)
+        return
+
+  def run(self):
+    """Runs until all tasks ended"""
+    while self.tasks:
+      while self.ready:
+        task, wakeup, value, error = self.ready.popleft()
+        if wakeup == task.wakeups and not task.future.done:
+          if error is not None and not isinstance(error, tuple):
+            error = (type(error), error, None)
+          self.step(task, value, error)
+      if not self.tasks:
+        break
+
+      timeout = 1.0
+      if self.timers:
+        timeout = min(max(self.timers[0][0] - time.time(), 0), timeout)
+      if self.deadlines:
+        timeout = min(max(min(self.deadlines.values()) - time.time(), 0), timeout)
+      readers = self.readers.keys() + [self.wakeup_read]
+      try:
+        readable, writable, broken = select.select(readers, self.writers.keys(), [], timeout)
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      while self.timers and self.timers[0][0] <= time.time():
+        heapq.heappop(self.timers)[2].set()
+      for sock in readable:
+        if sock == self.wakeup_read:
+          os.read(self.wakeup_read, 4096)
+          self.lock.acquire()
+          try:
+            calls, self.calls = self.calls, []
+          finally:
+            self.lock.release()
+          for function, args in calls:
+            function(*args)
+        elif sock in self.readers:
+          self.wake(*self.readers[sock])
+      for sock in writable:
+        if sock in self.writers:
+          self.wake(*self.writers[sock])
+      now = time.time()
+      for sock, deadline in self.deadlines.items():
+        if deadline <= now:
+          task, wakeup = self.readers.get(sock) or self.writers[sock]
+          self.wake(task, wakeup, error=socket.timeout("timed out"))
+
+class Executor:
+  """A few threads doing the blocking work of the coroutines
+
+  Work submitted with the same key is done in order, by the same thread."""
+
+  def __init__(self, loop, threads=WRITER_THREADS):
+    """Executor constructor"""
+    self.loop = loop
+    self.queues = []
+    self.workers = []
+    for i in range(threads):
+      work = Queue.Queue()
+      worker = threading.Thread(target=self.work, args=(work,))
+      worker.setDaemon(True)
+      worker.start()
+      self.queues.append(work)
+      self.workers.append(worker)
+
+  def work(self, work):
+    """Worker thread, until shutdown()"""
+    while True:
+      item = work.get()
+      if item is None:
+        return
+      future, function, args = item
+      try:
+        result, error = function(*args), None
+      except Exception:
+        result, error = None, sys.exc_info()
+      self.loop.call_soon_threadsafe(future.set, result, error)
+
+  def submit(self, key, function, *args):
+    """Has function(*args) called by a worker thread, returns a Future of its result"""
+    future = Future()
+    self.queues[hash(key) % len(self.queues)].put((future, function, args))
+    return future
+
+  def shutdown(self):
+    """Stops the worker threads once they are done with the work submitted"""
+    for work in self.queues:
+      work.put(None)
+    for worker in self.workers:
+      worker.join()
+
+class WriteQueue:
+  """Disk work of a folder, done in order, with a cap on the bytes waiting"""
+
+  def __init__(self, executor, key, metrics, limit=WRITE_BACKLOG):
+    """WriteQueue constructor, the work being timed as the 'disk write' phase of metrics"""
+    self.executor = executor
+    self.key = key
+    self.metrics = metrics
+    self.limit = limit
+    self.pending = collections.deque() # (future, size)
+    self.size = 0
+
+  def submit(self, size, function, *args):
+    """Queues function(*args), returns its Future"""
+    future = self.executor.submit(self.key, timed, self.metrics, 'disk write', function, *args)
+    self.pending.append((future, size))
+    self.size += size
+    return future
+
+  def throttle(self):
+    """Returns a Future to wait for when too many bytes are waiting, else None"""
+    while self.pending and (self.pending[0][0].done or self.size > self.limit):
+      future, size = self.pending[0]
+      if not future.done:
+        return future
+      self.pending.popleft()
+      self.size -= size
+      if future.error is not None:
+        raise future.error[0], future.error[1], future.error[2]
+    return None
+
+  def drain(self):
+    """Coroutine waiting for all the work queued"""
+    while self.pending:
+      future, size = self.pending.popleft()
+      self.size -= size
+      yield future
+
+class DeferredMessage:
+  """Stands for the MessageWriter of a message in coroutines, until it exists
+
+  The store creates the writer and writes to it in a worker thread."""
+
+  def __init__(self, queue, store, msg_id, size, throttle):
+    """DeferredMessage constructor"""
+    self.queue = queue
+    self.store = store
+    self.msg_id = msg_id
+    self.size = size
+    self.throttle = throttle
+    self.writer = None
+    queue.submit(0, self.start, msg_id, size)
+
+  def start(self, msg_id, size):
+    """Starts the message, in a worker thread"""
+    self.writer = self.store.start(msg_id, size)
+
+  def write(self, data):
+    """Queues a chunk of the message, returns a Future to wait for if too much is queued
+
+    or if reading on would go over the rate of the throttle."""
+    self.queue.submit(len(data), self.writer_write, data)
+    pause = self.throttle.delay(len(data))
+    if pause > 0:
+      return self.queue.executor.loop.sleep(pause)
+    return self.queue.throttle()
+
+  def writer_write(self, data):
+    """Writes a chunk of the message, in a worker thread"""
+    self.writer.write(data)
+
+  def finish(self, sums, uid, date):
+    """Queues the end of the message and its record in sums, returns a Future of its size"""
+    return self.queue.submit(0, self.finish_writer, sums, uid, date)
+
+  def finish_writer(self, sums, uid, date):
+    """Ends the message, in a worker thread"""
+    size = self.store.finish(self.writer)
+    sums.add(uid, self.size, date, self.writer, self.msg_id)
+    return size
+
+def timed(metrics, phase, function, *args):
+  """Calls function(*args), in a worker thread, adding the time it takes to phase of metrics"""
+  start = time.time()
+  try:
+    return function(*args)
+  finally:
+    metrics.charge(phase, time.time() - start)
+
+def quote_argument(arg):
+  """Quotes a command argument the way imaplib does"""
+  if len(arg) >= 2 and (arg[0], arg[-1]) in (('(', ')'), ('"', '"')):
+    return arg
+  if arg and MUSTQUOTE_RE.search(arg) is None:
+    return arg
+  return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+class Literal:
+  """A command argument sent as a literal"""
+  def __init__(self, data):
+    """Literal constructor"""
+    self.data = data
+
+class Connection:
+  """A non-blocking IMAP connection, plain or over SSL, used by coroutines"""
+
+  def __init__(self, executor, config):
+    """Connection constructor"""
+    self.executor = executor
+    self.config = config
+    self.sock = None
+    self.buffer = ''
+    self.tags = 0
+    self.capabilities = ()
+    self.qresync = False
+    self.metrics = config['metrics'].account # those of the folder being backed up
+    self.sending = False # since the last read, see imapbackup.count_traffic()
+    self.inflater = self.deflater = None # with COMPRESS=DEFLATE, see imapbackup.Deflate
+
+  def connect(self):
+    """Coroutine connecting to the server, up to its greeting"""
+    config = self.config
+    addresses = yield self.executor.submit('dns', socket.getaddrinfo, config['server'],
+                                           config['port'], 0, socket.SOCK_STREAM)
+    family, socktype, proto, name, address = addresses[0]
+    sock = socket.socket(family, socktype, proto)
+    # before connecting, for the TCP window to be scaled to --rcvbuf
+    imapbackup.tweaksocket(sock, config)
+    sock.setblocking(0)
+    status = sock.connect_ex(address)
+    if status not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      raise socket.error(status, os.strerror(status))
+    yield Wait(sock, 'w', config['timeout'])
+    status = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if status:
+      raise socket.error(status, os.strerror(status))
+    self.sock = sock
+
+    if config['usessl']:
+      self.sock = ssl.wrap_socket(sock, config.get('keyfilename'), config.get('certfilename'),
+                                  do_handshake_on_connect=False)
+      while True:
+        try:
+          self.sock.do_handshake()
+          break
+        except ssl.SSLError, e:
+          if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+            yield self.wait('r')
+          elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+            yield self.wait('w')
+          else:
+            raise
+
+    greeting = yield self.readline()
+    if not (greeting.startswith('* OK') or greeting.startswith('* PREAUTH')):
+      raise Abort("unexpected greeting: %s" % (greeting))
+
+  def wait(self, mode):
+    """A Wait for the socket, the connection being broken after --timeout seconds"""
+    return Wait(self.sock, mode, self.config['timeout'])
+
+  def fill(self):
+    """Coroutine reading more data into the buffer"""
+    if self.inflater is not None and self.inflater.unconsumed_tail:
+      self.inflate(self.inflater.unconsumed_tail)
+      return
+    started = time.time()
+    while True:
+      try:
+        data = self.sock.recv(self.config['readchunk'])
+      except ssl.SSLError, e:
+        if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+          yield self.wait('r')
+          continue
+        elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+          yield self.wait('w')
+          continue
+        raise
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          yield self.wait('r')
+          continue
+        raise
+      if not data:
+        raise Abort("connection closed by the server")
+      if self.sending:
+        self.sending = False
+        self.metrics.add('round_trips')
+      if self.inflater is not None:
+        # waited for along with the other connections of the loop
+        self.metrics.add('compressed_read_microseconds', int((time.time() - started) * 1e6))
+        self.metrics.add('compressed_bytes', len(data))
+        self.inflate(data)
+        return
+      self.metrics.add('received_bytes', len(data))
+      self.buffer += data
+      return
+
+  def inflate(self, data):
+    """Inflates compressed data into the buffer, a read chunk of it at most"""
+    started = time.time()
+    try:
+      text = self.inflater.decompress(data, self.config['readchunk'])
+    except zlib.error, e:
+      raise Abort("COMPRESS=DEFLATE: %s" % (e))
+    self.metrics.add('inflate_microseconds', int((time.time() - started) * 1e6))
+    self.metrics.add('inflated_bytes', len(text))
+    self.metrics.add('received_bytes', len(text))
+    self.buffer += text
+
+  def readline(self):
+    """Coroutine returning the next line, without its CRLF"""
+    searched = 0
+    while True:
+      end = self.buffer.find('\r\n', searched)
+      if end >= 0:
+        line, self.buffer = self.buffer[:end], self.buffer[end+2:]
+        raise Return(line)
+      searched = max(len(self.buffer) - 1, 0)
+      yield self.fill()
+
+  def read(self, size, sink=None):
+    """Coroutine returning the next size bytes, or writing them to sink as they come"""
+    chunks = []
+    while size > 0:
+      if not self.buffer:
+        yield self.fill()
+      data, self.buffer = self.buffer[:size], self.buffer[size:]
+      size -= len(data)
+      if sink is None:
+        chunks.append(data)
+      else:
+        future = sink.write(data)
+        if future is not None:
+          yield future
+    raise Return(''.join(chunks))
+
+  def send(self, data):
+    """Coroutine sending data"""
+    self.sending = True
+    self.metrics.add('sent_bytes', len(data))
+    if self.deflater is not None:
+      data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+    while data:
+      try:
+        sent = self.sock.send(data[:SEND_CHUNK])
+      except ssl.SSLError, e:
+        if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+          yield self.wait('r')
+          continue
+        elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+          yield self.wait('w')
+          continue
+        raise
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          yield self.wait('w')
+          continue
+        raise
+      data = data[sent:]
+
+  def command(self, name, *args):
+    """Coroutine sending a command, returns its tag without waiting for its completion
+
+    Literal arguments are sent right away with LITERAL+, otherwise once the
+    server asked for them, which requires no other command to be in flight."""
+    self.tags += 1
+    tag = 'E%d' % (self.tags)
+    line = '%s %s' % (tag, name)
+    for arg in args:
+      if not isinstance(arg, Literal):
+        line += ' ' + arg
+      elif 'LITERAL+' in self.capabilities:
+        line += ' {%d+}\r\n%s' % (len(arg.data), arg.data)
+      else:
+        yield self.send(line + ' {%d}\r\n' % (len(arg.data)))
+        while True:
+          tagged, parts = yield self.response()
+          if tagged == '+':
+            break
+          if tagged == tag:
+            raise ImapError("%s failed: %s" % (name, parts[0]))
+        line = arg.data
+    yield self.send(line + '\r\n')
+    raise Return(tag)
+
+  def response(self, stream=None):
+    """Coroutine reading the next response, returns (tag, parts)
+
+    tag is '*' for untagged responses and '+' for continuation requests.
+    parts are like in the data imaplib returns, strings and (text, literal)
+    tuples, the text of the first one without its tag.  When a literal
+    comes, stream(parts), parts being the response so far with an empty
+    literal, may return a file-like object for the literal to be written to,
+    which then stands for the literal in parts."""
+    line = yield self.readline()
+    tag, text = (line.split(' ', 1) + [''])[:2]
+    parts = []
+    while True:
+      match = imapbackup.LITERAL_RE.search(text)
+      if match is None:
+        parts.append(text)
+        break
+      size = int(match.group(1))
+      sink = None
+      if stream is not None:
+        sink = stream(parts + [(text, '')])
+      if sink is None:
+        literal = yield self.read(size)
+      else:
+        yield self.read(size, sink)
+        literal = sink
+      parts.append((text, literal))
+      text = yield self.readline()
+    if tag == '*' and text.startswith('BYE') and len(parts) == 1:
+      raise Abort(text)
+    raise Return((tag, parts))
+
+  def simple(self, name, *args):
+    """Coroutine running a command, returns its untagged responses
+
+    Raises ImapError if the command fails."""
+    tag = yield self.command(name, *args)
+    untagged = []
+    while True:
+      tagged, parts = yield self.response()
+      if tagged == tag:
+        if not parts[0].startswith('OK'):
+          raise ImapError("%s failed: %s" % (name, parts[0]))
+        raise Return(untagged)
+      if tagged == '*':
+        untagged.append(parts)
+
+  def login(self):
+    """Coroutine logging in, returns once capabilities are known"""
+    yield self.update_capabilities()
+    args = []
+    for arg in (self.config['user'], self.config['pass']):
+      if '\r' in arg or '\n' in arg or [c for c in arg if ord(c) > 127]:
+        args.append(Literal(arg))
+      else:
+        args.append(quote_argument(arg))
+    yield self.simple('LOGIN', *args)
+    # servers tell more once logged in
+    yield self.update_capabilities()
+    if 'QRESYNC' in self.capabilities:
+      try:
+        yield self.simple('ENABLE', 'QRESYNC')
+        self.qresync = True
+      except ImapError:
+        pass
+    if self.config['deflate'] and 'COMPRESS=DEFLATE' in self.capabilities:
+      try:
+        yield self.simple('COMPRESS', 'DEFLATE')
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.deflater = zlib.compressobj(imapbackup.DEFLATE_LEVEL, zlib.DEFLATED,
+                                         -zlib.MAX_WBITS)
+      except ImapError:
+        pass
+
+  def update_capabilities(self):
+    """Coroutine asking for the CAPABILITY of the server"""
+    for parts in (yield self.simple('CAPABILITY')):
+      if parts[0].upper().startswith('CAPABILITY'):
+        self.capabilities = tuple(parts[0].upper().split()[1:])
+
+  def close(self):
+    """Coroutine logging out, and closing the connection"""
+    try:
+      yield self.simple('LOGOUT')
+    except (ImapError, socket.error):
+      pass
+    self.sock.close()
+
+def fetch_parts(parts):
+  """Makes the parts of a FETCH response look like those parse_fetch_response() takes"""
+  first = parts[0]
+  if isinstance(first, tuple):
+    return [(first[0].replace(' FETCH (', ' (', 1), first[1])] + parts[1:]
+  return [first.replace(' FETCH (', ' (', 1)] + parts[1:]
+
+def is_fetch(parts):
+  """Tells whether the parts of an untagged response are those of a FETCH"""
+  first = parts[0]
+  if isinstance(first, tuple):
+    first = first[0]
+  return ' FETCH (' in first
+
+def fetch(conn, msgsets, items, on_message, use_uid=False, stream=None,
+          pipeline=imapbackup.FETCH_PIPELINE):
+  """Coroutine issuing one FETCH per message set, keeping several of them in flight
+
+  Calls on_message(num, attrs) for each message as soon as its response has
+  been read, waiting for the Future it may return.  stream(num, attrs) may return a file-like object for the
+  literal of a message, see Connection.response().  Like
+  imapbackup.fetch_pipelined(), the answers to the FETCHes in flight when
+  one fails are read before SkipFolderException is raised."""
+  command = use_uid and 'UID FETCH' or 'FETCH'
+  pending = list(msgsets)
+  inflight = {}
+  failure = []
+
+  def stream_parts(parts):
+    """Streams a literal, once the message it belongs to is known"""
+    if failure or not is_fetch(parts):
+      return None
+    num, attrs = imapbackup.parse_fetch_response(fetch_parts(parts)).items()[0]
+    return stream(num, attrs)
+
+  while pending or inflight:
+    # keep the pipeline full
+    while pending and len(inflight) < pipeline:
+      msgset = pending.pop(0)
+      tag = yield conn.command(command, msgset, items)
+      inflight[tag] = msgset
+
+    tag, parts = yield conn.response(stream and stream_parts)
+    if tag in inflight:
+      # tagged completion of one of the commands in flight
+      msgset = inflight.pop(tag)
+      if not parts[0].startswith('OK') and not failure:
+        failure.append("FETCH %s failed: %s" % (msgset, parts[0]))
+        pending = []
+    elif failure:
+      # the folder is skipped, what is still coming is only read
+      continue
+    elif tag == '*' and is_fetch(parts):
+      for num, attrs in imapbackup.parse_fetch_response(fetch_parts(parts)).items():
+        waited = on_message(num, attrs)
+        if waited is not None:
+          yield waited
+  if failure:
+    raise SkipFolderException(failure[0])
+
+def get_folder_status(conn, foldername):
+  """Coroutine getting the STATUS values of a folder, returns {item: Integer} dict"""
+  try:
+    untagged = yield conn.simple('STATUS', quote_argument(foldername),
+                                 imapbackup.status_items(conn.capabilities))
+  except ImapError, e:
+    raise SkipFolderException("STATUS failed: %s" % (e))
+  raise Return(imapbackup.parse_status(untagged[-1][0]))
+
+def get_folder_statuses(conn, names):
+  """Coroutine getting the STATUS of all folders at once, returns {foldername: status}
+
+  Like imapbackup.get_folder_statuses(), with LIST-STATUS when the server
+  has it.  Folders whose STATUS fails are left out, see imapbackup.plan_folders()."""
+  items = imapbackup.status_items(conn.capabilities)
+  statuses = {}
+  if 'LIST-STATUS' in conn.capabilities:
+    try:
+      untagged = yield conn.simple('LIST', '""', '"*"', 'RETURN', '(STATUS %s)' % (items))
+    except ImapError:
+      untagged = []
+    for parts in untagged:
+      # names sent as literals are asked for again below
+      if isinstance(parts[0], str) and parts[0].startswith('STATUS '):
+        foldername, status = imapbackup.parse_named_status(parts[0][len('STATUS '):])
+        statuses[foldername] = status
+
+  tags = {}
+  for foldername, filename, priority in names:
+    if foldername not in statuses:
+      tag = yield conn.command('STATUS', quote_argument(foldername), items)
+      tags[tag] = foldername
+  responses = []
+  while tags:
+    tag, parts = yield conn.response()
+    text = isinstance(parts[0], tuple) and parts[0][0] or parts[0]
+    if tag == '*' and text.startswith('STATUS'):
+      # the values follow the folder name, even sent as a literal
+      responses.append(parts[-1])
+    elif tag in tags:
+      foldername = tags.pop(tag)
+      if parts[0].startswith('OK') and responses:
+        statuses[foldername] = imapbackup.parse_status(responses[-1])
+      else:
+        report("STATUS %s failed: %s" % (foldername, parts[0]))
+      responses = []
+  raise Return(statuses)
+
+def get_quota(conn):
+  """Coroutine getting the STORAGE quota of INBOX, like imapbackup.get_quota()"""
+  if 'QUOTA' not in conn.capabilities:
+    raise Return(None)
+  try:
+    untagged = yield conn.simple('GETQUOTAROOT', 'INBOX')
+  except ImapError:
+    raise Return(None)
+  raise Return(imapbackup.parse_quota([parts[0] for parts in untagged
+                                       if isinstance(parts[0], str) and parts[0].startswith('QUOTA ')]))
+
+def measure_folders(conn, plan):
+  """Coroutine adding up the RFC822.SIZE of the messages of the folders of unknown size
+
+  Like imapbackup.measure_folders(), the FETCH commands of a folder pipelined."""
+  for folder in plan:
+    if folder['size'] is not None:
+      continue
+    try:
+      untagged = yield conn.simple('EXAMINE', quote_argument(folder['folder']))
+    except ImapError, e:
+      report("SELECT failed: %s" % (e))
+      continue
+    num_msgs = 0
+    for parts in untagged:
+      match = EXISTS_RE.match(parts[0])
+      if match:
+        num_msgs = int(match.group(1))
+    sizes = []
+    def measured(num, attrs):
+      """Counts the size of a message"""
+      sizes.append(attrs.get('RFC822.SIZE', 0))
+    try:
+      yield fetch(conn, imapbackup.scan_sequence_sets(num_msgs, imapbackup.SCAN_CHUNK),
+                  '(RFC822.SIZE)', measured)
+      folder['size'] = sum(sizes)
+    except SkipFolderException, e:
+      report(str(e))
+
+def scan_folder(conn, foldername, chunk=imapbackup.SCAN_CHUNK, since_uid=None,
+                qresync=None, vanished=None, criteria=None):
+  """Coroutine getting the IDs of messages in a folder, returns id:(num, uid, size) dict
+
+  Like imapbackup.scan_folder(), with the FETCH commands pipelined."""
+  args = [quote_argument(foldername)]
+  if qresync is not None:
+    args.append('(QRESYNC (%d %d))' % qresync)
+  conn.metrics.start('select')
+  try:
+    untagged = yield conn.simple('EXAMINE', *args)
+  except ImapError, e:
+    raise SkipFolderException("SELECT failed: %s" % (e))
+  conn.metrics.stop()
+  num_msgs = 0
+  for parts in untagged:
+    match = EXISTS_RE.match(parts[0])
+    if match:
+      num_msgs = int(match.group(1))
+    elif parts[0].upper().startswith('VANISHED '):
+      vanished.extend(imapbackup.parse_sequence_set(parts[0].split()[-1]))
+
+  if criteria is not None and num_msgs:
+    # let the server pick the messages
+    try:
+      untagged = yield conn.simple('UID SEARCH', imapbackup.search_keys(criteria, since_uid))
+    except ImapError, e:
+      raise SkipFolderException("SEARCH failed: %s" % (e))
+    uids = []
+    for parts in untagged:
+      if parts[0].upper().startswith('SEARCH'):
+        uids.extend([int(uid) for uid in parts[0].split()[1:]])
+    msgsets, use_uid = imapbackup.search_sequence_sets(uids, chunk, since_uid), True
+  else:
+    msgsets = imapbackup.scan_sequence_sets(num_msgs, chunk, since_uid)
+    use_uid = since_uid is not None
+
+  messages = {}
+  missing = []
+  def scanned(num, attrs):
+    """Adds a scanned message"""
+    imapbackup.add_scanned_messages(messages, missing, {num: attrs}, since_uid)
+  yield fetch(conn, msgsets, imapbackup.SCAN_ITEMS, scanned, use_uid)
+
+  # Some messages may have no Message-Id, so we'll synthesise one
+  batches = [dict(missing[first:first+chunk]) for first in range(0, len(missing), chunk)]
+  fetched = {}
+  def synthesized(num, attrs):
+    """Collects the headers a Message-Id is made from"""
+    fetched[num] = attrs
+  yield fetch(conn, [imapbackup.make_sequence_set(sorted(batch.keys())) for batch in batches],
+              imapbackup.SYNTHESIS_ITEMS, synthesized)
+  for batch in batches:
+    msgset = imapbackup.make_sequence_set(sorted(batch.keys()))
+    imapbackup.add_synthesized_ids(messages, batch, fetched, msgset)
+  raise Return(messages)
+
+def record_deletions(conn, state, status, fol_messages, qresync, vanished, criteria=None):
+  """Coroutine moving the UIDs expunged from the folder to state['deleted'], returns their number
+
+  Like imapbackup.record_deletions()."""
+  arrived = None
+  if qresync is None and criteria is not None:
+    try:
+      untagged = yield conn.simple('UID SEARCH', 'UID %d:*' % (state['uidnext']))
+    except ImapError, e:
+      raise SkipFolderException("SEARCH failed: %s" % (e))
+    arrived = imapbackup.count_arrived([parts[0][len('SEARCH'):] for parts in untagged
+                                        if parts[0].upper().startswith('SEARCH')], state)
+  if qresync is not None:
+    gone = [uid for uid in state['ids'] if imapbackup.in_sequence_set(vanished, uid)]
+  elif imapbackup.expunged_since(state, status, fol_messages, arrived):
+    try:
+      untagged = yield conn.simple('UID SEARCH', 'ALL')
+    except ImapError, e:
+      raise SkipFolderException("SEARCH failed: %s" % (e))
+    left = set()
+    for parts in untagged:
+      if parts[0].upper().startswith('SEARCH'):
+        left.update([int(uid) for uid in parts[0].split()[1:]])
+    gone = [uid for uid in state['ids'] if uid not in left]
+  else:
+    gone = []
+  raise Return(imapbackup.move_deleted(state, gone))
+
+def reuse_messages(store, sums, messages):
+  """Stores the messages the store has copies of, recording them in sums, returns (the others, bytes saved)"""
+  wanted = {}
+  saved = 0
+  for msg_id, (num, uid, size) in messages.items():
+    if store.reuse(msg_id, size, sums, uid):
+      saved += size or 0
+    else:
+      wanted[msg_id] = (num, uid, size)
+  return wanted, saved
+
+def store_message(store, sums, uid, date, msg_id, size, text):
+  """Stores a message read whole in memory and records it in sums, returns its size"""
+  writer = store.start(msg_id, size)
+  writer.write(text)
+  stored = store.finish(writer)
+  sums.add(uid, size, date, writer, msg_id)
+  return stored
+
+def download_messages(conn, executor, store, sums, messages, config):
+  """Coroutine downloading messages from the folder to its store, recording them in sums
+
+  Like imapbackup.download_messages(), the store working in a worker thread."""
+  if not messages and not config['overwrite']:
+    raise Return((0, 0, 0, {}))
+
+  throttle = config['throttle']
+  checkpoints = imapbackup.Checkpoints()
+  queue = WriteQueue(executor, store.filename, conn.metrics)
+  yield queue.submit(0, store.open)
+  yield queue.submit(0, sums.open, config['overwrite'])
+  conn.metrics.start('fetch')
+  try:
+    messages, saved = yield queue.submit(0, reuse_messages, store, sums, messages)
+
+    # address messages by UID when the server gave us one, by number otherwise
+    use_uid = None not in [uid for num, uid, size in messages.values()]
+    wanted = {}
+    for msg_id, (num, uid, size) in messages.items():
+      wanted[use_uid and uid or num] = (msg_id, size)
+    keys, later = imapbackup.schedule_downloads(wanted, config['order'], throttle)
+    left = {}
+    for key in later:
+      msg_id, size = wanted.pop(key)
+      left[msg_id] = messages[msg_id]
+      throttle.leave(size or 0)
+    finished = []
+
+    def stream(num, attrs):
+      """Starts writing a message as soon as it is known which one it is"""
+      key = use_uid and attrs.get('UID') or num
+      if key not in wanted:
+        return None
+      msg_id, size = wanted[key]
+      return DeferredMessage(queue, store, msg_id, size, throttle)
+
+    def fetched(num, attrs):
+      """Ends writing a message, returns a Future to wait for if going over the rate"""
+      key = use_uid and attrs.get('UID') or num
+      if key not in wanted or 'BODY' not in attrs:
+        return
+      msg_id, size = wanted.pop(key)
+      uid, date = messages[msg_id][1], attrs.get('INTERNALDATE')
+      conn.metrics.add('downloaded_messages')
+      pause = 0
+      if isinstance(attrs['BODY'], DeferredMessage):
+        finished.append(attrs['BODY'].finish(sums, uid, date))
+      else:
+        # the UID came after the message, which had to be read in memory
+        pause = throttle.delay(len(attrs['BODY']))
+        finished.append(queue.submit(len(attrs['BODY']), store_message,
+                                     store, sums, uid, date, msg_id, size, attrs['BODY']))
+      if checkpoints.due(size or 0):
+        queue.submit(0, store.checkpoint)
+        queue.submit(0, sums.checkpoint)
+      if pause > 0:
+        return executor.loop.sleep(pause)
+
+    batches = imapbackup.make_fetch_batches(dict([(key, wanted[key][1]) for key in wanted]),
+                                            config['inflight'], imapbackup.FETCH_PIPELINE, keys)
+    yield fetch(conn, [imapbackup.make_sequence_set(batch) for batch in batches],
+                imapbackup.DOWNLOAD_ITEMS, fetched, use_uid, stream)
+    conn.metrics.stop()
+    yield queue.drain()
+  finally:
+    # whatever happened, the store is closed once its writes are done
+    try:
+      yield queue.drain()
+    finally:
+      try:
+        yield queue.submit(0, store.close)
+      finally:
+        yield queue.submit(0, sums.close)
+
+  sizes = [future.result for future in finished]
+  raise Return((sum(sizes), max(sizes + [0]), saved, left))
+
+def backup_folder(conn, executor, foldername, filename, config, status=None):
+  """Coroutine backing up one folder into filename, prints a summary line
+
+  Like imapbackup.submain(), the local scan of the folder running in a
+  worker thread while the server is scanned."""
+  metrics = conn.metrics
+  store = imapbackup.open_store(filename, config)
+  metrics.start('local scan')
+  state = imapbackup.previous_state(store, filename, config)
+  metrics.stop()
+  if status is None:
+    metrics.start('status')
+    status = yield get_folder_status(conn, foldername)
+    metrics.stop()
+
+  if state and imapbackup.folder_unchanged(state, status):
+    # nothing came or went since last run
+    report(imapbackup.folder_summary(filename, 0, state['local'], status['messages'], 0, 0, 0, 0))
+    return
+
+  if state and state.get('uidvalidity') == status['uidvalidity']:
+    # only look at messages which arrived since last run
+    metrics.start('local scan')
+    state = yield executor.submit(filename, imapbackup.load_state, filename)
+    metrics.stop()
+    qresync, vanished = imapbackup.qresync_since(conn, state), []
+    since, size = imapbackup.resume_point(state)
+    metrics.start('id scan')
+    fol_messages = yield scan_folder(conn, foldername, config['scanchunk'], since,
+                                     qresync, vanished, imapbackup.search_criteria(config))
+    countdeleted = yield record_deletions(conn, state, status, fol_messages, qresync, vanished,
+                                          imapbackup.search_criteria(config))
+    metrics.stop()
+    fil_messages, miwarnings = imapbackup.IdSet(state['ids'].values() + state['deleted'].values()), 0
+    countremote = status['messages']
+    countlocal = len(fil_messages)
+    # those past the resume point may be stored already
+    countnew = len(fil_messages.missing(fol_messages))
+    if size is not None and not countdeleted:
+      size += imapbackup.messages_size(fol_messages)
+    else:
+      size = None
+  else:
+    state = {'ids':{}, 'deleted':{}, 'filter':imapbackup.filter_key(config)}
+    local = executor.submit(filename, timed, metrics, 'local scan', config['localscans'].result, store)
+    metrics.start('id scan')
+    fol_messages = yield scan_folder(conn, foldername, config['scanchunk'],
+                                     criteria=imapbackup.search_criteria(config))
+    metrics.stop()
+    fil_messages, miwarnings = yield local
+    countremote = len(fol_messages)
+    countlocal = len(fil_messages)
+    countnew = countremote - countlocal
+    countdeleted = 0
+    size = None
+    if imapbackup.search_criteria(config) is None:
+      size = imapbackup.messages_size(fol_messages)
+  status = imapbackup.sized_status(status, state, size)
+
+  new_messages = imapbackup.find_new_messages(fol_messages, fil_messages)
+
+  needed = imapbackup.disk_needed(new_messages, config)
+  if not config['diskspace'].reserve(filename, needed):
+    raise SkipFolderException("Not enough disk space: %s not downloaded, %s needed" % (
+                              filename, imapbackup.pretty_byte_count(needed)))
+  sums = imapbackup.Sums(filename, status['uidvalidity'])
+  try:
+    sizetotal, sizebiggest, sizesaved, left = yield download_messages(conn, executor, store, sums,
+                                                                      new_messages, config)
+  except CONNECTION_ERRORS:
+    error = sys.exc_info()
+    yield executor.submit(filename, imapbackup.save_stored, store, filename, state, status,
+                          fol_messages, new_messages, countlocal)
+    raise error[0], error[1], error[2]
+  finally:
+    config['diskspace'].release(needed)
+  metrics.start('disk write')
+  yield executor.submit(filename, imapbackup.update_state, store, filename, state, status,
+                        fol_messages, countlocal + len(new_messages) - len(left), left)
+  metrics.stop()
+  sizenew = sum([size or 0 for num, uid, size in new_messages.values()])
+  imapbackup.count_folder(metrics, countnew, sizetotal, sizebiggest, sizesaved)
+  report(imapbackup.folder_summary(filename, countnew, countlocal, countremote,
+                                   sizetotal, sizebiggest, sizesaved, miwarnings, countdeleted,
+                                   sum([size or 0 for num, uid, size in left.values()]), sizenew))
+
+def backup_worker(conn, executor, work, config):
+  """Coroutine backing up the folders of the work list until it is empty, then logging out
+
+  A folder whose connection broke is backed up again over a new one, see
+  reconnect(), going on from the messages stored."""
+  try:
+    while work:
+      foldername, filename, status = work.pop(0)
+      metrics = imapbackup.Metrics(foldername, filename)
+      conn.metrics = metrics
+      tries = 0
+      try:
+        while True:
+          try:
+            yield backup_folder(conn, executor, foldername, filename, config, status)
+            break
+          except CONNECTION_ERRORS, e:
+            conn, tries = yield reconnect(conn, executor, config, e, tries)
+      except SkipFolderException, e:
+        report(str(e))
+      finally:
+        conn.metrics = config['metrics'].account
+        config['metrics'].add(metrics)
+  finally:
+    yield conn.close()
+
+def reconnect(conn, executor, config, error, tries):
+  """Coroutine opening a broken connection again, returns (new Connection, tries)
+
+  Like imapbackup.Session, waiting longer each time it fails, error being
+  raised once tries reaches config['reconnects']."""
+  metrics = conn.metrics
+  metrics.stop_all()
+  conn.sock.close()
+  while True:
+    if tries >= config['reconnects']:
+      raise error
+    delay = min(imapbackup.RECONNECT_DELAY * 2 ** tries, imapbackup.RECONNECT_MAX_DELAY)
+    tries += 1
+    report("Connection lost (%s), connecting again in %ds" % (error, delay))
+    yield executor.loop.sleep(delay)
+    try:
+      conn = yield open_connection(executor, config, metrics)
+    except CONNECTION_ERRORS, e:
+      error = e
+      metrics.stop_all()
+      continue
+    metrics.add('reconnects')
+    raise Return((conn, tries))
+
+def list_rows(untagged):
+  """The rows of LIST or LSUB responses, as imapbackup.parse_list() takes them"""
+  rows = []
+  for parts in untagged:
+    row = parts[0]
+    if isinstance(row, tuple):
+      # folder name sent as a literal
+      row = imapbackup.LITERAL_RE.sub('', row[0]) + quote_argument(row[1])
+    rows.append(row.split(' ', 1)[1])
+  return rows
+
+def open_connection(executor, config, metrics=None):
+  """Coroutine connecting to the server and logging in, returns a Connection
+
+  The login is timed in metrics, those of the account by default."""
+  conn = Connection(executor, config)
+  if metrics is not None:
+    conn.metrics = metrics
+  conn.metrics.start('login')
+  yield conn.connect()
+  yield conn.login()
+  conn.metrics.stop()
+  raise Return(conn)
+
+def backup_account(loop, executor, config):
+  """Coroutine backing up every folder over config['jobs'] connections, returns the exit status"""
+  try:
+    report("Connecting to '%s' TCP port %d%s" % (config['server'], config['port'],
+                                                 config['usessl'] and ', SSL' or ''))
+    conn = yield open_connection(executor, config)
+
+    account = config['metrics'].account
+    account.start('list')
+    untagged = yield conn.simple('LIST', '""', '""')
+    delim = imapbackup.parse_hierarchy_delimiter(untagged[0][0][len('LIST '):])
+    rows = list_rows((yield conn.simple('LIST', '""', '"*"')))
+    subscribed = None
+    if config['subscribed']:
+      subscribed = list_rows((yield conn.simple('LSUB', '""', '"*"')))
+    names = imapbackup.folder_names(rows, delim, config, subscribed)
+    account.stop()
+
+    account.start('status')
+    statuses = yield get_folder_statuses(conn, names)
+    account.stop()
+    plan = imapbackup.plan_folders(names, statuses, config)
+    if config['plan']:
+      yield measure_folders(conn, plan)
+    imapbackup.save_plan(plan)
+    imapbackup.report_plan(plan, config)
+    imapbackup.report_quota((yield get_quota(conn)), plan, config)
+    if config['plan']:
+      yield conn.close()
+      raise Return(0)
+    config['localscans'].start([(folder['folder'], folder['file'], folder['priority'])
+                                for folder in plan if folder['action'] != 'skip'], config)
+    work = []
+    for folder in plan:
+      if folder['action'] == 'skip':
+        imapbackup.skip_folder(folder, config)
+      else:
+        work.append((folder['folder'], folder['file'], folder['status']))
+
+    connections = [conn]
+    for i in range(1, min(config['jobs'], len(work))):
+      connections.append((yield open_connection(executor, config)))
+    workers = [loop.spawn(backup_worker(conn, executor, work, config)) for conn in connections]
+    status = 0
+    for worker in workers:
+      try:
+        yield worker
+      except (socket.error, ssl.SSLError), e:
+        report("ERROR: %s" % (e))
+        status = status or 4
+      except ImapError, e:
+        report("ERROR: %s" % (e))
+        status = status or 5
+      except Cancelled:
+        status = status or 1
+    raise Return(status)
+  except (socket.error, ssl.SSLError), e:
+    report("ERROR: %s" % (e))
+    raise Return(4)
+  except ImapError, e:
+    report("ERROR: %s" % (e))
+    raise Return(5)
+
+def main():
+  """Main entry point"""
+  config = imapbackup.get_config()
+  if config['verify']:
+    print "ERROR --verify is only done by imapbackup.py"
+    sys.exit(2)
+  try:
+    imapbackup.profiled(config, run, config)
+  finally:
+    config['localscans'].close()
+    config['metrics'].close()
+    imapbackup.dump_profiles(config)
+
+def run(config):
+  """Backs up the account from an event loop, exits with the status of the run
+
+  With --profile, only the thread of the loop is profiled."""
+  loop = Loop()
+  executor = Executor(loop)
+  account = loop.spawn(backup_account(loop, executor, config))
+  try:
+    loop.run()
+  except KeyboardInterrupt:
+    # let every coroutine close its files
+    loop.cancel_all()
+    loop.run()
+  executor.shutdown()
+  if account.future.error is not None:
+    raise account.future.error[0], account.future.error[1], account.future.error[2]
+  imapbackup.report_left(config)
+  status = config['diskspace'].finish()
+  sys.exit(account.future.result or status)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""Backs up every account of config.d/*.conf with imapbackup.py, several at once"""
+
+# Each config.d/*.conf file sets LOCALDIR, REMOTEUSER, REMOTEPASS, REMOTESERV
+# and optionally REMOTESSL=yes (see file.conf.sample), in NAME=value lines
+# quoted and commented as in the shell.  Unlike when imapsync.sh sourced them,
+# nothing else of the shell is understood: a line with a $ substitution, a
+# `command`, a ~, an export or any other command, or a ; & | < > ( ) outside
+# of quotes is an error, rather than a value different from the shell's.
+# Accounts are run concurrently, each in its own imapbackup.py process, within
+# a global cap and a per-server cap on the number of IMAP connections.
+import os, re, sys, time, glob, getopt, shlex, subprocess, threading
+import imapbackup
+
+MAX_CONNECTIONS = 4 # IMAP connections open at once, all servers together
+MAX_PER_SERVER = 2 # IMAP connections open at once to a single server
+ASSIGNMENT_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+SHELL_SPECIAL = '$`~;&|<>()' # what the shell would do more than quoting with
+
+def print_usage():
+  """Prints usage, exits"""
+  print "Usage: imapsync [OPTIONS] [-- IMAPBACKUP OPTIONS]"
+  print " -c N --connections=N      Most IMAP connections open at once. (4)"
+  print " -S N --per-server=N       Most IMAP connections open to one server. (2)"
+  print "\nOptions after -- are given to imapbackup.py for every account, eg. -- -j 2"
+  print "in which case each account counts for 2 connections, or for as many as the"
+  print "limits allow, being then given a lower --jobs."
+  sys.exit(2)
+
+def shell_words(line):
+  """The words of line as the shell splits them, None if it would do more than unquote them"""
+  quote = None
+  escaped = False
+  for i in range(len(line)):
+    char = line[i]
+    if escaped:
+      escaped = False
+    elif quote == "'":
+      if char == "'":
+        quote = None
+    elif char == '\\':
+      escaped = True
+    elif quote == '"':
+      if char == '"':
+        quote = None
+      elif char in '$`':
+        return None
+    elif char in '\'"':
+      quote = char
+    elif char == '#' and (i == 0 or line[i-1].isspace()):
+      # a comment, a # within a word isn't one
+      line = line[:i]
+      break
+    elif char in SHELL_SPECIAL:
+      return None
+  try:
+    return shlex.split(line)
+  except ValueError:
+    return None
+
+def read_account(filename):
+  """Reads the NAME=value lines of an account file, returns {name: value}
+
+  Raises ValueError naming the line for what only the shell could read."""
+  account = {}
+  conffile = open(filename)
+  try:
+    number = 0
+    for line in conffile:
+      number += 1
+      words = shell_words(line)
+      if words is None or [word for word in words if not ASSIGNMENT_RE.match(word)]:
+        raise ValueError("line %d is not plain NAME=value: %s" % (number, line.strip()))
+      for word in words:
+        name, value = word.split('=', 1)
+        account[name] = value
+  finally:
+    conffile.close()
+  return account
+
+def count_jobs(args):
+  """Number of connections imapbackup.py opens with these arguments"""
+  jobs = 1
+  for i in range(len(args)):
+    if args[i] in ('-j', '--jobs') and i+1 < len(args):
+      jobs = int(args[i+1])
+    elif args[i].startswith('--jobs='):
+      jobs = int(args[i][len('--jobs='):])
+    elif args[i].startswith('-j') and len(args[i]) > 2:
+      jobs = int(args[i][2:])
+  return jobs
+
+def directory_size(path):
+  """Total size of the files under path"""
+  total = 0
+  for dirpath, dirnames, filenames in os.walk(path):
+    for name in filenames:
+      try:
+        total += os.path.getsize(os.path.join(dirpath, name))
+      except OSError:
+        pass
+  return total
+
+class ConnectionLimiter:
+  """Hands out IMAP connections within a global and a per-server limit"""
+
+  def __init__(self, total, per_server):
+    """ConnectionLimiter constructor"""
+    self.cond = threading.Condition()
+    self.total = total
+    self.per_server = per_server
+    self.free = total
+    self.free_by = {}
+
+  def acquire(self, server, count):
+    """Waits until count connections to server may be opened, returns how many may
+
+    An account wanting more connections than a limit allows gets that many,
+    once they are all free."""
+    self.cond.acquire()
+    try:
+      count = min(count, self.total, self.per_server)
+      self.free_by.setdefault(server, self.per_server)
+      while self.free - count < 0 or self.free_by[server] - count < 0:
+        self.cond.wait()
+      self.free -= count
+      self.free_by[server] -= count
+    finally:
+      self.cond.release()
+    return count
+
+  def release(self, server, count):
+    """Gives back connections obtained by acquire()"""
+    self.cond.acquire()
+    try:
+      self.free += count
+      self.free_by[server] += count
+      self.cond.notifyAll()
+    finally:
+      self.cond.release()
+
+def backup_account(conf, args, limiter, results):
+  """Runs imapbackup.py for the account of conf, appends its result to results"""
+  result = {'conf':conf, 'ok':False, 'time':0.0, 'bytes':0, 'status':None}
+  try:
+    account = read_account(conf)
+  except (IOError, ValueError), e:
+    imapbackup.report("[NOT-OK] %s: %s" % (conf, e))
+    results.append(result)
+    return
+  for name in ('LOCALDIR', 'REMOTEUSER', 'REMOTEPASS'):
+    if not account.get(name):
+      imapbackup.report("[NOT-OK] %s: no %s" % (conf, name))
+      results.append(result)
+      return
+
+  localdir = account['LOCALDIR']
+  try:
+    if not os.path.isdir(localdir):
+      os.mkdir(localdir)
+  except OSError, e:
+    imapbackup.report("[NOT-OK] %s: %s" % (conf, e))
+    results.append(result)
+    return
+  server = account.get('REMOTESERV', '').split(':')[0]
+  jobs = count_jobs(args)
+  count = limiter.acquire(server, jobs)
+  command = [sys.executable, os.path.abspath('imapbackup.py'), '--compress=none'] + args
+  if count < jobs:
+    # the last --jobs wins, no more connections are opened than were counted
+    command.append('--jobs=%d' % (count))
+  if account.get('REMOTESSL') == 'yes':
+    command.append('--ssl')
+  command += ['-s', account.get('REMOTESERV', ''),
+              '-u', account['REMOTEUSER'], '-p', account['REMOTEPASS']]
+  try:
+    size = directory_size(localdir)
+    start = time.time()
+    child = subprocess.Popen(command, cwd=localdir, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    output = child.communicate()[0]
+    result['time'] = time.time() - start
+    result['bytes'] = directory_size(localdir) - size
+    result['status'] = child.returncode
+    result['ok'] = (child.returncode == 0)
+  finally:
+    limiter.release(server, count)
+
+  # the whole output of an account at once, not mixed with other accounts'
+  imapbackup.report("== %s (%s)\n%s" % (conf, account['REMOTEUSER'], output.rstrip()))
+  results.append(result)
+
+def main():
+  """Main entry point"""
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "c:S:", ["connections=", "per-server="])
+  except getopt.GetoptError:
+    print_usage()
+
+  total, per_server = MAX_CONNECTIONS, MAX_PER_SERVER
+  try:
+    for option, value in opts:
+      if option in ("-c", "--connections"):
+        total = int(value)
+      elif option in ("-S", "--per-server"):
+        per_server = int(value)
+    count_jobs(args)
+  except ValueError:
+    print_usage()
+  if total < 1 or per_server < 1:
+    print_usage()
+
+  # config.d/ and the relative LOCALDIRs are next to this script
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  limiter = ConnectionLimiter(total, per_server)
+  results = []
+  workers = []
+  for conf in sorted(glob.glob('config.d/*.conf')):
+    worker = threading.Thread(target=backup_account, args=(conf, args, limiter, results))
+    worker.setDaemon(True)
+    worker.start()
+    workers.append(worker)
+  for worker in workers:
+    # join with a timeout, a plain join() would not let CTRL-C through
+    while worker.isAlive():
+      worker.join(1)
+
+  # per account summary
+  all_ok = len(results) == len(workers)
+  for result in sorted(results, key=lambda result: result['conf']):
+    if result['ok']:
+      state = "[OK]    "
+    else:
+      state = "[NOT-OK]"
+      all_ok = False
+    print "%s %8.1fs %10s  %s" % (state, result['time'],
+                                  imapbackup.pretty_byte_count(result['bytes']), result['conf']),
+    if result['status']:
+      print "(exit %d)" % (result['status'])
+    else:
+      print
+
+  if all_ok:
+    print "[OK] all done without error."
+    sys.exit(0)
+  else:
+    print "[NOT-OK] some error are got!"
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()